@@ -1,12 +1,28 @@
 from __future__ import annotations
 
+import atexit
+import os
 import secrets
+import threading
+import time
 from pathlib import Path
-from typing import Any, Dict
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
 
 import yaml
 
 from .paths import BACKUPS_DIR, CONFIG_DIR, DATA_DIR, FILES_DIR, SITES_DIR
+from .locks import file_lock
+from .persistence import MAX_CHANGE_OPS, Journal, apply_changes, atomic_write, document_changes, document_digest
+
+JOURNAL_PATH = CONFIG_DIR / ".journal"
+# Number of uvicorn worker processes sharing this config directory (set by scripts/run-backend.sh).
+WORKERS = int(os.environ.get("DLOPER_WORKERS") or os.environ.get("WEB_CONCURRENCY") or 1)
+# Writes are acknowledged once journaled; documents are rewritten after this quiet period...
+# With several workers every save is written through so the other processes see it on their next stat().
+FLUSH_DELAY_SECONDS = 0.5 if WORKERS <= 1 else 0.0
+# ...but never later than this after the first unflushed write.
+MAX_FLUSH_DELAY_SECONDS = 2.0
 
 DEFAULT_SYSTEM = {
     "instance": {
@@ -16,8 +32,45 @@ DEFAULT_SYSTEM = {
     "security": {
         "secret_key": "",
         "token_expiry_minutes": 90,
+        # `params` is filled in by calibration at startup (or after scheme/target changes).
+        "password_hashing": {"scheme": "pbkdf2", "target_ms": 250, "params": None},
+    },
+    # ingest_token: shared secret for X-Ingest-Token on the analytics endpoints (signed-in users need none);
+    # setting it also closes the otherwise public per-site beacon endpoint.
+    "analytics": {"enabled": True, "access_log": "", "ingest_token": ""},
+    "storage": {"backend": "sqlite"},
+    # max_file_mb: largest single file accepted by share and site uploads (multipart or resumable).
+    # Resumable sessions preallocate their full size: open sessions per user / overall, the space they may
+    # hold, and the free space a new one must leave.
+    "uploads": {
+        "max_file_mb": 4096,
+        "sessions": {"max_per_user": 8, "max_user_mb": 16384, "max_sessions": 64, "max_total_mb": 65536, "reserve_mb": 512},
+    },
+    "sites": {
+        # Archive deploys: releases kept besides the live one, and the most one deploy may unpack.
+        "releases": {"keep": 5, "max_mb": 4096, "max_files": 50000},
+        # Off by default: .gz (and .br with the brotli module) siblings for text files plus a hash manifest, built in the background.
+        # Files outside min_bytes..max_bytes are left alone; compression streams, so max_bytes bounds time, not memory.
+        "assets": {"enabled": False, "workers": 2, "min_bytes": 1024, "max_bytes": 16777216, "gzip_level": 9, "brotli_quality": 5},
+    },
+    # Store compressible SmartShare uploads gzipped (served as-is to clients that accept gzip).
+    "files": {
+        "compression": {"enabled": False, "level": 6},
+        # What the sweeper does with expired or used-up shares: "deactivate" (keep the record) or "delete".
+        "expiry": {"action": "deactivate"},
+        # Let the reverse proxy stream raw share downloads: "none", "x-accel" (nginx) or "x-sendfile".
+        "offload": {"mode": "none", "internal_prefix": "/_dloper_files/"},
+        # In-memory cache of hot share content, per worker; max_mb 0 sizes it from RAM (1/32, at most 128 MB).
+        "cache": {"enabled": True, "max_mb": 0, "max_object_mb": 16},
+        # Public share endpoints, shared by all workers: request rates (per second, 0 = off) per client IP and per
+        # share, and downloads streamed at once (more wait up to queue_seconds, then get 503).
+        "limits": {
+            "client": {"rate": 10, "burst": 40},
+            "share": {"rate": 50, "burst": 200},
+            "max_downloads_in_flight": 16,
+            "queue_seconds": 10,
+        },
     },
-    "analytics": {"enabled": True},
 }
 
 DEFAULT_USERS = {"users": []}
@@ -30,32 +83,220 @@ def ensure_directories() -> None:
         path.mkdir(parents=True, exist_ok=True)
 
 
-def _write_default(path: Path, payload: Dict[str, Any]) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w") as handle:
-        yaml.safe_dump(payload, handle, sort_keys=False)
+def freeze(value: Any) -> Any:
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value: Any) -> Any:
+    if isinstance(value, Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(item) for item in value]
+    return value
+
+
+def _signature(stat: os.stat_result) -> Tuple[int, int, int]:
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+class ConfigStore:
+    """Parsed YAML documents kept in memory and revalidated against the file's stat signature.
+
+    Cached documents are frozen; `snapshot()` hands them out as-is for read paths and
+    `load()` returns a mutable copy for callers that edit and save. Saves journal just what
+    changed and are acknowledged immediately, then coalesced into one atomic rewrite per
+    document. With several workers saves are written through instead (see FLUSH_DELAY_SECONDS).
+    """
+
+    def __init__(self, journal: Journal) -> None:
+        self._entries: Dict[Path, Tuple[Tuple[int, int, int], Mapping[str, Any]]] = {}
+        self._dirty: Dict[Path, Mapping[str, Any]] = {}
+        # digest of each dirty document's latest state, the base of its next journal entry
+        self._digests: Dict[Path, str] = {}
+        self._watchers: Dict[Path, List[Callable[[], None]]] = {}
+        self._lock = threading.RLock()
+        self._timer: Optional[threading.Timer] = None
+        self._dirty_since: Optional[float] = None
+        self.journal = journal
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+        self.flushes = 0
+        self.documents_written = 0
+        self.bytes_written = 0
+
+    def snapshot(self, path: Path, default: Dict[str, Any]) -> Mapping[str, Any]:
+        pending = self._dirty.get(path)
+        if pending is not None:
+            self.hits += 1
+            return pending
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            self._write(path, default)
+            stat = path.stat()
+        signature = _signature(stat)
+        cached = self._entries.get(path)
+        if cached and cached[0] == signature:
+            self.hits += 1
+            return cached[1]
+        with self._lock:
+            self.misses += 1
+            with path.open() as handle:
+                content = freeze(yaml.safe_load(handle) or {})
+            self._entries[path] = (signature, content)
+        if cached:
+            for callback in self._watchers.get(path, ()):
+                callback()
+        return content
+
+    def watch(self, path: Path, callback: Callable[[], None]) -> None:
+        """Call `callback` when a cached document is found rewritten behind this store's back
+        (edited by hand, or saved by another worker)."""
+        self._watchers.setdefault(path, []).append(callback)
+
+    def load(self, path: Path, default: Dict[str, Any]) -> Dict[str, Any]:
+        return thaw(self.snapshot(path, default))
+
+    def store(self, path: Path, payload: Dict[str, Any]) -> None:
+        frozen = freeze(payload)
+        with self._lock:
+            self.saves += 1
+            if FLUSH_DELAY_SECONDS <= 0:
+                self._write(path, payload)
+                self._entries[path] = (_signature(path.stat()), frozen)
+                return
+            base = self._dirty.get(path)
+            digest = self._digests.get(path)
+            if base is None:
+                cached = self._entries.get(path)
+                if cached and path.exists() and _signature(path.stat()) == cached[0]:
+                    base = cached[1]
+                    digest = document_digest(base)
+            changes = document_changes(base, frozen) if base is not None else [{"path": [], "set": frozen}]
+            if not changes:
+                return
+            if len(changes) > MAX_CHANGE_OPS or base is None:
+                changes, digest = [{"path": [], "set": frozen}], None
+            self.journal.append(path, changes, digest)
+            self._dirty[path] = frozen
+            self._digests[path] = document_digest(frozen)
+            self._schedule_flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._dirty_since = None
+            if not self._dirty:
+                return
+            for path, frozen in list(self._dirty.items()):
+                self._write(path, frozen)
+                self._entries[path] = (_signature(path.stat()), frozen)
+                del self._dirty[path]
+                self._digests.pop(path, None)
+            self.journal.truncate()
+            self.flushes += 1
+
+    def recover(self) -> int:
+        """Apply writes that were journaled but not flushed before the last shutdown."""
+        with self._lock:
+            recovered = 0
+            for path, entries in self.journal.replay():
+                try:
+                    with path.open() as handle:
+                        document = yaml.safe_load(handle) or {}
+                except FileNotFoundError:
+                    document = {}
+                applied = False
+                for base, changes in entries:
+                    # The document on disk may already contain an entry: it was rewritten but the
+                    # journal not yet truncated. Such entries no longer match and are skipped.
+                    if base is None or base == document_digest(document):
+                        document = apply_changes(document, changes)
+                        applied = True
+                if not applied:
+                    continue
+                self._write(path, document)
+                self._entries.pop(path, None)
+                recovered += 1
+            self.journal.truncate()
+            return recovered
+
+    def invalidate(self, path: Optional[Path] = None) -> None:
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+            "saves": self.saves,
+            "flushes": self.flushes,
+            "documents_written": self.documents_written,
+            "document_bytes": self.bytes_written,
+            "journal_bytes": self.journal.bytes_appended,
+            "pending": len(self._dirty),
+        }
+
+    def _schedule_flush(self) -> None:
+        now = time.monotonic()
+        if self._dirty_since is None:
+            self._dirty_since = now
+        delay = min(FLUSH_DELAY_SECONDS, max(self._dirty_since + MAX_FLUSH_DELAY_SECONDS - now, 0.0))
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _write(self, path: Path, payload: Mapping[str, Any]) -> None:
+        data = yaml.safe_dump(thaw(payload), sort_keys=False).encode()
+        atomic_write(path, data)
+        self.documents_written += 1
+        self.bytes_written += len(data)
+
+
+store = ConfigStore(Journal(JOURNAL_PATH))
+atexit.register(store.flush)
 
 
 def load_yaml(path: Path, default: Dict[str, Any]) -> Dict[str, Any]:
-    if not path.exists():
-        _write_default(path, default)
-    with path.open() as handle:
-        content = yaml.safe_load(handle) or {}
-    return content
+    return store.load(path, default)
 
 
 def save_yaml(path: Path, payload: Dict[str, Any]) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w") as handle:
-        yaml.safe_dump(payload, handle, sort_keys=False)
+    store.store(path, payload)
+
+
+def flush() -> None:
+    store.flush()
+
+
+def cache_stats() -> Dict[str, Any]:
+    return store.stats()
 
 
 def init_config() -> Dict[str, Any]:
     ensure_directories()
-    system = load_yaml(CONFIG_DIR / "system.yaml", DEFAULT_SYSTEM)
-    if not system.get("security", {}).get("secret_key"):
-        system.setdefault("security", {})["secret_key"] = secrets.token_hex(32)
-        save_yaml(CONFIG_DIR / "system.yaml", system)
+    # Workers start concurrently; only the first one may recover the journal or mint the secret.
+    with file_lock("config-system"):
+        store.recover()
+        system = load_yaml(CONFIG_DIR / "system.yaml", DEFAULT_SYSTEM)
+        if not system.get("security", {}).get("secret_key"):
+            system.setdefault("security", {})["secret_key"] = secrets.token_hex(32)
+            save_yaml(CONFIG_DIR / "system.yaml", system)
 
     # Initialize other config files if missing
     load_yaml(CONFIG_DIR / "users.yaml", DEFAULT_USERS)
@@ -68,6 +309,10 @@ def get_system_settings() -> Dict[str, Any]:
     return load_yaml(CONFIG_DIR / "system.yaml", DEFAULT_SYSTEM)
 
 
+def system_snapshot() -> Mapping[str, Any]:
+    return store.snapshot(CONFIG_DIR / "system.yaml", DEFAULT_SYSTEM)
+
+
 def get_users_config() -> Dict[str, Any]:
     return load_yaml(CONFIG_DIR / "users.yaml", DEFAULT_USERS)
 
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from .paths import DB_PATH
+
+# Each entry upgrades the schema by one version (tracked in PRAGMA user_version).
+MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS sites (
+        name TEXT PRIMARY KEY,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS site_domains (
+        domain TEXT NOT NULL,
+        site TEXT NOT NULL REFERENCES sites(name) ON DELETE CASCADE,
+        PRIMARY KEY (domain, site)
+    );
+    CREATE INDEX IF NOT EXISTS idx_site_domains_site ON site_domains(site);
+    CREATE TABLE IF NOT EXISTS files (
+        id TEXT PRIMARY KEY,
+        owner TEXT,
+        expires_at TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_files_owner ON files(owner);
+    CREATE INDEX IF NOT EXISTS idx_files_expires_at ON files(expires_at) WHERE expires_at IS NOT NULL;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_buckets (
+        site TEXT NOT NULL,
+        granularity TEXT NOT NULL,
+        bucket_start INTEGER NOT NULL,
+        requests INTEGER NOT NULL DEFAULT 0,
+        errors INTEGER NOT NULL DEFAULT 0,
+        bandwidth_mb REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (site, granularity, bucket_start)
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS site_sketches (
+        site TEXT NOT NULL,
+        name TEXT NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (site, name)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS download_sessions (
+        file_id TEXT NOT NULL,
+        client TEXT NOT NULL,
+        last_seen REAL NOT NULL,
+        PRIMARY KEY (file_id, client)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS download_sessions_last_seen ON download_sessions(last_seen);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS upload_sessions (
+        id TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        target TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        chunk_size INTEGER NOT NULL,
+        options TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS upload_sessions_updated ON upload_sessions(updated_at);
+    CREATE TABLE IF NOT EXISTS upload_chunks (
+        session_id TEXT NOT NULL REFERENCES upload_sessions(id) ON DELETE CASCADE,
+        idx INTEGER NOT NULL,
+        PRIMARY KEY (session_id, idx)
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS blobs (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL,
+        created_at REAL NOT NULL
+    ) WITHOUT ROWID;
+    """,
+    """
+    ALTER TABLE blobs ADD COLUMN encoding TEXT;
+    ALTER TABLE blobs ADD COLUMN stored_size INTEGER;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS site_entries (
+        site TEXT NOT NULL,
+        parent TEXT NOT NULL,
+        name TEXT NOT NULL,
+        is_dir INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        files INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        PRIMARY KEY (site, parent, name)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS site_dirs (
+        site TEXT NOT NULL,
+        path TEXT NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        PRIMARY KEY (site, path)
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS site_hashes (
+        site TEXT NOT NULL,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        PRIMARY KEY (site, path)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS sync_plans (
+        id TEXT PRIMARY KEY,
+        site TEXT NOT NULL,
+        base TEXT,
+        created_at REAL NOT NULL,
+        data TEXT NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS site_assets (
+        site TEXT NOT NULL,
+        path TEXT NOT NULL,
+        sha256 TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        encodings TEXT NOT NULL,
+        PRIMARY KEY (site, path)
+    ) WITHOUT ROWID;
+    """,
+    """
+    ALTER TABLE files ADD COLUMN sweep_at REAL;
+    CREATE INDEX IF NOT EXISTS idx_files_sweep_at ON files(sweep_at) WHERE sweep_at IS NOT NULL;
+    """,
+    """
+    ALTER TABLE download_sessions ADD COLUMN started_at REAL;
+    UPDATE download_sessions SET started_at = last_seen;
+    CREATE INDEX IF NOT EXISTS download_sessions_started_at ON download_sessions(started_at);
+    """,
+]
+
+_local = threading.local()
+
+
+def connect() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(DB_PATH), timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        _local.conn = conn
+    return conn
+
+
+@contextmanager
+def transaction(immediate: bool = False) -> Iterator[sqlite3.Connection]:
+    conn = connect()
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def init_db() -> None:
+    conn = connect()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for index, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.executescript(f"BEGIN; {script}; PRAGMA user_version = {index}; COMMIT;")
+
+
+def get_meta(key: str) -> Optional[str]:
+    row = connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row else None
+
+
+def set_meta(key: str, value: str) -> None:
+    connect().execute("INSERT INTO meta(key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
+
+from .paths import DATA_DIR
+
+LOCKS_DIR = DATA_DIR / "locks"
+GENERATIONS_PATH = LOCKS_DIR / "generations"
+GENERATION_SLOTS = 256
+_SLOT = struct.Struct("<Q")
+BUCKETS_PATH = LOCKS_DIR / "buckets"
+BUCKET_SLOTS = 4096
+_BUCKET = struct.Struct("<Qdd")  # key digest, tokens, last refill (CLOCK_MONOTONIC, the same in every process)
+PROCESS_SLOTS = 64
+_GAUGE = struct.Struct("<qq")  # pid, value
+
+
+@contextmanager
+def file_lock(name: str) -> Iterator[None]:
+    """Exclusive lock shared by every thread and worker process on this host."""
+    LOCKS_DIR.mkdir(parents=True, exist_ok=True)
+    fd = os.open(str(LOCKS_DIR / f"{name}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def try_leader_lock(name: str) -> Optional[int]:
+    """Non-blocking lock held until the process exits; only one worker gets it (None for the rest)."""
+    LOCKS_DIR.mkdir(parents=True, exist_ok=True)
+    fd = os.open(str(LOCKS_DIR / f"{name}.leader"), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+class Generations:
+    """Per-name change counters in a memory-mapped file shared by all worker processes.
+
+    Writers bump a name after committing a change; in-process caches remember the
+    generation they were filled at and drop their entries once it moves.
+    """
+
+    def __init__(self) -> None:
+        self._map: Optional[mmap.mmap] = None
+        self._lock = threading.Lock()
+
+    def _mapping(self) -> mmap.mmap:
+        if self._map is None:
+            with self._lock, file_lock("generations"):
+                if self._map is None:
+                    size = GENERATION_SLOTS * _SLOT.size
+                    fd = os.open(str(GENERATIONS_PATH), os.O_RDWR | os.O_CREAT, 0o600)
+                    try:
+                        if os.fstat(fd).st_size < size:
+                            os.ftruncate(fd, size)
+                        self._map = mmap.mmap(fd, size)
+                    finally:
+                        os.close(fd)
+        return self._map
+
+    @staticmethod
+    def _offset(name: str) -> int:
+        return (zlib.crc32(name.encode()) % GENERATION_SLOTS) * _SLOT.size
+
+    def current(self, name: str) -> int:
+        return _SLOT.unpack_from(self._mapping(), self._offset(name))[0]
+
+    def bump(self, name: str) -> int:
+        mapping = self._mapping()
+        offset = self._offset(name)
+        with self._lock, file_lock("generations"):
+            value = _SLOT.unpack_from(mapping, offset)[0] + 1
+            _SLOT.pack_into(mapping, offset, value)
+        return value
+
+
+generations = Generations()
+
+
+class _SharedTable:
+    """A fixed-size memory-mapped file plus an flock on it, opened lazily (after uvicorn forks)."""
+
+    def __init__(self, path: "os.PathLike[str]", size: int) -> None:
+        self.path, self.size = path, size
+        self._map: Optional[mmap.mmap] = None
+        self._fd = -1
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def locked(self) -> Iterator[mmap.mmap]:
+        with self._lock:
+            if self._map is None:
+                LOCKS_DIR.mkdir(parents=True, exist_ok=True)
+                fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if os.fstat(fd).st_size < self.size:
+                    os.ftruncate(fd, self.size)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                self._map, self._fd = mmap.mmap(fd, self.size), fd
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield self._map
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class SharedBuckets:
+    """Token buckets shared by every worker process, so a rate or bandwidth cap is host-wide.
+
+    Keys hash to one of BUCKET_SLOTS slots. A key landing on a slot held by another key starts
+    over with a full bucket, as if the other one had been evicted from an LRU.
+    """
+
+    def __init__(self) -> None:
+        self._table = _SharedTable(BUCKETS_PATH, BUCKET_SLOTS * _BUCKET.size)
+
+    def spend(self, key: str, rate: float, capacity: float, amount: float, now: float, force: bool = False) -> float:
+        """Take `amount` tokens and return 0; if there are not enough, take nothing and return the
+        seconds until there would be. With `force` the amount is always taken (the balance may go
+        negative) and the return value is how long to wait to pay it back."""
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+        offset = digest % BUCKET_SLOTS * _BUCKET.size
+        with self._table.locked() as mapping:
+            stored, tokens, updated = _BUCKET.unpack_from(mapping, offset)
+            if stored != digest or updated > now + 60:  # another key's slot, or written before a reboot
+                tokens, updated = capacity, now
+            # `now` was read before the lock, so it may be older than the last writer's; never refill twice.
+            now = max(now, updated)
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if force:
+                tokens -= amount
+                wait = max(-tokens / rate, 0.0)
+            elif tokens >= amount:
+                tokens -= amount
+                wait = 0.0
+            else:
+                wait = (amount - tokens) / rate
+            _BUCKET.pack_into(mapping, offset, digest, tokens, now)
+        return wait
+
+
+class SharedGauge:
+    """A count summed over all live worker processes; each process owns one slot, so a worker
+    that dies holding some of the count does not leak it."""
+
+    def __init__(self, path: "os.PathLike[str]") -> None:
+        self._table = _SharedTable(path, PROCESS_SLOTS * _GAUGE.size)
+
+    @staticmethod
+    def _alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _scan(self, mapping: mmap.mmap) -> Tuple[int, int]:
+        """(total over live processes, offset of this process's slot), reclaiming dead ones."""
+        pid, own, free, total = os.getpid(), -1, -1, 0
+        for offset in range(0, PROCESS_SLOTS * _GAUGE.size, _GAUGE.size):
+            holder, value = _GAUGE.unpack_from(mapping, offset)
+            if holder == pid:
+                own = offset
+            elif holder and not self._alive(holder):
+                _GAUGE.pack_into(mapping, offset, 0, 0)
+                holder = 0
+            if holder:
+                total += value
+            elif free < 0:
+                free = offset
+        if own < 0:
+            if free < 0:
+                raise RuntimeError("No free process slot in the shared gauge")
+            own = free
+            _GAUGE.pack_into(mapping, own, pid, 0)
+        return total, own
+
+    def try_add(self, limit: int) -> bool:
+        """Add one unless the total is already at `limit` (0 = no limit)."""
+        with self._table.locked() as mapping:
+            total, own = self._scan(mapping)
+            if limit and total >= limit:
+                return False
+            pid, value = _GAUGE.unpack_from(mapping, own)
+            _GAUGE.pack_into(mapping, own, pid, value + 1)
+        return True
+
+    def add(self, delta: int) -> None:
+        with self._table.locked() as mapping:
+            _, own = self._scan(mapping)
+            pid, value = _GAUGE.unpack_from(mapping, own)
+            _GAUGE.pack_into(mapping, own, pid, value + delta)
+
+    def total(self) -> int:
+        with self._table.locked() as mapping:
+            return self._scan(mapping)[0]
+
+
+buckets = SharedBuckets()
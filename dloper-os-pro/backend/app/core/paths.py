@@ -1,10 +1,13 @@
+import os
 from pathlib import Path
 
-# Resolve project directories relative to the backend/app package
-BASE_DIR = Path(__file__).resolve().parents[2]
+# Resolve project directories relative to the backend/app package (DLOPER_BASE_DIR moves them, e.g. for tests)
+BASE_DIR = Path(os.environ.get("DLOPER_BASE_DIR") or Path(__file__).resolve().parents[2])
 CONFIG_DIR = BASE_DIR / "config"
 DATA_DIR = BASE_DIR / "data"
 SITES_DIR = DATA_DIR / "sites"
 FILES_DIR = DATA_DIR / "files"
+# Content-addressed share data (sha256 fan-out); lives under FILES_DIR so file backups include it.
+BLOBS_DIR = FILES_DIR / "blobs"
 BACKUPS_DIR = DATA_DIR / "backups"
 DB_PATH = DATA_DIR / "db.sqlite3"
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+# os.umask can only be read by setting it, so it is read once, at import, before worker threads start.
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+# Mode for stored files the reverse proxy (another user, e.g. www-data) has to read. Temp files
+# from mkstemp or private O_CREAT modes are 0600 and get this before they are published.
+PUBLIC_FILE_MODE = 0o644 & ~_UMASK
+
+
+def fsync_dir(path: Path) -> None:
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def fsync_tree(root: Path) -> None:
+    """fsync every file and directory under `root`, children before their directory."""
+    for dirpath, _, filenames in os.walk(root, topdown=False):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+        fsync_dir(Path(dirpath))
+
+
+def make_public(root: Path) -> int:
+    """Give every regular file under `root` PUBLIC_FILE_MODE if it lacks it; returns how many changed."""
+    changed = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                if os.stat(path).st_mode & 0o777 != PUBLIC_FILE_MODE:
+                    os.chmod(path, PUBLIC_FILE_MODE)
+                    changed += 1
+            except OSError:
+                continue
+    return changed
+
+
+def atomic_write(path: Path, data: bytes) -> None:
+    """Replace `path` with `data` so readers only ever see the old or the new content."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            handle.write(data)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except FileNotFoundError:
+            pass
+        raise
+    fsync_dir(path.parent)
+
+
+# A document change with more operations than this is journaled as the whole document.
+MAX_CHANGE_OPS = 64
+
+Change = Dict[str, Any]
+
+
+def document_changes(old: Any, new: Any, path: Tuple[Any, ...] = ()) -> List[Change]:
+    """The operations turning `old` into `new`: `set`/`delete` at a key path, and `splice` for lists,
+    so appending, removing or editing one record of a long list yields a change of one record."""
+    if isinstance(old, Mapping) and isinstance(new, Mapping):
+        changes: List[Change] = [{"path": [*path, key], "delete": True} for key in old if key not in new]
+        for key, value in new.items():
+            if key not in old:
+                changes.append({"path": [*path, key], "set": value})
+            elif old[key] != value:
+                changes.extend(document_changes(old[key], value, (*path, key)))
+        return changes
+    if isinstance(old, Sequence) and isinstance(new, Sequence) and not isinstance(old, str) and not isinstance(new, str):
+        if len(old) == len(new):
+            changes = []
+            for index in range(len(old)):
+                if old[index] != new[index]:
+                    changes.extend(document_changes(old[index], new[index], (*path, index)))
+            return changes
+        start = 0
+        while start < min(len(old), len(new)) and old[start] == new[start]:
+            start += 1
+        end = 0
+        while end < min(len(old), len(new)) - start and old[-1 - end] == new[-1 - end]:
+            end += 1
+        return [{"path": list(path), "splice": [start, len(old) - start - end, list(new[start : len(new) - end])]}]
+    return [{"path": list(path), "set": new}]
+
+
+def apply_changes(document: Any, changes: List[Change]) -> Any:
+    for change in changes:
+        if not change["path"]:
+            document = change["set"]
+            continue
+        *parents, last = change["path"]
+        node = document
+        for key in parents:
+            node = node[key]
+        if "splice" in change:
+            start, removed, items = change["splice"]
+            node[last][start : start + removed] = items
+        elif change.get("delete"):
+            del node[last]
+        else:
+            node[last] = change["set"]
+    return document
+
+
+def _json_default(value: Any) -> Any:
+    return dict(value) if isinstance(value, Mapping) else str(value)
+
+
+def document_digest(document: Any) -> str:
+    """Content hash of a document, the same for its frozen, thawed and re-parsed forms."""
+    data = json.dumps(document, default=_json_default, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class Journal:
+    """Append-only log of acknowledged document changes, truncated once they are flushed.
+
+    Each entry holds only what changed (see `document_changes`) relative to the document as
+    last flushed plus the entries before it, so a save costs about the size of the edit.
+    It also records the digest of the document it applies to (`base`); replay skips entries
+    whose base the document has moved past, so a crash after a document was rewritten but
+    before the journal was truncated does not apply the same splice twice.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.appends = 0
+        self.bytes_appended = 0
+
+    def append(self, target: Path, changes: List[Change], base: Optional[str] = None) -> None:
+        entry = {"path": str(target), "base": base, "changes": changes}
+        line = json.dumps(entry, default=_json_default, separators=(",", ":")) + "\n"
+        data = line.encode()
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(str(self.path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.appends += 1
+            self.bytes_appended += len(data)
+
+    def replay(self) -> Iterator[Tuple[Path, List[Tuple[Optional[str], List[Change]]]]]:
+        """Yield each document's journaled (base, changes) entries, in order; a torn trailing line is ignored.
+
+        A base of None (a whole-document set, or an entry from an older journal) applies to any state.
+        """
+        if not self.path.exists():
+            return
+        pending: Dict[str, List[Tuple[Optional[str], List[Change]]]] = {}
+        with self.path.open() as handle:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if "payload" in entry:  # whole-document entry from an older journal
+                    pending[entry["path"]] = [(None, [{"path": [], "set": entry["payload"]}])]
+                else:
+                    pending.setdefault(entry["path"], []).append((entry.get("base"), entry["changes"]))
+        for target, entries in pending.items():
+            yield Path(target), entries
+
+    def truncate(self) -> None:
+        with self._lock:
+            if self.path.exists():
+                with self.path.open("w"):
+                    pass
@@ -0,0 +1,370 @@
+from __future__ import annotations
+
+import datetime as dt
+import json
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import config, db
+from .locks import file_lock, generations
+
+Record = Dict[str, Any]
+Mutator = Callable[[Record], Optional[Record]]
+
+
+class YamlCollection:
+    """Records kept as a single list inside a YAML document (the original storage format)."""
+
+    def __init__(self, path: Path, list_key: str, key: str, default: Dict[str, Any]) -> None:
+        self.path = path
+        self.list_key = list_key
+        self.key = key
+        self.default = default
+
+    def _snapshot(self) -> Tuple[Any, ...]:
+        return config.store.snapshot(self.path, self.default).get(self.list_key, ())
+
+    def revalidate(self) -> None:
+        """Re-stat the document, so an edit made on disk is noticed (see `Collection.generation`)."""
+        self._snapshot()
+
+    def all(self) -> List[Record]:
+        return config.thaw(self._snapshot())
+
+    def get(self, key: str) -> Optional[Record]:
+        for record in self._snapshot():
+            if record.get(self.key) == key:
+                return config.thaw(record)
+        return None
+
+    def find(self, field: str, value: Any) -> List[Record]:
+        matches = []
+        for record in self._snapshot():
+            current = record.get(field)
+            if current == value or (isinstance(current, tuple) and value in current):
+                matches.append(config.thaw(record))
+        return matches
+
+    def _lock(self):
+        return file_lock(f"config-{self.path.stem}")
+
+    def insert(self, record: Record) -> bool:
+        with self._lock():
+            records = self.all()
+            if any(r.get(self.key) == record[self.key] for r in records):
+                return False
+            records.append(record)
+            self._save(records)
+        return True
+
+    def update(self, key: str, mutate: Mutator) -> Optional[Record]:
+        with self._lock():
+            records = self.all()
+            for idx, record in enumerate(records):
+                if record.get(self.key) == key:
+                    updated = mutate(record) or record
+                    records[idx] = updated
+                    self._save(records)
+                    return updated
+        return None
+
+    def delete(self, key: str) -> Optional[Record]:
+        with self._lock():
+            records = self.all()
+            for idx, record in enumerate(records):
+                if record.get(self.key) == key:
+                    del records[idx]
+                    self._save(records)
+                    return record
+        return None
+
+    def replace_all(self, records: List[Record]) -> None:
+        with self._lock():
+            self._save(records)
+
+    def _save(self, records: List[Record]) -> None:
+        config.save_yaml(self.path, {self.list_key: records})
+
+
+class SqliteCollection:
+    """Records stored as JSON rows with selected fields mirrored into indexed columns."""
+
+    def __init__(
+        self,
+        table: str,
+        key: str,
+        columns: Tuple[str, ...] = (),
+        multi: Optional[Tuple[str, str, str, str]] = None,
+        derived: Optional[Dict[str, Callable[[Record], Any]]] = None,
+    ) -> None:
+        self.table = table
+        self.key = key
+        self.columns = columns
+        # column -> function of the record, for indexed columns that are computed rather than copied
+        self.derived = derived or {}
+        # (link table, value column, owner column, record field) for list-valued fields such as site domains
+        self.multi = multi
+
+    @staticmethod
+    def _decode(rows) -> List[Record]:
+        return [json.loads(row["data"]) for row in rows]
+
+    def all(self) -> List[Record]:
+        rows = db.connect().execute(f"SELECT data FROM {self.table} ORDER BY rowid")
+        return self._decode(rows)
+
+    def get(self, key: str) -> Optional[Record]:
+        row = db.connect().execute(f"SELECT data FROM {self.table} WHERE {self.key} = ?", (key,)).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def find(self, field: str, value: Any) -> List[Record]:
+        conn = db.connect()
+        if self.multi and field == self.multi[3]:
+            link_table, value_column, owner_column, _ = self.multi
+            rows = conn.execute(
+                f"SELECT t.data FROM {self.table} t JOIN {link_table} l ON l.{owner_column} = t.{self.key} "
+                f"WHERE l.{value_column} = ? ORDER BY t.rowid",
+                (value,),
+            )
+            return self._decode(rows)
+        if field == self.key or field in self.columns:
+            rows = conn.execute(f"SELECT data FROM {self.table} WHERE {field} = ? ORDER BY rowid", (value,))
+            return self._decode(rows)
+        return [record for record in self.all() if record.get(field) == value]
+
+    def _values(self, record: Record) -> Tuple[Any, ...]:
+        return tuple(self.derived[column](record) if column in self.derived else record.get(column) for column in self.columns)
+
+    def ordered_below(self, column: str, bound: Any, limit: int) -> List[Record]:
+        """Records whose `column` is at most `bound`, lowest first (uses the column's index)."""
+        rows = db.connect().execute(
+            f"SELECT data FROM {self.table} WHERE {column} IS NOT NULL AND {column} <= ? ORDER BY {column} LIMIT ?", (bound, limit)
+        )
+        return self._decode(rows)
+
+    def lowest(self, column: str) -> Tuple[Optional[Any], int]:
+        """(smallest non-null value of `column`, number of rows that have one)."""
+        row = db.connect().execute(f"SELECT MIN({column}), COUNT({column}) FROM {self.table}").fetchone()
+        return row[0], row[1]
+
+    def refresh_columns(self) -> int:
+        """Recompute the mirrored columns of every row, e.g. after a derived column was added."""
+        with db.transaction(immediate=True) as conn:
+            rows = conn.execute(f"SELECT {self.key} AS key, data FROM {self.table}").fetchall()
+            assignments = ", ".join(f"{column} = ?" for column in self.columns)
+            conn.executemany(
+                f"UPDATE {self.table} SET {assignments} WHERE {self.key} = ?",
+                [(*self._values(json.loads(row["data"])), row["key"]) for row in rows],
+            )
+        return len(rows)
+
+    def _write_links(self, conn, record: Record) -> None:
+        if not self.multi:
+            return
+        link_table, value_column, owner_column, field = self.multi
+        conn.execute(f"DELETE FROM {link_table} WHERE {owner_column} = ?", (record[self.key],))
+        conn.executemany(
+            f"INSERT OR IGNORE INTO {link_table}({value_column}, {owner_column}) VALUES (?, ?)",
+            [(value, record[self.key]) for value in record.get(field) or []],
+        )
+
+    def _insert(self, conn, record: Record) -> None:
+        names = ", ".join((self.key, *self.columns, "data"))
+        marks = ", ".join("?" * (len(self.columns) + 2))
+        conn.execute(
+            f"INSERT INTO {self.table}({names}) VALUES ({marks})",
+            (record[self.key], *self._values(record), json.dumps(record)),
+        )
+        self._write_links(conn, record)
+
+    def insert(self, record: Record) -> bool:
+        with db.transaction(immediate=True) as conn:
+            exists = conn.execute(f"SELECT 1 FROM {self.table} WHERE {self.key} = ?", (record[self.key],)).fetchone()
+            if exists:
+                return False
+            self._insert(conn, record)
+        return True
+
+    def insert_many(self, records: List[Record]) -> int:
+        inserted = 0
+        with db.transaction(immediate=True) as conn:
+            for record in records:
+                exists = conn.execute(f"SELECT 1 FROM {self.table} WHERE {self.key} = ?", (record[self.key],)).fetchone()
+                if not exists:
+                    self._insert(conn, record)
+                    inserted += 1
+        return inserted
+
+    def update(self, key: str, mutate: Mutator) -> Optional[Record]:
+        with db.transaction(immediate=True) as conn:
+            return self.update_in(conn, key, mutate)
+
+    def update_in(self, conn, key: str, mutate: Mutator) -> Optional[Record]:
+        """`update` inside a transaction the caller holds, so it commits or rolls back with the caller's other writes."""
+        row = conn.execute(f"SELECT data FROM {self.table} WHERE {self.key} = ?", (key,)).fetchone()
+        if not row:
+            return None
+        record = json.loads(row["data"])
+        updated = mutate(record) or record
+        assignments = ", ".join(f"{column} = ?" for column in (*self.columns, "data"))
+        conn.execute(
+            f"UPDATE {self.table} SET {assignments} WHERE {self.key} = ?",
+            (*self._values(updated), json.dumps(updated), key),
+        )
+        self._write_links(conn, updated)
+        return updated
+
+    def delete(self, key: str) -> Optional[Record]:
+        with db.transaction(immediate=True) as conn:
+            row = conn.execute(f"SELECT data FROM {self.table} WHERE {self.key} = ?", (key,)).fetchone()
+            if not row:
+                return None
+            conn.execute(f"DELETE FROM {self.table} WHERE {self.key} = ?", (key,))
+        return json.loads(row["data"])
+
+    def replace_all(self, records: List[Record]) -> None:
+        with db.transaction(immediate=True) as conn:
+            conn.execute(f"DELETE FROM {self.table}")
+            for record in records:
+                self._insert(conn, record)
+
+
+class Collection:
+    """Facade that routes record operations to the configured storage backend.
+
+    Every successful mutation bumps the collection's shared generation so per-worker
+    caches built on top of it can tell their entries are stale.
+    """
+
+    def __init__(self, name: str, yaml_backend: YamlCollection, sqlite_backend: SqliteCollection) -> None:
+        self.name = name
+        self.backends = {"yaml": yaml_backend, "sqlite": sqlite_backend}
+        self.backend = "yaml"
+        config.store.watch(yaml_backend.path, self.bump)
+
+    @property
+    def impl(self):
+        return self.backends[self.backend]
+
+    def all(self) -> List[Record]:
+        return self.impl.all()
+
+    def get(self, key: str) -> Optional[Record]:
+        return self.impl.get(key)
+
+    def find(self, field: str, value: Any) -> List[Record]:
+        return self.impl.find(field, value)
+
+    def generation(self) -> int:
+        if self.backend == "yaml":
+            # Edits to the YAML document made outside the API bump the generation when it is reloaded.
+            self.impl.revalidate()
+        return generations.current(self.name)
+
+    def bump(self) -> None:
+        """Mark the collection changed after writing through a backend directly (e.g. `SqliteCollection.update_in`)."""
+        generations.bump(self.name)
+
+    def insert(self, record: Record) -> bool:
+        inserted = self.impl.insert(record)
+        if inserted:
+            generations.bump(self.name)
+        return inserted
+
+    def update(self, key: str, mutate: Mutator) -> Optional[Record]:
+        updated = self.impl.update(key, mutate)
+        if updated is not None:
+            generations.bump(self.name)
+        return updated
+
+    def delete(self, key: str) -> Optional[Record]:
+        removed = self.impl.delete(key)
+        if removed is not None:
+            generations.bump(self.name)
+        return removed
+
+    def replace_all(self, records: List[Record]) -> None:
+        self.impl.replace_all(records)
+        generations.bump(self.name)
+
+
+# A share's downloads are counted once per client per window this long; a used-up share is
+# kept for one more window so its last download can still be resumed (services/files, expiry).
+DOWNLOAD_SESSION_SECONDS = 30 * 60
+
+
+def timestamp(value: str) -> float:
+    parsed = dt.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=dt.timezone.utc)  # stored as naive UTC
+    return parsed.timestamp()
+
+
+def share_due_at(record: Record) -> Optional[float]:
+    """When a share should be swept (expired, or used up plus the grace window), or None if it never needs to be."""
+    if not record.get("active", True) or record.get("purged_at"):
+        return None
+    due: List[float] = []
+    if record.get("expires_at"):
+        due.append(timestamp(record["expires_at"]))
+    if record.get("max_downloads") and record.get("download_count", 0) >= record["max_downloads"]:
+        exhausted_at = record.get("exhausted_at")
+        due.append(timestamp(exhausted_at) + DOWNLOAD_SESSION_SECONDS if exhausted_at else 0.0)
+    return min(due) if due else None
+
+
+users = Collection(
+    "users",
+    YamlCollection(config.CONFIG_DIR / "users.yaml", "users", "username", config.DEFAULT_USERS),
+    SqliteCollection("users", "username"),
+)
+sites = Collection(
+    "sites",
+    YamlCollection(config.CONFIG_DIR / "websites.yaml", "websites", "name", config.DEFAULT_WEBSITES),
+    SqliteCollection("sites", "name", multi=("site_domains", "domain", "site", "domains")),
+)
+files = Collection(
+    "files",
+    YamlCollection(config.CONFIG_DIR / "files.yaml", "files", "id", config.DEFAULT_FILES),
+    # sweep_at: when the share is next due for the expiry sweeper (services/expiry.py).
+    SqliteCollection("files", "id", columns=("owner", "expires_at", "sweep_at"), derived={"sweep_at": share_due_at}),
+)
+
+COLLECTIONS = {"users": users, "sites": sites, "files": files}
+
+
+def active_backend() -> str:
+    return config.system_snapshot().get("storage", {}).get("backend", "sqlite")
+
+
+def migrate_from_yaml(force: bool = False) -> Dict[str, int]:
+    """Copy YAML records into SQLite once; later runs are no-ops unless forced."""
+    if db.get_meta("yaml_migrated") and not force:
+        return {}
+    counts: Dict[str, int] = {}
+    for name, collection in COLLECTIONS.items():
+        source: YamlCollection = collection.backends["yaml"]  # type: ignore[assignment]
+        target: SqliteCollection = collection.backends["sqlite"]  # type: ignore[assignment]
+        if not source.path.exists():
+            continue
+        counts[name] = target.insert_many([r for r in source.all() if r.get(source.key)])
+    db.set_meta("yaml_migrated", json.dumps(counts))
+    return counts
+
+
+def init_storage() -> str:
+    backend = active_backend()
+    if backend not in ("yaml", "sqlite"):
+        raise RuntimeError(f"Unknown storage backend: {backend}")
+    with file_lock("storage-init"):
+        db.init_db()
+        if backend == "sqlite":
+            migrate_from_yaml()
+    for collection in COLLECTIONS.values():
+        collection.backend = backend
+    return backend
+
+
+def reset_storage() -> None:
+    for collection in COLLECTIONS.values():
+        collection.replace_all([])
@@ -3,12 +3,20 @@ from __future__ import annotations
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from .core.config import init_config
+from .core.config import flush as flush_config, init_config
+from .core.storage import init_storage
+from .services import assets, blobs
 from .services.users import ensure_seed_user
-from .routes import auth, backups, docker, files, settings, system, users, websites
+from .routes import auth, backups, docker, files, settings, system, uploads, users, websites
+from .utils import background
+from .utils.security import calibrate_password_hashing, hash_pool
 
 init_config()
+calibrate_password_hashing()
+init_storage()
 ensure_seed_user()
+blobs.publish_existing()
+assets.publish_existing()
 
 app = FastAPI(title="DloperOS Pro API", version="0.1.0")
 
@@ -25,12 +33,25 @@ app.include_router(users.router, prefix="/api/users", tags=["users"])
 app.include_router(websites.router, prefix="/api/websites", tags=["websites"])
 app.include_router(files.router, prefix="/api/files", tags=["files"])
 app.include_router(files.public_router, tags=["files-public"])
+app.include_router(uploads.router, prefix="/api/uploads", tags=["uploads"])
 app.include_router(docker.router, prefix="/api/docker", tags=["docker"])
 app.include_router(system.router, prefix="/api/system", tags=["system"])
 app.include_router(backups.router, prefix="/api/backups", tags=["backups"])
 app.include_router(settings.router, prefix="/api/settings", tags=["settings"])
 
 
+@app.on_event("startup")
+def startup() -> None:
+    background.start_all()
+
+
+@app.on_event("shutdown")
+def shutdown() -> None:
+    background.stop_all()
+    hash_pool.shutdown()
+    flush_config()
+
+
 @app.get("/api/health")
 def health() -> dict:
     return {"status": "ok"}
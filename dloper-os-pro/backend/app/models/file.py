@@ -1,7 +1,13 @@
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+
+class BundleMember(BaseModel):
+    path: str
+    size: int
+    sha256: str
 
 
 class SharedFile(BaseModel):
@@ -15,6 +21,10 @@ class SharedFile(BaseModel):
     share_url: Optional[str] = None
     owner: Optional[str] = None
     active: bool = True
+    sha256: Optional[str] = None
+    size: Optional[int] = None
+    members: Optional[List[BundleMember]] = None
+    max_bytes_per_second: Optional[int] = None
 
 
 class SharedFileCreate(BaseModel):
@@ -24,8 +34,24 @@ class SharedFileCreate(BaseModel):
     active: bool = True
 
 
+class SharedFileFromHash(SharedFileCreate):
+    sha256: str
+    filename: str
+
+
 class SharedFileUpdate(BaseModel):
     password: Optional[str] = None
     max_downloads: Optional[int] = None
     expires_at: Optional[datetime] = None
     active: Optional[bool] = None
+    # Bandwidth cap for this link across all its downloads; 0 removes it.
+    max_bytes_per_second: Optional[int] = Field(None, ge=0)
+
+
+class FileTicketRequest(BaseModel):
+    password: Optional[str] = None
+
+
+class FileTicket(BaseModel):
+    ticket: str
+    expires_at: datetime
@@ -1,6 +1,6 @@
-from typing import Optional
+from typing import Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class SettingsUpdate(BaseModel):
@@ -8,6 +8,11 @@ class SettingsUpdate(BaseModel):
     base_url: Optional[str] = None
     analytics_enabled: Optional[bool] = None
     token_expiry_minutes: Optional[int] = None
+    password_hash_scheme: Optional[Literal["pbkdf2", "scrypt"]] = None
+    password_hash_target_ms: Optional[int] = Field(None, ge=50, le=5000)
+    compress_uploads: Optional[bool] = None
+    expired_share_action: Optional[Literal["deactivate", "delete"]] = None
+    download_offload: Optional[Literal["none", "x-accel", "x-sendfile"]] = None
 
 
 class ResetRequest(BaseModel):
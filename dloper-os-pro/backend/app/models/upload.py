@@ -0,0 +1,31 @@
+from datetime import datetime
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel, Field
+
+
+class UploadSessionCreate(BaseModel):
+    target: Literal["share", "site"] = "share"
+    filename: str
+    size: int = Field(..., ge=0)
+    chunk_size: Optional[int] = None
+    # target == "site"
+    site: Optional[str] = None
+    path: Optional[str] = None
+    # target == "share"
+    password: Optional[str] = None
+    max_downloads: Optional[int] = None
+    expires_at: Optional[datetime] = None
+
+
+class UploadSession(BaseModel):
+    id: str
+    target: str
+    filename: str
+    size: int
+    chunk_size: int
+    chunks: int
+    received: List[int] = []
+    missing: List[int] = []
+    created_at: datetime
+    updated_at: datetime
@@ -1,6 +1,7 @@
-from typing import Optional
+from datetime import datetime
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class Website(BaseModel):
@@ -10,6 +11,7 @@ class Website(BaseModel):
     ssl_enabled: bool = False
     upstream: Optional[str] = None
     analytics: Optional[dict] = None
+    release: Optional[str] = None
 
 
 class WebsiteCreate(BaseModel):
@@ -23,3 +25,38 @@ class WebsiteUpdate(BaseModel):
     domains: Optional[list[str]] = None
     ssl_enabled: Optional[bool] = None
     upstream: Optional[str] = None
+
+
+class AnalyticsEvent(BaseModel):
+    site: str
+    timestamp: Optional[datetime] = None
+    error: bool = False
+    bandwidth_mb: float = Field(0.0, ge=0, le=1_000_000, allow_inf_nan=False)
+    # Requests summarised by this one event.
+    count: int = Field(1, ge=1, le=1_000_000)
+
+
+class AnalyticsBatch(BaseModel):
+    events: List[AnalyticsEvent] = Field(..., max_length=10_000)
+
+
+class SyncEntry(BaseModel):
+    size: int = Field(..., ge=0)
+    sha256: str = Field(..., pattern=r"^[0-9a-f]{64}$")
+
+
+class SyncManifest(BaseModel):
+    files: Dict[str, SyncEntry]
+    # The manifest lists the whole site: server files missing from it are proposed for deletion.
+    complete: bool = False
+
+
+class FileEdit(BaseModel):
+    # Byte offset in the current file; omitted means the end (an append).
+    offset: Optional[int] = Field(None, ge=0)
+    delete: int = Field(0, ge=0)
+    text: str = ""
+
+
+class FilePatch(BaseModel):
+    edits: List[FileEdit] = Field(..., min_length=1, max_length=1000)
@@ -1,17 +1,21 @@
-import datetime as dt
-from typing import List, Optional
+from pathlib import Path
+from typing import Dict, List, Optional
 
-from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile, status
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, Response
+from pydantic import ValidationError
 
-from ..models.file import SharedFile, SharedFileCreate, SharedFileUpdate
+from ..models.file import FileTicket, FileTicketRequest, SharedFile, SharedFileCreate, SharedFileFromHash, SharedFileUpdate
 from ..core.config import get_system_settings
-from ..services import files
-from ..utils import deps
-from ..utils.security import hash_password
+from ..services import admission, blobs, bundles, files
+from ..utils import deps, http
+from ..utils.security import hash_password_async
 
 router = APIRouter()
 
+UPLOAD_FIELDS = ("password", "max_downloads", "expires_at")
+
 
 @router.get("/", response_model=List[SharedFile])
 def list_shared_files(current_user=Depends(deps.get_current_user)):
@@ -19,21 +23,47 @@ def list_shared_files(current_user=Depends(deps.get_current_user)):
 
 
 @router.post("/upload", response_model=SharedFile)
-async def upload_file(
-    upload: UploadFile = File(...),
-    password: Optional[str] = Form(None),
-    max_downloads: Optional[int] = Form(None),
-    expires_at: Optional[str] = Form(None),
-    current_user=Depends(deps.get_current_user),
-):
-    expires_dt = dt.datetime.fromisoformat(expires_at) if expires_at else None
-    payload = SharedFileCreate(password=password, max_downloads=max_downloads, expires_at=expires_dt)
+async def upload_file(request: Request, current_user=Depends(deps.get_current_user)):
+    # Multipart fields: `upload` (file), optional `password`, `max_downloads`, `expires_at`.
+    # Parsed here rather than via File()/Form() so the file is streamed into the store, not spooled first.
+    fields, upload = await files.receive_upload(request)
+    try:
+        payload = SharedFileCreate(**{key: fields[key] for key in UPLOAD_FIELDS if fields.get(key)})
+    except ValidationError as exc:
+        upload.discard()
+        raise RequestValidationError(exc.errors()) from exc
     settings = get_system_settings()
     base_url = settings.get("instance", {}).get("base_url", "")
     record = await files.create_shared_file(upload, payload, owner=current_user.get("username"), base_url=base_url)
     return record
 
 
+@router.post("/bundle", response_model=SharedFile)
+async def upload_bundle(request: Request, current_user=Depends(deps.get_current_user)):
+    # Multipart: one `upload` part per file (its filename may be a relative path such as "docs/a.pdf"),
+    # plus optional `name` (of the ZIP) and the same `password`, `max_downloads`, `expires_at` fields.
+    fields, sinks = await bundles.receive_bundle(request)
+    try:
+        payload = SharedFileCreate(**{key: fields[key] for key in UPLOAD_FIELDS if fields.get(key)})
+    except ValidationError as exc:
+        for sink in sinks:
+            sink.discard()
+        raise RequestValidationError(exc.errors()) from exc
+    base_url = get_system_settings().get("instance", {}).get("base_url", "")
+    return await bundles.create_bundle(fields.get("name") or "bundle", sinks, payload, current_user.get("username"), base_url)
+
+
+@router.post("/share-existing", response_model=SharedFile)
+async def share_existing(payload: SharedFileFromHash, current_user=Depends(deps.get_current_user)):
+    base_url = get_system_settings().get("instance", {}).get("base_url", "")
+    return await files.share_existing(payload, current_user, base_url)
+
+
+@router.get("/blobs/report")
+def blob_report(current_user=Depends(deps.require_role("owner", "admin"))):
+    return blobs.report()
+
+
 @router.get("/{file_id}", response_model=SharedFile)
 def get_file(file_id: str, current_user=Depends(deps.get_current_user)):
     record = files.get_file(file_id)
@@ -43,8 +73,8 @@ def get_file(file_id: str, current_user=Depends(deps.get_current_user)):
 
 
 @router.post("/{file_id}/download", response_model=SharedFile)
-def download(file_id: str, password: Optional[str] = None):
-    _ = files.validate_file_password(file_id, password)
+async def download(file_id: str, password: Optional[str] = None, ticket: Optional[str] = None):
+    _ = await files.validate_file_password(file_id, password, ticket)
     updated = files.increment_download(file_id)
     if not updated:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
@@ -52,18 +82,19 @@ def download(file_id: str, password: Optional[str] = None):
 
 
 @router.put("/{file_id}", response_model=SharedFile)
-def update_file(file_id: str, payload: SharedFileUpdate, current_user=Depends(deps.require_role("owner", "admin"))):
-    record = files.get_file(file_id)
-    if not record:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+async def update_file(file_id: str, payload: SharedFileUpdate, current_user=Depends(deps.require_role("owner", "admin"))):
+    # Only the changed fields are sent; they are applied to the current record under the store's lock,
+    # so counters another worker updated meanwhile are not overwritten with a stale copy.
     updates = payload.dict(exclude_none=True)
+    password = updates.pop("password", None)
+    if updates.get("max_bytes_per_second") == 0:
+        updates["max_bytes_per_second"] = None  # 0 lifts the cap
     if expires := updates.get("expires_at"):
         updates["expires_at"] = expires.isoformat()
-    record.update(updates)
-    if payload.password:
-        record["password_hash"] = hash_password(payload.password)
-        record["password_protected"] = True
-    updated = files.update_file_record(file_id, record)
+    if password:
+        updates["password_hash"] = await hash_password_async(password)
+        updates["password_protected"] = True
+    updated = files.update_file_record(file_id, updates)
     if not updated:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
     return updated
@@ -81,16 +112,83 @@ def delete_file(file_id: str, current_user=Depends(deps.require_role("owner", "a
 public_router = APIRouter()
 
 
-@public_router.get("/files/{file_id}")
-def public_download(file_id: str, password: Optional[str] = None):
-    path = files.resolve_download(file_id, password)
-    return FileResponse(path, filename=path.name)
-
-
-@public_router.get("/files/{file_id}/meta")
-def public_metadata(file_id: str, password: Optional[str] = None):
+def _content_response(
+    request: Request,
+    path: Path,
+    encoding: Optional[str],
+    filename: str,
+    sha256: Optional[str],
+    size: Optional[int],
+    offload: bool = True,
+) -> Response:
+    etag = f'"{sha256}"' if sha256 else None
+    if encoding and http.accepts_encoding(request, encoding):
+        # Different bytes on the wire than the decoded representation, so a distinct strong ETag.
+        return http.file_response(request, path, filename, f'"{sha256}-{encoding}"', content_encoding=encoding)
+    if encoding:
+        return http.file_response(request, path, filename, etag, decoded_size=size)
+    # Checks and counting stay with the caller; the bytes can go out through the reverse proxy.
+    return http.file_response(request, path, filename=filename, etag=etag, offload=offload)
+
+
+async def _deliver(request: Request, record: Dict, response: Response, client: str) -> Response:
+    """Count the download and, when the backend streams the body itself, take an admission slot for it."""
+    if request.method != "GET" or response.status_code == status.HTTP_304_NOT_MODIFIED:
+        return response
+    offloaded = "x-accel-redirect" in response.headers or "x-sendfile" in response.headers
+    slot = None if offloaded else await admission.controller.acquire()
+    try:
+        files.record_download(record["id"], client)
+    except BaseException:
+        if slot:
+            slot.release()
+        raise
+    return admission.controller.guard(response, slot, record) if slot else response
+
+
+admit = Depends(admission.controller.admit)
+
+
+@public_router.api_route("/files/{file_id}", methods=["GET", "HEAD"], dependencies=[admit])
+async def public_download(request: Request, file_id: str, password: Optional[str] = None, ticket: Optional[str] = None):
+    client = http.download_client(request, ticket)
+    record = await files.check_access(file_id, password, ticket, client)
+    if record.get("members") is not None:
+        return await _deliver(request, record, bundles.zip_response(request, record), client)
+    path, encoding = files.stored_content(record)
+    # A bandwidth cap is enforced here, so capped shares are never handed to the proxy.
+    response = _content_response(
+        request, path, encoding, record.get("filename"), record.get("sha256"), record.get("size"), not record.get("max_bytes_per_second")
+    )
+    return await _deliver(request, record, response, client)
+
+
+@public_router.api_route("/files/{file_id}/members/{member_path:path}", methods=["GET", "HEAD"], dependencies=[admit])
+async def public_member_download(
+    request: Request, file_id: str, member_path: str, password: Optional[str] = None, ticket: Optional[str] = None
+):
+    client = http.download_client(request, ticket)
+    record = await files.check_access(file_id, password, ticket, client)
+    member = bundles.find_member(record, member_path)
+    path, encoding = blobs.locate(member["sha256"])
+    if not path.exists():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File missing on disk")
+    filename = member["path"].rsplit("/", 1)[-1]
+    response = _content_response(
+        request, path, encoding, filename, member["sha256"], member["size"], not record.get("max_bytes_per_second")
+    )
+    return await _deliver(request, record, response, client)
+
+
+@public_router.post("/files/{file_id}/ticket", response_model=FileTicket, dependencies=[admit])
+async def public_ticket(file_id: str, payload: FileTicketRequest):
+    return await files.issue_download_ticket(file_id, payload.password)
+
+
+@public_router.get("/files/{file_id}/meta", dependencies=[admit])
+async def public_metadata(file_id: str, password: Optional[str] = None, ticket: Optional[str] = None):
     try:
-        meta = files.file_metadata(file_id, password)
+        meta = await files.file_metadata(file_id, password, ticket)
         return JSONResponse(meta)
     except HTTPException as exc:
         # surface auth errors cleanly for UI prompts
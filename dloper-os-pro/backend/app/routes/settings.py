@@ -17,6 +17,11 @@ def update_settings(payload: SettingsUpdate, current_user=Depends(deps.require_r
     return settings.update_settings(payload)
 
 
+@router.post("/password-hashing/calibrate")
+def calibrate_password_hashing(current_user=Depends(deps.require_role("owner"))):
+    return settings.recalibrate_hashing()
+
+
 @router.post("/reset")
-def reset_system(payload: ResetRequest, current_user=Depends(deps.require_role("owner"))):
-    return settings.reset_system(payload, current_user["username"])
+async def reset_system(payload: ResetRequest, current_user=Depends(deps.require_role("owner"))):
+    return await settings.reset_system(payload, current_user["username"])
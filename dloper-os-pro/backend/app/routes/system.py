@@ -9,3 +9,8 @@ router = APIRouter()
 @router.get("/metrics")
 def metrics(current_user=Depends(deps.get_current_user)):
     return system.system_metrics()
+
+
+@router.get("/stats")
+def stats(current_user=Depends(deps.require_role("owner", "admin"))):
+    return system.runtime_stats()
@@ -0,0 +1,45 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, status
+
+from ..core.config import get_system_settings
+from ..models.upload import UploadSession, UploadSessionCreate
+from ..services import uploads
+from ..utils import deps
+
+router = APIRouter()
+
+
+@router.post("/", response_model=UploadSession)
+async def create_upload(payload: UploadSessionCreate, current_user=Depends(deps.get_current_user)):
+    if payload.target == "site" and current_user.get("role") not in {"owner", "admin"}:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Insufficient permissions")
+    return await uploads.create_session(payload, owner=current_user["username"])
+
+
+@router.get("/{session_id}", response_model=UploadSession)
+def get_upload(session_id: str, current_user=Depends(deps.get_current_user)):
+    return uploads.get_session(session_id, owner=current_user["username"])
+
+
+@router.put("/{session_id}/chunks/{index}")
+async def put_chunk(
+    session_id: str,
+    index: int,
+    request: Request,
+    x_chunk_sha256: Optional[str] = Header(None),
+    current_user=Depends(deps.get_current_user),
+):
+    return await uploads.write_chunk(session_id, index, current_user["username"], request.stream(), sha256=x_chunk_sha256)
+
+
+@router.post("/{session_id}/complete")
+async def complete_upload(session_id: str, current_user=Depends(deps.get_current_user)):
+    base_url = get_system_settings().get("instance", {}).get("base_url", "")
+    return await uploads.complete_session(session_id, current_user["username"], base_url)
+
+
+@router.delete("/{session_id}")
+def abort_upload(session_id: str, current_user=Depends(deps.get_current_user)):
+    uploads.abort_session(session_id, current_user["username"])
+    return {"status": "deleted"}
@@ -15,17 +15,17 @@ def list_users(current_user=Depends(deps.require_role("owner", "admin"))):
 
 
 @router.post("/", response_model=User)
-def create_user(payload: UserCreate, current_user=Depends(deps.require_role("owner", "admin"))):
+async def create_user(payload: UserCreate, current_user=Depends(deps.require_role("owner", "admin"))):
     try:
-        created = users.create_user(payload.username, payload.email, payload.role, payload.password)
+        created = await users.create_user(payload.username, payload.email, payload.role, payload.password)
         return users._sanitize(created)  # type: ignore[attr-defined]
     except ValueError as exc:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc)) from exc
 
 
 @router.put("/{username}", response_model=User)
-def update_user(username: str, payload: UserUpdate, current_user=Depends(deps.require_role("owner", "admin"))):
-    updated = users.update_user(username, payload.dict(exclude_none=True))
+async def update_user(username: str, payload: UserUpdate, current_user=Depends(deps.require_role("owner", "admin"))):
+    updated = await users.update_user(username, payload.dict(exclude_none=True))
     if not updated:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     return users._sanitize(updated)  # type: ignore[attr-defined]
@@ -1,9 +1,9 @@
-from typing import List
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
 
-from ..models.website import Website, WebsiteCreate, WebsiteUpdate
-from ..services import websites
+from ..models.website import AnalyticsBatch, FilePatch, SyncManifest, Website, WebsiteCreate, WebsiteUpdate
+from ..services import access_log, analytics, assets, deploys, site_files, site_sync, websites
 from ..utils import deps
 
 router = APIRouter()
@@ -38,12 +38,37 @@ def delete_site(name: str, current_user=Depends(deps.require_role("owner"))):
     return {"status": "deleted"}
 
 
-@router.post("/{name}/analytics")
-def bump_analytics(name: str, error: bool = False, bandwidth_mb: float = 0.0):
+@router.post("/{name}/analytics", dependencies=[Depends(deps.require_ingest_token_if_set)])
+def bump_analytics(name: str, error: bool = False, bandwidth_mb: float = Query(0.0, ge=0, le=1_000_000, allow_inf_nan=False)):
     websites.record_analytics(name, bandwidth_mb=bandwidth_mb, error=error)
     return {"status": "ok"}
 
 
+@router.post("/analytics/events", dependencies=[Depends(deps.require_ingest_access)])
+def ingest_analytics(payload: AnalyticsBatch):
+    return analytics.ingest(event.dict() for event in payload.events)
+
+
+@router.get("/{name}/analytics/history")
+def analytics_history(
+    name: str,
+    granularity: str = "hour",
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    current_user=Depends(deps.get_current_user),
+):
+    if not websites.get_site(name):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+    return analytics.history(name, granularity=granularity, since=since, until=until)
+
+
+@router.get("/{name}/traffic")
+def traffic_summary(name: str, limit: int = 10, current_user=Depends(deps.get_current_user)):
+    if not websites.get_site(name):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+    return access_log.ingester.summary(name, limit=limit)
+
+
 @router.get("/{name}/files")
 def list_site_files(name: str, current_user=Depends(deps.get_current_user)):
     files = websites.list_site_files(name)
@@ -53,16 +78,131 @@ def list_site_files(name: str, current_user=Depends(deps.get_current_user)):
 
 
 @router.post("/{name}/files/upload")
-async def upload_site_file(name: str, path: str, upload: UploadFile, current_user=Depends(deps.require_role("owner", "admin"))):
+async def upload_site_file(name: str, path: str, request: Request, current_user=Depends(deps.require_role("owner", "admin"))):
+    # Multipart body with one `upload` file part, streamed straight to the site (see utils/forms.py).
     try:
-        return await websites.upload_site_file(name, path, upload)
+        return await websites.upload_site_file(name, path, request)
     except FileNotFoundError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site or path not found")
 
 
-@router.post("/{name}/files/save")
+@router.post("/{name}/files/save", deprecated=True)
 async def save_site_file(name: str, path: str, content: str, current_user=Depends(deps.require_role("owner", "admin"))):
     try:
         return websites.save_site_file(name, path, content)
     except FileNotFoundError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site or path not found")
+
+
+def _site(name: str) -> dict:
+    site = websites.get_site(name)
+    if not site:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+    return site
+
+
+@router.api_route("/{name}/files/content", methods=["GET", "HEAD"])
+def read_site_file(name: str, path: str, request: Request, current_user=Depends(deps.get_current_user)):
+    # Range, If-Range and If-None-Match are honoured; the ETag is what If-Match takes on writes.
+    return site_files.read(_site(name), path, request)
+
+
+@router.put("/{name}/files/content")
+async def write_site_file(
+    name: str, path: str, request: Request, response: Response, current_user=Depends(deps.require_role("owner", "admin"))
+):
+    # Raw body, streamed to a temp file and renamed into place; If-Match / If-None-Match: * guard against lost updates.
+    result = await site_files.write(_site(name), path, request)
+    response.headers["ETag"] = result["etag"]
+    return result
+
+
+@router.patch("/{name}/files/content")
+def patch_site_file(
+    name: str,
+    path: str,
+    payload: FilePatch,
+    request: Request,
+    response: Response,
+    current_user=Depends(deps.require_role("owner", "admin")),
+):
+    result = site_files.patch(_site(name), path, payload, request)
+    response.headers["ETag"] = result["etag"]
+    return result
+
+
+@router.get("/{name}/files/browse")
+def browse_site_files(
+    name: str,
+    path: str = "",
+    cursor: Optional[str] = None,
+    limit: int = 200,
+    sort: str = "name",
+    order: str = "asc",
+    current_user=Depends(deps.get_current_user),
+):
+    listing = websites.browse_site_files(name, path, cursor=cursor, limit=limit, sort=sort, order=order)
+    if listing is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+    return listing
+
+
+@router.post("/{name}/deploy")
+async def deploy_site(name: str, request: Request, strip: int = 0, current_user=Depends(deps.require_role("owner", "admin"))):
+    # Raw tar/tar.gz/zip body, unpacked into a new release and switched to atomically (see services/deploys.py).
+    site = websites.get_site(name)
+    if not site:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+    return await deploys.deploy(site, request, strip=strip)
+
+
+@router.get("/{name}/releases")
+def list_releases(name: str, current_user=Depends(deps.get_current_user)):
+    site = websites.get_site(name)
+    if not site:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+    return deploys.list_releases(site)
+
+
+@router.post("/{name}/releases/{release_id}/activate")
+def activate_release(name: str, release_id: str, current_user=Depends(deps.require_role("owner", "admin"))):
+    site = websites.get_site(name)
+    if not site:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+    return deploys.activate(site, release_id)
+
+
+@router.post("/{name}/sync/plan")
+def plan_sync(name: str, payload: SyncManifest, current_user=Depends(deps.require_role("owner", "admin"))):
+    site = websites.get_site(name)
+    if not site:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+    return site_sync.plan(site, payload)
+
+
+@router.post("/{name}/sync/{plan_id}")
+async def apply_sync(name: str, plan_id: str, request: Request, current_user=Depends(deps.require_role("owner", "admin"))):
+    # Multipart: one `upload` part per planned path (filename = path) plus an optional `delete` JSON list.
+    site = websites.get_site(name)
+    if not site:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+    return await site_sync.apply(site, plan_id, request)
+
+
+@router.get("/{name}/assets")
+def asset_manifest(name: str, current_user=Depends(deps.get_current_user)):
+    if not websites.get_site(name):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+    manifest = assets.manifest(name)
+    if manifest is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No asset manifest yet")
+    return manifest
+
+
+@router.post("/{name}/assets/rebuild")
+def rebuild_assets(name: str, current_user=Depends(deps.require_role("owner", "admin"))):
+    if not websites.get_site(name):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+    if not assets.enabled():
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="The asset pipeline is disabled (sites.assets.enabled)")
+    return assets.pipeline.process(name)
@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import datetime as dt
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from ..core import db, storage
+from ..core.config import system_snapshot
+from ..core.locks import try_leader_lock
+from ..utils.background import PeriodicTask, register
+from ..utils.sketches import HyperLogLog, TopK
+from . import analytics
+
+# nginx: log_format dloper '$host $remote_addr - $remote_user [$time_local] "$request" '
+#                          '$status $body_bytes_sent "$http_referer" "$http_user_agent"';
+LINE_RE = re.compile(
+    r'^(?P<host>\S+) (?P<ip>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] "(?P<request>[^"]*)" '
+    r'(?P<status>\d{3}) (?P<bytes>\d+|-) "(?P<referer>[^"]*)" "(?P<agent>[^"]*)"'
+)
+POLL_SECONDS = 2.0
+BATCH_BYTES = 1 << 20
+DAILY_VISITOR_DAYS = 7
+CHECKPOINT_KEY = "access_log_checkpoint"
+
+
+class SiteSketches:
+    """Bounded-size traffic summaries for one site (~100 KiB regardless of traffic)."""
+
+    def __init__(self) -> None:
+        self.visitors = HyperLogLog()
+        self.daily: Dict[str, HyperLogLog] = {}
+        self.paths = TopK()
+        self.referrers = TopK()
+
+    def add(self, day: str, visitor: str, path: str, referrer: Optional[str]) -> None:
+        self.visitors.add(visitor)
+        if day not in self.daily:
+            self.daily[day] = HyperLogLog()
+            for stale in sorted(self.daily)[:-DAILY_VISITOR_DAYS]:
+                del self.daily[stale]
+        self.daily[day].add(visitor)
+        self.paths.add(path)
+        if referrer:
+            self.referrers.add(referrer)
+
+    def dump(self) -> List[Tuple[str, bytes]]:
+        rows = [("visitors", self.visitors.to_bytes()), ("paths", self.paths.to_bytes()), ("referrers", self.referrers.to_bytes())]
+        rows.extend((f"daily:{day}", hll.to_bytes()) for day, hll in self.daily.items())
+        return rows
+
+    @classmethod
+    def load(cls, site: str) -> "SiteSketches":
+        sketches = cls()
+        rows = db.connect().execute("SELECT name, data FROM site_sketches WHERE site = ?", (site,))
+        for row in rows:
+            name, data = row["name"], row["data"]
+            if name == "visitors":
+                sketches.visitors = HyperLogLog.from_bytes(data)
+            elif name == "paths":
+                sketches.paths = TopK.from_bytes(data)
+            elif name == "referrers":
+                sketches.referrers = TopK.from_bytes(data)
+            elif name.startswith("daily:"):
+                sketches.daily[name.split(":", 1)[1]] = HyperLogLog.from_bytes(data)
+        return sketches
+
+    def summary(self, limit: int = 10) -> Dict:
+        return {
+            "unique_visitors": self.visitors.count(),
+            "daily_unique_visitors": [{"day": day, "visitors": hll.count()} for day, hll in sorted(self.daily.items())],
+            "top_paths": self.paths.top(limit),
+            "top_referrers": self.referrers.top(limit),
+        }
+
+
+class AccessLogIngester:
+    """Tails the reverse-proxy access log from a checkpointed offset; runs in one worker only."""
+
+    def __init__(self) -> None:
+        self._sketches: Dict[str, SiteSketches] = {}
+        self._domains: Dict[str, str] = {}
+        self._domains_generation = -1
+        self._times: Dict[str, float] = {}
+        self._leader: Optional[int] = None
+        self._lock = threading.Lock()
+        self.lines = 0
+        self.unmatched = 0
+        self.unattributed = 0
+        self.oversized = 0
+        self.batches = 0
+
+    def log_path(self) -> Optional[Path]:
+        configured = system_snapshot().get("analytics", {}).get("access_log")
+        return Path(configured) if configured else None
+
+    def _site_for(self, host: str) -> Optional[str]:
+        generation = storage.sites.generation()
+        if generation != self._domains_generation:
+            self._domains = {domain: site["name"] for site in storage.sites.all() for domain in site.get("domains") or []}
+            self._domains_generation = generation
+        return self._domains.get(host.split(":", 1)[0].lower())
+
+    def _timestamp(self, raw: str) -> float:
+        cached = self._times.get(raw)
+        if cached is None:
+            if len(self._times) > 4096:
+                self._times.clear()
+            cached = self._times[raw] = dt.datetime.strptime(raw, "%d/%b/%Y:%H:%M:%S %z").timestamp()
+        return cached
+
+    def _site_sketches(self, site: str) -> SiteSketches:
+        if site not in self._sketches:
+            self._sketches[site] = SiteSketches.load(site)
+        return self._sketches[site]
+
+    def process(self, lines: Iterable[str]) -> set:
+        touched = set()
+        for line in lines:
+            self.lines += 1
+            match = LINE_RE.match(line)
+            if not match:
+                self.unmatched += 1
+                continue
+            host = match["host"]
+            site = self._site_for(host)
+            if not site:
+                self.unattributed += 1
+                continue
+            timestamp = self._timestamp(match["time"])
+            status = int(match["status"])
+            size = 0 if match["bytes"] == "-" else int(match["bytes"])
+            analytics.aggregator.add(site, timestamp, errors=int(status >= 500), bandwidth_mb=size / (1024 * 1024))
+
+            parts = match["request"].split(" ")
+            path = parts[1].split("?", 1)[0] if len(parts) > 1 else "-"
+            referrer_host = urlsplit(match["referer"]).netloc.lower() if match["referer"] not in ("", "-") else ""
+            referrer = referrer_host if referrer_host and referrer_host != host.lower() else None
+            day = dt.datetime.utcfromtimestamp(timestamp).date().isoformat()
+            self._site_sketches(site).add(day, f"{match['ip']}|{match['agent']}", path, referrer)
+            touched.add(site)
+        return touched
+
+    def _checkpoint(self) -> Dict:
+        raw = db.get_meta(CHECKPOINT_KEY)
+        return json.loads(raw) if raw else {}
+
+    def _commit(self, touched: set, checkpoint: Dict) -> None:
+        with db.transaction(immediate=True) as conn:
+            for site in touched:
+                days = [f"daily:{day}" for day in self._sketches[site].daily]
+                conn.executemany(
+                    "INSERT INTO site_sketches(site, name, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT(site, name) DO UPDATE SET data = excluded.data",
+                    [(site, name, data) for name, data in self._sketches[site].dump()],
+                )
+                conn.execute(
+                    f"DELETE FROM site_sketches WHERE site = ? AND name LIKE 'daily:%' AND name NOT IN ({','.join('?' * len(days))})",
+                    (site, *days),
+                )
+            conn.execute(
+                "INSERT INTO meta(key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (CHECKPOINT_KEY, json.dumps(checkpoint)),
+            )
+        self.batches += 1
+
+    def tick(self) -> Optional[float]:
+        path = self.log_path()
+        if not path or not analytics.enabled():
+            return None
+        if self._leader is None:
+            self._leader = try_leader_lock("access-log")
+            if self._leader is None:
+                return 30.0
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        checkpoint = self._checkpoint()
+        offset = checkpoint.get("offset", 0)
+        # Whether `offset` is inside an oversized line whose rest is to be dropped; checkpointed with the
+        # offset, since the line may still be being written when a tick ends.
+        skipping = bool(checkpoint.get("skipping"))
+        if checkpoint.get("path") != str(path) or checkpoint.get("inode") != stat.st_ino or stat.st_size < offset:
+            offset, skipping = 0, False  # new file or rotated/truncated log
+        with path.open("rb") as handle:
+            while offset < stat.st_size:
+                handle.seek(offset)
+                chunk = handle.read(BATCH_BYTES)
+                end = chunk.rfind(b"\n")
+                if end < 0 and len(chunk) < BATCH_BYTES:
+                    break  # partial line still being written
+                if end < 0:
+                    # A line longer than a whole batch: drop it (its tail goes with the next read) rather than stall on it.
+                    self.oversized += 0 if skipping else 1
+                    offset += len(chunk)
+                    skipping = True
+                    with self._lock:
+                        self._commit(set(), {"path": str(path), "inode": stat.st_ino, "offset": offset, "skipping": True})
+                    continue
+                start = chunk.find(b"\n") + 1 if skipping else 0
+                skipping = False
+                lines = chunk[start : end + 1].decode("utf-8", "replace").splitlines()
+                offset += end + 1
+                # The lock is taken per batch, so /traffic is answered between batches of a long backlog.
+                with self._lock:
+                    touched = self.process(lines)
+                    self._commit(touched, {"path": str(path), "inode": stat.st_ino, "offset": offset, "skipping": False})
+        return None
+
+    def summary(self, site: str, limit: int = 10) -> Dict:
+        with self._lock:
+            sketches = self._sketches.get(site) or SiteSketches.load(site)
+            return sketches.summary(limit)
+
+    def forget(self, site: str) -> None:
+        with self._lock:
+            self._sketches.pop(site, None)
+        with db.transaction(immediate=True) as conn:
+            conn.execute("DELETE FROM site_sketches WHERE site = ?", (site,))
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.log_path() is not None,
+            "leader": self._leader is not None,
+            "pid": os.getpid(),
+            "lines": self.lines,
+            "unmatched": self.unmatched,
+            "unattributed": self.unattributed,
+            "oversized": self.oversized,
+            "batches": self.batches,
+            "sites_loaded": len(self._sketches),
+        }
+
+
+ingester = AccessLogIngester()
+tailer = register(PeriodicTask("access-log", POLL_SECONDS, ingester.tick))
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Mapping, Optional
+
+from fastapi import HTTPException, Request, status
+from fastapi.responses import Response
+from starlette.types import Message, Receive, Scope, Send
+
+from ..core import locks
+from ..core.config import system_snapshot
+from ..utils import http
+
+# Other workers free download slots without waking this one's waiters, so waiters also poll this often.
+SLOT_POLL_SECONDS = 0.1
+# Shaped bodies go out in pieces this big so a slow cap still streams smoothly.
+SHAPE_CHUNK = 64 * 1024
+ZERO_COPY = ("http.response.zerocopysend", "http.response.pathsend")
+
+
+def limits() -> Mapping[str, Any]:
+    return system_snapshot().get("files", {}).get("limits", {})
+
+
+class SharedBucket:
+    """One host-wide token bucket (see core/locks.py); every worker process draws from the same tokens."""
+
+    __slots__ = ("key", "rate", "capacity")
+
+    def __init__(self, key: str, rate: float, capacity: float) -> None:
+        self.key, self.rate, self.capacity = key, rate, capacity
+
+    def take(self, amount: float, now: float) -> float:
+        """Take `amount` if available; otherwise take nothing and return the seconds until it would be."""
+        return locks.buckets.spend(self.key, self.rate, self.capacity, amount, now)
+
+    def debit(self, amount: float, now: float) -> float:
+        """Always take `amount` (the balance may go negative); returns how long to wait to pay it back."""
+        return locks.buckets.spend(self.key, self.rate, self.capacity, amount, now, force=True)
+
+
+def _too_many(detail: str, wait: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=detail, headers={"Retry-After": str(max(math.ceil(wait), 1))}
+    )
+
+
+class DownloadSlot:
+    def __init__(self, controller: "AdmissionController") -> None:
+        self._controller: Optional[AdmissionController] = controller
+
+    def release(self) -> None:
+        if self._controller is not None:
+            self._controller._release()
+            self._controller = None
+
+
+class GuardedResponse(Response):
+    """Wraps a body-carrying response: holds a download slot until the body is done (or the
+    client is gone) and, for capped shares, paces the body through the share's byte bucket."""
+
+    def __init__(self, inner: Response, slot: DownloadSlot, bucket: Optional[SharedBucket], controller: "AdmissionController") -> None:
+        # No super().__init__: the wrapped response already rendered its headers and body.
+        self.inner, self.slot, self.bucket, self.controller = inner, slot, bucket, controller
+        self.status_code, self.raw_headers, self.background = inner.status_code, inner.raw_headers, None
+
+    async def _shaped_send(self, send: Send, message: Message) -> None:
+        body = message.get("body", b"")
+        if message["type"] != "http.response.body" or not body:
+            await send(message)
+            return
+        more = message.get("more_body", False)
+        for position in range(0, len(body), SHAPE_CHUNK):
+            piece = body[position : position + SHAPE_CHUNK]
+            wait = self.bucket.debit(len(piece), time.monotonic())
+            if wait:
+                self.controller.throttle_seconds += wait
+                await asyncio.sleep(wait)
+            await send({"type": "http.response.body", "body": piece, "more_body": more or position + SHAPE_CHUNK < len(body)})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            if self.bucket is None:
+                await self.inner(scope, receive, send)
+                return
+            self.controller.throttled += 1
+            # Zero-copy sends would bypass the pacing, so hide them from the inner response.
+            extensions = {key: value for key, value in (scope.get("extensions") or {}).items() if key not in ZERO_COPY}
+            await self.inner({**scope, "extensions": extensions}, receive, lambda message: self._shaped_send(send, message))
+        finally:
+            self.slot.release()
+        if self.background is not None:
+            await self.background()
+
+
+class AdmissionController:
+    """Admission for the public share endpoints, enforced across all worker processes.
+
+    Request rate is limited per client IP and per share (token buckets, 429 + Retry-After).
+    Bodies in flight are capped; extra downloads wait up to `queue_seconds` for a slot, then
+    are shed with 503 + Retry-After. Shares with `max_bytes_per_second` are paced. Buckets and
+    the in-flight count live in shared memory (core/locks.py), so the limits hold for the host,
+    not per worker. The counters reported by `stats` are this worker's.
+    """
+
+    def __init__(self) -> None:
+        self.in_flight = locks.SharedGauge(locks.LOCKS_DIR / "downloads")
+        self.active = 0
+        self._waiters: Deque[asyncio.Event] = deque()
+        self.rejected_client = 0
+        self.rejected_share = 0
+        self.queued = 0
+        self.shed = 0
+        self.throttled = 0
+        self.throttle_seconds = 0.0
+
+    async def admit(self, request: Request, file_id: str) -> None:
+        """FastAPI dependency for public share routes."""
+        settings = limits()
+        now = time.monotonic()
+        client, share = settings.get("client", {}), settings.get("share", {})
+        if client.get("rate"):
+            bucket = SharedBucket(f"client:{http.client_ip(request)}", client["rate"], client.get("burst", client["rate"]))
+            wait = bucket.take(1, now)
+            if wait:
+                self.rejected_client += 1
+                raise _too_many("Too many requests from this client", wait)
+        if share.get("rate"):
+            wait = SharedBucket(f"share:{file_id}", share["rate"], share.get("burst", share["rate"])).take(1, now)
+            if wait:
+                self.rejected_share += 1
+                raise _too_many("This link is receiving too many requests", wait)
+
+    async def acquire(self) -> DownloadSlot:
+        settings = limits()
+        limit = int(settings.get("max_downloads_in_flight", 0))
+        if not await asyncio.to_thread(self.in_flight.try_add, limit):
+            loop = asyncio.get_running_loop()
+            queue_seconds = float(settings.get("queue_seconds", 10))
+            deadline = loop.time() + queue_seconds
+            self.queued += 1
+            while not await asyncio.to_thread(self.in_flight.try_add, limit):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    self.shed += 1
+                    raise HTTPException(
+                        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        detail="Server busy, try again shortly",
+                        headers={"Retry-After": str(max(math.ceil(queue_seconds), 1))},
+                    )
+                event = asyncio.Event()
+                self._waiters.append(event)
+                try:
+                    await asyncio.wait_for(event.wait(), min(remaining, SLOT_POLL_SECONDS))
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    if event in self._waiters:
+                        self._waiters.remove(event)
+        self.active += 1
+        return DownloadSlot(self)
+
+    def _release(self) -> None:
+        self.active -= 1
+        self.in_flight.add(-1)
+        if self._waiters:
+            self._waiters.popleft().set()
+
+    def guard(self, response: Response, slot: DownloadSlot, record: Dict) -> Response:
+        cap = record.get("max_bytes_per_second")
+        bucket = None
+        if cap:
+            bucket = SharedBucket(f"bytes:{record['id']}", cap, max(cap, SHAPE_CHUNK))
+        return GuardedResponse(response, slot, bucket, self)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active_downloads": self.active,
+            "active_downloads_all_workers": self.in_flight.total(),
+            "waiting": len(self._waiters),
+            "rejected_client": self.rejected_client,
+            "rejected_share": self.rejected_share,
+            "queued": self.queued,
+            "shed": self.shed,
+            "throttled_downloads": self.throttled,
+            "throttle_wait_seconds": round(self.throttle_seconds, 3),
+        }
+
+
+controller = AdmissionController()
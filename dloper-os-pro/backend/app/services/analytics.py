@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import datetime as dt
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+from ..core import db, storage
+from ..core.config import system_snapshot
+from ..utils.background import PeriodicTask, register
+
+FLUSH_INTERVAL_SECONDS = 10.0
+GRANULARITIES = {"minute": 60, "hour": 3600, "day": 86400}
+# Buckets older than this are pruned (None keeps them forever).
+RETENTION_SECONDS = {"minute": 2 * 86400, "hour": 90 * 86400, "day": None}
+# Ingested events must fall in this window around now; anything else is rejected.
+MAX_EVENT_AGE_SECONDS = RETENTION_SECONDS["minute"]
+MAX_EVENT_SKEW_SECONDS = 300
+
+Counters = List[float]  # [requests, errors, bandwidth_mb]
+
+
+class Aggregator:
+    """Per-worker in-memory counters, flushed additively so several workers can share the tables."""
+
+    def __init__(self) -> None:
+        self._pending: Dict[Tuple[str, int], Counters] = defaultdict(lambda: [0, 0, 0.0])
+        self._lock = threading.Lock()
+        self.events = 0
+        self.flushes = 0
+        self.last_flush_rows = 0
+
+    def add(self, site: str, timestamp: float, requests: int = 1, errors: int = 0, bandwidth_mb: float = 0.0) -> None:
+        minute = int(timestamp) // 60 * 60
+        with self._lock:
+            counters = self._pending[(site, minute)]
+            counters[0] += requests
+            counters[1] += errors
+            counters[2] += bandwidth_mb
+            self.events += requests
+
+    def drain(self) -> Dict[Tuple[str, int], Counters]:
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(lambda: [0, 0, 0.0])
+        return pending
+
+    def restore(self, pending: Dict[Tuple[str, int], Counters]) -> None:
+        """Put drained counters back after a failed flush, so the next one retries them."""
+        with self._lock:
+            for key, counters in pending.items():
+                current = self._pending[key]
+                for idx in range(3):
+                    current[idx] += counters[idx]
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+
+aggregator = Aggregator()
+
+
+def enabled() -> bool:
+    return bool(system_snapshot().get("analytics", {}).get("enabled", True))
+
+
+def record(site: str, bandwidth_mb: float = 0.0, error: bool = False, timestamp: Optional[float] = None) -> None:
+    if not enabled() or storage.sites.get(site) is None:
+        return
+    aggregator.add(site, timestamp or time.time(), errors=int(error), bandwidth_mb=bandwidth_mb)
+
+
+def ingest(events: Iterable[Dict]) -> Dict[str, int]:
+    """Queue a batch of `{site, timestamp?, error?, bandwidth_mb?, count?}` events for the next flush."""
+    if not enabled():
+        return {"accepted": 0, "rejected": 0}
+    known: Dict[str, bool] = {}
+    accepted = rejected = 0
+    now = time.time()
+    for event in events:
+        site = event["site"]
+        if site not in known:
+            known[site] = storage.sites.get(site) is not None
+        if not known[site]:
+            rejected += 1
+            continue
+        count = max(int(event.get("count") or 1), 1)
+        timestamp = event.get("timestamp") or now
+        if isinstance(timestamp, dt.datetime):
+            timestamp = timestamp.timestamp()
+        if not now - MAX_EVENT_AGE_SECONDS <= timestamp <= now + MAX_EVENT_SKEW_SECONDS:
+            rejected += 1
+            continue
+        aggregator.add(
+            site,
+            timestamp,
+            requests=count,
+            errors=count if event.get("error") else 0,
+            bandwidth_mb=float(event.get("bandwidth_mb") or 0.0),
+        )
+        accepted += 1
+    return {"accepted": accepted, "rejected": rejected}
+
+
+def _write_buckets(conn, rows: Dict[Tuple[str, str, int], Counters]) -> None:
+    conn.executemany(
+        """
+        INSERT INTO analytics_buckets(site, granularity, bucket_start, requests, errors, bandwidth_mb)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(site, granularity, bucket_start) DO UPDATE SET
+            requests = requests + excluded.requests,
+            errors = errors + excluded.errors,
+            bandwidth_mb = bandwidth_mb + excluded.bandwidth_mb
+        """,
+        [(site, granularity, start, *counters) for (site, granularity, start), counters in rows.items()],
+    )
+
+
+def _add_totals(counters: Counters):
+    requests, errors, bandwidth_mb = counters
+
+    def apply(record: Dict) -> None:
+        analytics = record.setdefault("analytics", {"requests": 0, "errors": 0, "bandwidth_mb": 0.0})
+        analytics["requests"] = analytics.get("requests", 0) + int(requests)
+        analytics["errors"] = analytics.get("errors", 0) + int(errors)
+        analytics["bandwidth_mb"] = round(analytics.get("bandwidth_mb", 0.0) + bandwidth_mb, 6)
+
+    return apply
+
+
+def flush() -> None:
+    pending = aggregator.drain()
+    if not pending:
+        return
+    rows: Dict[Tuple[str, str, int], Counters] = defaultdict(lambda: [0, 0, 0.0])
+    totals: Dict[str, Counters] = defaultdict(lambda: [0, 0, 0.0])
+    for (site, minute), counters in pending.items():
+        for granularity, width in GRANULARITIES.items():
+            bucket = rows[(site, granularity, minute // width * width)]
+            for idx in range(3):
+                bucket[idx] += counters[idx]
+        for idx in range(3):
+            totals[site][idx] += counters[idx]
+
+    # Buckets and lifetime totals commit together, so a failed flush can be retried without counting twice.
+    in_db = storage.sites.backend == "sqlite"
+    try:
+        with db.transaction(immediate=True) as conn:
+            _write_buckets(conn, rows)
+            if in_db:
+                for site, counters in totals.items():
+                    storage.sites.impl.update_in(conn, site, _add_totals(counters))
+    except Exception:
+        aggregator.restore(pending)
+        raise
+    if in_db:
+        storage.sites.bump()
+    else:
+        # The YAML backend cannot join the transaction; if this fails the totals miss one flush
+        # rather than the buckets being written twice.
+        for site, counters in totals.items():
+            storage.sites.update(site, _add_totals(counters))
+
+    aggregator.flushes += 1
+    aggregator.last_flush_rows = len(rows)
+
+
+def prune(now: Optional[float] = None) -> int:
+    now = now or time.time()
+    removed = 0
+    with db.transaction(immediate=True) as conn:
+        for granularity, retention in RETENTION_SECONDS.items():
+            if retention is None:
+                continue
+            cursor = conn.execute(
+                "DELETE FROM analytics_buckets WHERE granularity = ? AND bucket_start < ?",
+                (granularity, int(now - retention)),
+            )
+            removed += cursor.rowcount
+    return removed
+
+
+def history(site: str, granularity: str = "hour", since: Optional[int] = None, until: Optional[int] = None) -> List[Dict]:
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unknown granularity")
+    until = until or int(time.time())
+    since = since if since is not None else until - 60 * GRANULARITIES[granularity]
+    rows = db.connect().execute(
+        """
+        SELECT bucket_start, requests, errors, bandwidth_mb FROM analytics_buckets
+        WHERE site = ? AND granularity = ? AND bucket_start >= ? AND bucket_start <= ?
+        ORDER BY bucket_start
+        """,
+        (site, granularity, since, until),
+    )
+    return [dict(row) for row in rows]
+
+
+def forget(site: str) -> None:
+    with db.transaction(immediate=True) as conn:
+        conn.execute("DELETE FROM analytics_buckets WHERE site = ?", (site,))
+
+
+def stats() -> Dict:
+    return {
+        "events": aggregator.events,
+        "pending_buckets": aggregator.pending(),
+        "flushes": aggregator.flushes,
+        "last_flush_rows": aggregator.last_flush_rows,
+    }
+
+
+def _tick() -> None:
+    flush()
+    if aggregator.flushes % 360 == 1:
+        prune()
+
+
+flusher = register(PeriodicTask("analytics-flush", FLUSH_INTERVAL_SECONDS, _tick, run_on_stop=True))
@@ -0,0 +1,319 @@
+from __future__ import annotations
+
+import json
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple
+
+try:
+    import brotli  # optional: .br variants are only produced when it is installed
+except ImportError:
+    brotli = None
+
+from ..core import db, locks, storage
+from ..core.config import system_snapshot
+from ..core.paths import SITES_DIR
+from ..core.persistence import PUBLIC_FILE_MODE, atomic_write, fsync_dir, make_public
+from ..utils.background import PeriodicTask, register
+from . import blobs, deploys, site_index, site_sync
+
+# Compressed variants, content-addressed per site (outside every site root) and hardlinked next to the files.
+ASSETS_DIR = SITES_DIR / ".assets"
+SUFFIXES = {"gzip": ".gz", "br": ".br"}
+# Variants that save less than this are not kept; the proxy then serves the original.
+MAX_RATIO = 0.9
+# Uploads arrive in bursts; a site is processed once it has been quiet this long.
+DEBOUNCE_SECONDS = 1.0
+# Files are compressed in chunks of this size, so memory use does not grow with the file.
+READ_CHUNK = 1024 * 1024
+# Hashed names as bundlers emit them: main.3f2a9c1b.js, index-BfY3k2Qa.css.
+FINGERPRINT = re.compile(r"[.-](?=[0-9A-Za-z_]*\d)[0-9A-Za-z_]{8,}\.[0-9A-Za-z]+$")
+
+
+def _settings() -> Mapping[str, Any]:
+    return system_snapshot().get("sites", {}).get("assets", {})
+
+
+def enabled() -> bool:
+    return bool(_settings().get("enabled", False))
+
+
+def encodings() -> List[str]:
+    return ["gzip", "br"] if brotli is not None else ["gzip"]
+
+
+def compressible(path: str, size: int) -> bool:
+    settings = _settings()
+    if not int(settings.get("min_bytes", 1024)) <= size <= int(settings.get("max_bytes", 16777216)):
+        return False
+    if path.endswith(tuple(SUFFIXES.values())):
+        return False
+    media_type = mimetypes.guess_type(path)[0] or ""
+    return media_type.startswith(blobs.COMPRESSIBLE_TYPES)
+
+
+def _cache_path(name: str, digest: str, encoding: str) -> Path:
+    return ASSETS_DIR / name / digest[:2] / (digest[2:] + SUFFIXES[encoding])
+
+
+def _compress(source: Path, dest: Path, encoding: str, limit: float) -> Optional[int]:
+    """Stream `source` compressed into `dest` and return its size; None, writing nothing, if it exceeds `limit`."""
+    settings = _settings()
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=int(settings.get("brotli_quality", 5)))
+        process, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(int(settings.get("gzip_level", 9)), zlib.DEFLATED, 31)  # wbits 31: gzip container
+        process, finish = compressor.compress, compressor.flush
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp = tempfile.mkstemp(prefix=f".{dest.name}.", suffix=".tmp", dir=str(dest.parent))
+    written = 0
+    try:
+        with os.fdopen(fd, "wb") as out, source.open("rb") as handle:
+            for chunk in iter(lambda: handle.read(READ_CHUNK), b""):
+                written += out.write(process(chunk))
+                if written > limit:
+                    break
+            else:
+                written += out.write(finish())
+            if written > limit:
+                os.unlink(temp)
+                return None
+            out.flush()
+            os.fchmod(out.fileno(), PUBLIC_FILE_MODE)  # hardlinked into the site, where nginx *_static opens it
+            os.fsync(out.fileno())
+        os.replace(temp, dest)
+    except BaseException:
+        try:
+            os.unlink(temp)
+        except FileNotFoundError:
+            pass
+        raise
+    fsync_dir(dest.parent)
+    return written
+
+
+def _link(target: Path, link: Path) -> None:
+    temp = link.with_name(f".{link.name}.{uuid.uuid4().hex[:8]}.upload")
+    try:
+        os.link(target, temp)
+    except OSError:
+        shutil.copyfile(target, temp)
+    os.replace(temp, link)
+
+
+def _made(row: Mapping[str, Any]) -> List[str]:
+    """Encodings a row has a variant file for (`encodings` maps each one tried to its size, or null)."""
+    return [encoding for encoding, size in json.loads(row["encodings"]).items() if size is not None]
+
+
+def _entry(path: str, size: int, digest: str, variants: Dict[str, int]) -> Dict:
+    tag = digest[:32]
+    return {
+        "sha256": digest,
+        "size": size,
+        "etag": f'"{tag}"',
+        "immutable": bool(FINGERPRINT.search(path.rsplit("/", 1)[-1])),
+        "encodings": {encoding: {"size": length, "etag": f'"{tag}-{encoding}"'} for encoding, length in variants.items()},
+    }
+
+
+class AssetPipeline:
+    """Precompresses a site's text assets and keeps its asset manifest current.
+
+    Writes schedule the site; a background thread processes it once uploads go quiet.
+    Only files whose content hash changed (or whose variants went missing, e.g. in a fresh
+    release) are looked at again, and a variant already made for the same bytes is linked
+    from the cache instead of being compressed twice.
+    """
+
+    def __init__(self) -> None:
+        self._dirty: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.compressed = 0
+        self.reused = 0
+        self.bytes_saved = 0
+        self.last_run_seconds: Optional[float] = None
+
+    def schedule(self, name: str) -> None:
+        if not enabled():
+            return
+        with self._lock:
+            self._dirty[name] = time.monotonic()
+        task.wake()
+
+    def file_changed(self, site: Dict, path: Path) -> None:
+        """Drop the variants of a file that was just replaced, so a stale .gz is never served."""
+        root = Path(site["root_path"]).resolve()
+        try:
+            rel = path.resolve().relative_to(root).as_posix()
+        except ValueError:
+            return
+        row = db.connect().execute("SELECT encodings FROM site_assets WHERE site = ? AND path = ?", (site["name"], rel)).fetchone()
+        if row is not None:
+            for encoding in _made(row):
+                path.with_name(path.name + SUFFIXES[encoding]).unlink(missing_ok=True)
+        self.schedule(site["name"])
+
+    def tick(self) -> Optional[float]:
+        now = time.monotonic()
+        with self._lock:
+            due = [name for name, at in self._dirty.items() if now - at >= DEBOUNCE_SECONDS]
+            for name in due:
+                del self._dirty[name]
+            pending = [DEBOUNCE_SECONDS - (now - at) for at in self._dirty.values()]
+        for name in due:
+            self.process(name)
+        return min(pending) if pending else None
+
+    def process(self, name: str) -> Dict:
+        site = storage.sites.get(name)
+        if not site:
+            forget(name)
+            return {}
+        started = time.monotonic()
+        with locks.file_lock(f"assets-{name}"):
+            manifest = self._process(site)
+        self.runs += 1
+        self.last_run_seconds = round(time.monotonic() - started, 3)
+        return manifest
+
+    def _process(self, site: Dict) -> Dict:
+        name = site["name"]
+        root = Path(site["root_path"]).resolve()
+        conn = db.connect()
+        previous = {row["path"]: row for row in conn.execute("SELECT path, sha256, encodings FROM site_assets WHERE site = ?", (name,))}
+        generated = {path + SUFFIXES[encoding] for path, row in previous.items() for encoding in _made(row)}
+        site_index.refresh(site, force=True)
+        paths = [item["path"] for item in site_index.all_files(site) if item["path"] not in generated]
+        hashes = site_sync.hashes(site, paths)
+
+        wanted = encodings()
+        stale = []
+        for path, (size, digest) in hashes.items():
+            row = previous.get(path)
+            if row is not None and row["sha256"] == digest:
+                tried = json.loads(row["encodings"])
+                complete = not compressible(path, size) or all(encoding in tried for encoding in wanted)
+                if complete and all((root / (path + SUFFIXES[encoding])).exists() for encoding in _made(row)):
+                    continue
+            stale.append((path, size, digest))
+
+        def build(job: Tuple[str, int, str]) -> Tuple[str, int, str, Dict[str, Optional[int]], Tuple[int, int, int]]:
+            """Runs on a pool thread, so its counts (compressed, reused, bytes saved) are returned, not added up here."""
+            path, size, digest = job
+            variants: Dict[str, Optional[int]] = {}
+            compressed = reused = saved = 0
+            if compressible(path, size):
+                for encoding in wanted:
+                    cached = _cache_path(name, digest, encoding)
+                    if cached.exists():
+                        reused += 1
+                    else:
+                        length = _compress(root / path, cached, encoding, size * MAX_RATIO)
+                        if length is None:
+                            variants[encoding] = None  # tried; not worth keeping
+                            continue
+                        compressed += 1
+                        saved += size - length
+                    _link(cached, root / (path + SUFFIXES[encoding]))
+                    variants[encoding] = cached.stat().st_size
+            return path, size, digest, variants, (compressed, reused, saved)
+
+        with ThreadPoolExecutor(max_workers=max(int(_settings().get("workers", 2)), 1)) as pool:
+            results = list(pool.map(build, stale))
+        for *_, (compressed, reused, saved) in results:
+            self.compressed += compressed
+            self.reused += reused
+            self.bytes_saved += saved
+        gone = [path for path in previous if path not in hashes]
+        for path in gone:
+            for encoding in _made(previous[path]):
+                (root / (path + SUFFIXES[encoding])).unlink(missing_ok=True)
+        with db.transaction(immediate=True) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO site_assets(site, path, sha256, size, encodings) VALUES (?, ?, ?, ?, ?)",
+                [(name, path, digest, size, json.dumps(variants)) for path, size, digest, variants, _ in results],
+            )
+            conn.executemany("DELETE FROM site_assets WHERE site = ? AND path = ?", [(name, path) for path in gone])
+        return self._write_manifest(site)
+
+    def _write_manifest(self, site: Dict) -> Dict:
+        name = site["name"]
+        root = Path(site["root_path"]).resolve()
+        files = {}
+        for row in db.connect().execute("SELECT path, sha256, size, encodings FROM site_assets WHERE site = ? ORDER BY path", (name,)):
+            variants = {}
+            for encoding in _made(row):
+                try:
+                    variants[encoding] = (root / (row["path"] + SUFFIXES[encoding])).stat().st_size
+                except OSError:
+                    continue
+            files[row["path"]] = _entry(row["path"], row["size"], row["sha256"], variants)
+        manifest = {"site": name, "release": deploys.current_release(site), "generated_at": int(time.time()), "files": files}
+        atomic_write(ASSETS_DIR / name / "manifest.json", json.dumps(manifest, separators=(",", ":")).encode())
+        _collect(name)
+        return manifest
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": enabled(),
+            "brotli": brotli is not None,
+            "pending_sites": len(self._dirty),
+            "runs": self.runs,
+            "compressed": self.compressed,
+            "reused": self.reused,
+            "bytes_saved": self.bytes_saved,
+            "last_run_seconds": self.last_run_seconds,
+        }
+
+
+def _collect(name: str) -> None:
+    """Cached variants no release links to any more (only the cache's own link is left) are removed."""
+    for cached in (ASSETS_DIR / name).glob("??/*"):
+        try:
+            if cached.stat().st_nlink <= 1:
+                cached.unlink()
+        except OSError:
+            continue
+
+
+def publish_existing() -> None:
+    """Variants cached before they were made readable to the web server are 0600; fix them once."""
+    if db.get_meta("asset_modes"):
+        return
+    if ASSETS_DIR.exists():
+        make_public(ASSETS_DIR)
+    db.set_meta("asset_modes", "1")
+
+
+def manifest(name: str) -> Optional[Dict]:
+    try:
+        return json.loads((ASSETS_DIR / name / "manifest.json").read_bytes())
+    except (OSError, ValueError):
+        return None
+
+
+def generated(name: str) -> Set[str]:
+    """Paths of the variant files the pipeline placed in the site."""
+    rows = db.connect().execute("SELECT path, encodings FROM site_assets WHERE site = ?", (name,))
+    return {row["path"] + SUFFIXES[encoding] for row in rows for encoding in _made(row)}
+
+
+def forget(name: str) -> None:
+    db.connect().execute("DELETE FROM site_assets WHERE site = ?", (name,))
+    shutil.rmtree(ASSETS_DIR / name, ignore_errors=True)
+
+
+pipeline = AssetPipeline()
+task = register(PeriodicTask("site-assets", 60.0, pipeline.tick))
@@ -0,0 +1,311 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import mimetypes
+import os
+import tempfile
+import time
+import zlib
+from pathlib import Path
+from typing import IO, Any, Dict, Iterable, Mapping, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+from ..core import db, storage
+from ..core.config import system_snapshot
+from ..core.paths import BLOBS_DIR
+from ..core.persistence import PUBLIC_FILE_MODE, fsync_dir, make_public
+
+READ_CHUNK = 1024 * 1024
+TMP_DIR = BLOBS_DIR / "tmp"
+# Temp files older than this belong to uploads that died mid-stream.
+STALE_TMP_SECONDS = 24 * 3600
+
+# Compression is decided from the type, or from how well the first SAMPLE_BYTES shrink.
+SAMPLE_BYTES = 64 * 1024
+SAMPLE_RATIO = 0.8
+MIN_COMPRESS_BYTES = 4096
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/xml",
+    "application/javascript",
+    "application/sql",
+    "application/x-sh",
+    "application/x-ndjson",
+    "image/svg+xml",
+)
+ENCODING_SUFFIX = {"gzip": ".gz"}
+
+
+def blob_path(digest: str, encoding: Optional[str] = None) -> Path:
+    path = BLOBS_DIR / digest[:2] / digest[2:]
+    return path.with_name(path.name + ENCODING_SUFFIX[encoding]) if encoding else path
+
+
+def locate(digest: str) -> Tuple[Path, Optional[str]]:
+    """Where a blob's bytes live and how they are encoded (None for raw)."""
+    row = db.connect().execute("SELECT encoding FROM blobs WHERE sha256 = ?", (digest,)).fetchone()
+    encoding = row["encoding"] if row else None
+    return blob_path(digest, encoding), encoding
+
+
+def locate_many(digests: Iterable[str]) -> Dict[str, Tuple[Path, Optional[str]]]:
+    """`locate` for many blobs in one query; unknown digests are left out."""
+    wanted = list(dict.fromkeys(digests))
+    found: Dict[str, Tuple[Path, Optional[str]]] = {}
+    conn = db.connect()
+    for start in range(0, len(wanted), 500):  # stay under SQLite's bound-parameter limit
+        batch = wanted[start : start + 500]
+        placeholders = ",".join("?" * len(batch))
+        for row in conn.execute(f"SELECT sha256, encoding FROM blobs WHERE sha256 IN ({placeholders})", batch):
+            found[row["sha256"]] = (blob_path(row["sha256"], row["encoding"]), row["encoding"])
+    return found
+
+
+def compression_settings() -> Mapping[str, Any]:
+    return system_snapshot().get("files", {}).get("compression", {})
+
+
+def _compressor(filename: str, sample: bytes, settings: Mapping[str, Any]) -> Optional["zlib._Compress"]:
+    if not settings.get("enabled") or len(sample) < MIN_COMPRESS_BYTES:
+        return None
+    mime = mimetypes.guess_type(filename)[0] or ""
+    if not mime.startswith(COMPRESSIBLE_TYPES) and len(zlib.compress(sample, 1)) > len(sample) * SAMPLE_RATIO:
+        return None
+    return zlib.compressobj(int(settings.get("level", 6)), zlib.DEFLATED, 31)  # wbits 31: gzip container
+
+
+class _BlobWriter:
+    """Hashes the original bytes while writing them raw or gzipped, deciding after the first sample."""
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.settings = compression_settings()
+        self.hasher = hashlib.sha256()
+        self.crc32 = 0  # of the original bytes; bundle shares need it for their ZIP headers
+        self.size = 0
+        self.sample: Optional[bytearray] = bytearray()
+        self.compressor: Optional["zlib._Compress"] = None
+
+    @property
+    def encoding(self) -> Optional[str]:
+        return "gzip" if self.compressor else None
+
+    def feed(self, chunk: bytes) -> bytes:
+        """Returns the bytes to write for `chunk` (possibly none while the sample fills)."""
+        self.hasher.update(chunk)
+        self.crc32 = zlib.crc32(chunk, self.crc32)
+        self.size += len(chunk)
+        if self.sample is not None:
+            self.sample += chunk
+            if len(self.sample) < SAMPLE_BYTES:
+                return b""
+            chunk = self._decide()
+        return self.compressor.compress(chunk) if self.compressor else chunk
+
+    def _decide(self) -> bytes:
+        sample, self.sample = bytes(self.sample or b""), None
+        self.compressor = _compressor(self.filename, sample, self.settings)
+        return sample
+
+    def finish(self) -> bytes:
+        tail = b""
+        if self.sample is not None:
+            tail = self._decide()
+        if self.compressor:
+            return self.compressor.compress(tail) + self.compressor.flush()
+        return tail
+
+
+def _new_temp() -> Path:
+    TMP_DIR.mkdir(parents=True, exist_ok=True)
+    fd, name = tempfile.mkstemp(dir=str(TMP_DIR), suffix=".tmp")
+    os.close(fd)
+    return Path(name)
+
+
+def adopt(source: Path, digest: str, size: int, encoding: Optional[str] = None) -> Path:
+    """Move `source` into the store under `digest` (or drop it if the content is known) and take a reference.
+
+    Returns the blob's canonical (raw) path, which share records keep even when it is stored encoded.
+    """
+    with db.transaction(immediate=True) as conn:
+        row = conn.execute("SELECT encoding FROM blobs WHERE sha256 = ?", (digest,)).fetchone()
+        if row and blob_path(digest, row["encoding"]).exists():
+            conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE sha256 = ?", (digest,))
+            source.unlink(missing_ok=True)
+            return blob_path(digest)
+        dest = blob_path(digest, encoding)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        with source.open("rb") as handle:
+            os.fchmod(handle.fileno(), PUBLIC_FILE_MODE)  # temp files are 0600; offloaded downloads are read by the proxy
+            os.fsync(handle.fileno())
+        stored_size = source.stat().st_size
+        os.replace(source, dest)
+        fsync_dir(dest.parent)
+        conn.execute(
+            "INSERT INTO blobs(sha256, size, refcount, created_at, encoding, stored_size) VALUES (?, ?, 1, ?, ?, ?) "
+            "ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1, encoding = excluded.encoding, "
+            "stored_size = excluded.stored_size",
+            (digest, size, time.time(), encoding, stored_size),
+        )
+    return blob_path(digest)
+
+
+class BlobSink:
+    """Streams one upload into the store's temp dir (hashing, maybe compressing) for `adopt`.
+
+    The temp dir sits beside the blobs, so adopting is a rename rather than a second copy.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.writer = _BlobWriter(filename)
+        self.temp = _new_temp()
+        self._file: Optional[IO[bytes]] = self.temp.open("wb")
+        self._buffer = bytearray()
+
+    @property
+    def size(self) -> int:
+        return self.writer.size
+
+    async def write(self, data: bytes) -> None:
+        # zlib releases the GIL, so compression runs off the event loop.
+        self._buffer += await asyncio.to_thread(self.writer.feed, data) if self.writer.compressor else self.writer.feed(data)
+        if len(self._buffer) >= READ_CHUNK:
+            await asyncio.to_thread(self._file.write, bytes(self._buffer))
+            self._buffer.clear()
+
+    async def finish(self) -> None:
+        if self._file is None:
+            return
+        self._buffer += self.writer.finish()
+        await asyncio.to_thread(self._file.write, bytes(self._buffer))
+        self._buffer.clear()
+        self._file.close()
+        self._file = None
+
+    def commit(self) -> Tuple[str, int, Path]:
+        """Adopt the finished upload; returns (digest, size, canonical path)."""
+        digest = self.writer.hasher.hexdigest()
+        try:
+            return digest, self.writer.size, adopt(self.temp, digest, self.writer.size, self.writer.encoding)
+        finally:
+            self.temp.unlink(missing_ok=True)
+
+    def discard(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.temp.unlink(missing_ok=True)
+
+
+def prepare_file(path: Path, filename: str) -> Tuple[str, int, Path, Optional[str]]:
+    """Hash a finished file in one pass; when it should be compressed, also write the gzip variant.
+
+    Returns (digest, size, file to adopt, encoding); the caller removes `path` if a variant was made.
+    """
+    writer = _BlobWriter(filename)
+    temp = _new_temp()
+    try:
+        with path.open("rb") as source, temp.open("wb") as outfile:
+            while chunk := source.read(READ_CHUNK):
+                data = writer.feed(chunk)
+                if writer.compressor:
+                    outfile.write(data)
+            tail = writer.finish()
+            if writer.compressor:
+                outfile.write(tail)
+    except BaseException:
+        temp.unlink(missing_ok=True)
+        raise
+    if not writer.compressor:
+        temp.unlink(missing_ok=True)
+        return writer.hasher.hexdigest(), writer.size, path, None
+    return writer.hasher.hexdigest(), writer.size, temp, writer.encoding
+
+
+def add_ref(digest: str) -> Path:
+    with db.transaction(immediate=True) as conn:
+        updated = conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE sha256 = ?", (digest,)).rowcount
+    if not updated:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown content hash")
+    return blob_path(digest)
+
+
+def release(digest: str) -> bool:
+    """Drop one reference; the blob is deleted with its last one. Returns True if it was freed."""
+    with db.transaction(immediate=True) as conn:
+        row = conn.execute("SELECT refcount FROM blobs WHERE sha256 = ?", (digest,)).fetchone()
+        if not row:
+            return False
+        if row["refcount"] > 1:
+            conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?", (digest,))
+            return False
+        conn.execute("DELETE FROM blobs WHERE sha256 = ?", (digest,))
+        blob_path(digest).unlink(missing_ok=True)
+        for encoding in ENCODING_SUFFIX:
+            blob_path(digest, encoding).unlink(missing_ok=True)
+    return True
+
+
+def get_blob(digest: str) -> Optional[Dict]:
+    row = db.connect().execute("SELECT * FROM blobs WHERE sha256 = ?", (digest,)).fetchone()
+    return dict(row) if row else None
+
+
+def publish_existing() -> None:
+    """Blobs adopted before they were made readable to the proxy are 0600; fix them once."""
+    if db.get_meta("blob_modes"):
+        return
+    if BLOBS_DIR.exists():
+        make_public(BLOBS_DIR)
+    db.set_meta("blob_modes", "1")
+
+
+def report() -> Dict:
+    """Dedup ratio of the store plus space held by files it does not account for."""
+    totals = db.connect().execute(
+        "SELECT COUNT(*) AS blobs, COALESCE(SUM(refcount), 0) AS refs, COALESCE(SUM(size), 0) AS unique_bytes, "
+        "COALESCE(SUM(COALESCE(stored_size, size)), 0) AS physical, COALESCE(SUM(size * refcount), 0) AS logical, "
+        "COALESCE(SUM(encoding IS NOT NULL), 0) AS compressed FROM blobs"
+    ).fetchone()
+    known = {
+        blob_path(row["sha256"], row["encoding"]).relative_to(BLOBS_DIR).as_posix()
+        for row in db.connect().execute("SELECT sha256, encoding FROM blobs")
+    }
+    orphaned = stale_tmp = 0
+    now = time.time()
+    if BLOBS_DIR.exists():
+        for path in BLOBS_DIR.glob("*/*"):
+            stat = path.stat()
+            if path.parent == TMP_DIR:
+                if stat.st_mtime < now - STALE_TMP_SECONDS:
+                    stale_tmp += stat.st_size
+            elif f"{path.parent.name}/{path.name}" not in known:
+                orphaned += stat.st_size
+    legacy = [record for record in storage.files.all() if not record.get("sha256") and not record.get("members")]
+    legacy_bytes = sum(Path(record["path"]).stat().st_size for record in legacy if Path(record["path"]).exists())
+    physical, logical = totals["physical"], totals["logical"]
+    return {
+        "blobs": totals["blobs"],
+        "references": totals["refs"],
+        "physical_bytes": physical,
+        "logical_bytes": logical,
+        "saved_bytes": logical - physical,
+        "dedup_ratio": round(logical / totals["unique_bytes"], 3) if totals["unique_bytes"] else None,
+        "compressed_blobs": totals["compressed"],
+        "compression_saved_bytes": totals["unique_bytes"] - physical,
+        "legacy_files": len(legacy),
+        "legacy_bytes": legacy_bytes,
+        "reclaimable_bytes": orphaned + stale_tmp,
+        "orphaned_bytes": orphaned,
+        "stale_tmp_bytes": stale_tmp,
+    }
+
+
+def reset() -> None:
+    with db.transaction(immediate=True) as conn:
+        conn.execute("DELETE FROM blobs")
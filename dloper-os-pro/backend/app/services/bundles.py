@@ -0,0 +1,259 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import struct
+import time
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+from fastapi import HTTPException, Request, status
+from fastapi.responses import Response, StreamingResponse
+
+from ..models.file import SharedFileCreate
+from ..utils import forms, http
+from ..utils.security import hash_password_async
+from . import blobs, files
+
+MAX_MEMBERS = 10_000
+# Bumped whenever the archive bytes for the same members would change, so cached ETags stop matching.
+LAYOUT_VERSION = 1
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+MADE_BY_UNIX = 3 << 8
+FLAG_UTF8 = 0x800
+METHOD_STORED, METHOD_DEFLATED = 0, 8
+FILE_ATTRIBUTES = 0o100644 << 16
+# Blobs are gzipped by zlib (wbits=31): a fixed 10-byte header, no optional fields, and an
+# 8-byte CRC/size trailer around a raw deflate stream, which is exactly a ZIP "deflated" entry.
+GZIP_HEADER, GZIP_TRAILER = 10, 8
+
+
+class Segment(NamedTuple):
+    start: int
+    length: int
+    data: Optional[bytes]  # literal header bytes, or None to read from `path`
+    path: Optional[Path] = None
+    offset: int = 0
+
+
+def member_path(raw: str) -> str:
+    """Normalise a client-supplied relative path ("dir/sub/file.txt") for use inside the archive."""
+    parts = [part for part in raw.replace("\\", "/").split("/") if part not in ("", ".")]
+    if not parts or ".." in parts:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid member path: {raw}")
+    return "/".join(parts)
+
+
+def _dos_datetime(timestamp: float) -> Tuple[int, int]:
+    moment = time.gmtime(max(timestamp, 315532800))  # ZIP dates start in 1980
+    dos_time = (moment.tm_hour << 11) | (moment.tm_min << 5) | (moment.tm_sec // 2)
+    dos_date = ((moment.tm_year - 1980) << 9) | (moment.tm_mon << 5) | moment.tm_mday
+    return dos_time, dos_date
+
+
+def _zip64_extra(*values: int) -> bytes:
+    return struct.pack("<HH", 0x0001, 8 * len(values)) + struct.pack(f"<{len(values)}Q", *values) if values else b""
+
+
+def layout(record: Dict) -> Tuple[List[Segment], int, str]:
+    """Byte layout of a bundle's ZIP: every offset is known before the first byte is sent.
+
+    Sizes and CRCs were recorded at upload, so there are no data descriptors, and the same
+    members always produce the same archive. That is what makes Range/resume work.
+    Returns (segments, total size, ETag).
+    """
+    members = record["members"]
+    located = blobs.locate_many(member["sha256"] for member in members)
+    segments: List[Segment] = []
+    central = bytearray()
+    position = 0
+    etag = hashlib.blake2b(digest_size=16)
+    etag.update(f"{LAYOUT_VERSION}".encode())
+
+    def emit(data: Optional[bytes], length: int, path: Optional[Path] = None, offset: int = 0) -> None:
+        nonlocal position
+        if length:
+            segments.append(Segment(position, length, data, path, offset))
+            position += length
+
+    for member in members:
+        if member["sha256"] not in located:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File missing on disk")
+        path, encoding = located[member["sha256"]]
+        name = member["path"].encode()
+        size, crc = member["size"], member["crc32"]
+        if encoding == "gzip":
+            method, data_offset, compressed = METHOD_DEFLATED, GZIP_HEADER, path.stat().st_size - GZIP_HEADER - GZIP_TRAILER
+        else:
+            method, data_offset, compressed = METHOD_STORED, 0, size
+        dos_time, dos_date = _dos_datetime(member["mtime"])
+        etag.update(json.dumps([member["path"], member["sha256"], member["mtime"], method]).encode())
+
+        local_offset = position
+        big = size >= ZIP64_LIMIT or compressed >= ZIP64_LIMIT
+        local_extra = _zip64_extra(size, compressed) if big else b""
+        version = VERSION_ZIP64 if big else VERSION_DEFAULT
+        header = struct.pack(
+            "<IHHHHHIIIHH",
+            0x04034B50,
+            version,
+            FLAG_UTF8,
+            method,
+            dos_time,
+            dos_date,
+            crc,
+            ZIP64_LIMIT if big else compressed,
+            ZIP64_LIMIT if big else size,
+            len(name),
+            len(local_extra),
+        )
+        emit(header + name + local_extra, len(header) + len(name) + len(local_extra))
+        emit(None, compressed, path, data_offset)
+
+        overflow = [value for value in (size, compressed, local_offset) if value >= ZIP64_LIMIT]
+        central_extra = _zip64_extra(*overflow)
+        central_version = VERSION_ZIP64 if overflow else VERSION_DEFAULT
+        central += struct.pack(
+            "<IHHHHHHIIIHHHHHII",
+            0x02014B50,
+            MADE_BY_UNIX | central_version,
+            central_version,
+            FLAG_UTF8,
+            method,
+            dos_time,
+            dos_date,
+            crc,
+            min(compressed, ZIP64_LIMIT),
+            min(size, ZIP64_LIMIT),
+            len(name),
+            len(central_extra),
+            0,
+            0,
+            0,
+            FILE_ATTRIBUTES,
+            min(local_offset, ZIP64_LIMIT),
+        )
+        central += name + central_extra
+
+    central_offset, count = position, len(members)
+    tail = bytearray(central)
+    if count >= ZIP64_COUNT_LIMIT or central_offset >= ZIP64_LIMIT or len(central) >= ZIP64_LIMIT:
+        zip64_end = central_offset + len(central)
+        tail += struct.pack(
+            "<IQHHIIQQQQ", 0x06064B50, 44, MADE_BY_UNIX | VERSION_ZIP64, VERSION_ZIP64, 0, 0, count, count, len(central), central_offset
+        )
+        tail += struct.pack("<IIQI", 0x07064B50, 0, zip64_end, 1)
+    tail += struct.pack(
+        "<IHHHHIIH",
+        0x06054B50,
+        0,
+        0,
+        min(count, ZIP64_COUNT_LIMIT),
+        min(count, ZIP64_COUNT_LIMIT),
+        min(len(central), ZIP64_LIMIT),
+        min(central_offset, ZIP64_LIMIT),
+        0,
+    )
+    emit(bytes(tail), len(tail))
+    return segments, position, f'"zip-{etag.hexdigest()}"'
+
+
+async def _stream(segments: List[Segment], start: int, length: int) -> AsyncIterator[bytes]:
+    end = start + length
+    for segment in segments:
+        segment_end = segment.start + segment.length
+        if segment_end <= start:
+            continue
+        if segment.start >= end:
+            break
+        low, high = max(start, segment.start) - segment.start, min(end, segment_end) - segment.start
+        if segment.data is not None:
+            yield segment.data[low:high]
+        else:
+            async for chunk in http.read_slice(segment.path, segment.offset + low, high - low):
+                yield chunk
+
+
+def zip_response(request: Request, record: Dict) -> Response:
+    segments, size, etag = layout(record)
+    mtime = max((member["mtime"] for member in record["members"]), default=0)
+
+    def body(start: int, length: int, status_code: int, headers: Dict[str, str]) -> Response:
+        return StreamingResponse(_stream(segments, start, length), status_code=status_code, headers=headers, media_type="application/zip")
+
+    return http.ranged_response(request, size, etag, mtime, record["filename"], "application/zip", body)
+
+
+def find_member(record: Dict, path: str) -> Dict:
+    for member in record.get("members") or []:
+        if member["path"] == path:
+            return member
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such file in this share")
+
+
+async def receive_bundle(request: Request) -> Tuple[Dict[str, str], List[blobs.BlobSink]]:
+    """Stream every `upload` part (its filename may carry a relative path) into the blob temp dir."""
+    forms.ensure_space(blobs.TMP_DIR, forms.declared_length(request))
+
+    async def open_sink(field: str, filename: str) -> blobs.BlobSink:
+        return blobs.BlobSink(filename)
+
+    fields, parts = await forms.stream_form(request, open_sink, max_parts=MAX_MEMBERS + forms.MAX_PARTS)
+    sinks = []
+    for name, sink in parts:
+        if name == "upload":
+            sinks.append(sink)
+        else:
+            sink.discard()
+    if not sinks:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Missing file field 'upload'")
+    if len(sinks) > MAX_MEMBERS:
+        for sink in sinks:
+            sink.discard()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"A bundle holds at most {MAX_MEMBERS} files")
+    return fields, sinks
+
+
+async def create_bundle(
+    name: str, sinks: List[blobs.BlobSink], payload: SharedFileCreate, owner: str, base_url: str
+) -> Dict:
+    committed: List[str] = []
+    try:
+        paths = [member_path(sink.filename) for sink in sinks]
+        if len(set(paths)) != len(paths):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Duplicate paths in bundle")
+        password_hash = await hash_password_async(payload.password) if payload.password else None
+        now = int(time.time())
+        members = []
+        for path, sink in zip(paths, sinks):
+            digest, size, _ = await asyncio.to_thread(sink.commit)
+            committed.append(digest)
+            members.append({"path": path, "sha256": digest, "size": size, "crc32": sink.writer.crc32, "mtime": now})
+    except BaseException:
+        for sink in sinks:
+            sink.discard()
+        for digest in committed:
+            blobs.release(digest)
+        raise
+    record = {"members": members}
+    _, archive_size, _ = layout(record)
+    stem = Path(name).name.removesuffix(".zip") or "bundle"
+    return files.add_shared_file(
+        uuid.uuid4().hex[:12],
+        f"{stem}.zip",
+        blobs.BLOBS_DIR,
+        owner,
+        base_url,
+        password_hash=password_hash,
+        max_downloads=payload.max_downloads,
+        expires_at=payload.expires_at.isoformat() if payload.expires_at else None,
+        active=payload.active,
+        size=archive_size,
+        members=members,
+    )
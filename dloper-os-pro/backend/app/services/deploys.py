@@ -0,0 +1,410 @@
+from __future__ import annotations
+
+import asyncio
+import calendar
+import errno
+import io
+import os
+import re
+import shutil
+import stat
+import tarfile
+import time
+import uuid
+import zipfile
+from pathlib import Path
+from typing import IO, Any, AsyncIterator, Dict, List, Mapping, Optional
+
+import anyio
+from fastapi import HTTPException, Request, status
+
+from ..core import locks, storage
+from ..core.config import system_snapshot
+from ..core.paths import SITES_DIR
+from ..core.persistence import fsync_dir, fsync_tree
+from ..utils import forms
+from . import assets, site_index
+
+# Releases are assembled here (same filesystem as the sites, outside every site root) and renamed into place.
+STAGING_DIR = SITES_DIR / ".staging"
+STALE_STAGING_SECONDS = 24 * 3600
+COPY_CHUNK = 1024 * 1024
+ZIP_MAGIC = b"PK\x03\x04"
+ANY_BASE = object()
+RELEASE_ID = re.compile(r"^\d{8}T\d{9}Z-[0-9a-z]+$")
+
+
+def release_settings() -> Mapping[str, Any]:
+    return system_snapshot().get("sites", {}).get("releases", {})
+
+
+def new_release_id(timestamp: Optional[float] = None, suffix: Optional[str] = None) -> str:
+    """Sortable by creation time (to the millisecond), which is how releases are ordered and pruned."""
+    timestamp = time.time() if timestamp is None else timestamp
+    stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(timestamp)) + f"{int(timestamp * 1000) % 1000:03d}Z"
+    return f"{stamp}-{suffix or uuid.uuid4().hex[:6]}"
+
+
+def site_home(name: str) -> Path:
+    return SITES_DIR / name
+
+
+def current_release(site: Dict) -> Optional[str]:
+    link = site_home(site["name"]) / "current"
+    if not link.is_symlink():
+        return None
+    return Path(os.readlink(link)).name
+
+
+def list_releases(site: Dict) -> List[Dict]:
+    releases = site_home(site["name"]) / "releases"
+    current = current_release(site)
+    if not releases.is_dir():
+        return []
+    found = []
+    for entry in sorted(releases.iterdir(), reverse=True):
+        if entry.is_dir() and RELEASE_ID.match(entry.name):
+            stamp = entry.name.split("-", 1)[0]
+            created = calendar.timegm(time.strptime(stamp[:15], "%Y%m%dT%H%M%S")) + int(stamp[15:18]) / 1000
+            found.append({"id": entry.name, "current": entry.name == current, "created_at": created})
+    return found
+
+
+class _BodyReader(io.RawIOBase):
+    """Blocking file object over the request body, for tarfile running in a worker thread."""
+
+    def __init__(self, head: bytes, chunks: AsyncIterator[bytes]) -> None:
+        self._pending = memoryview(head)
+        self._chunks = chunks
+
+    def readable(self) -> bool:
+        return True
+
+    async def _next(self) -> bytes:
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b""
+
+    def readinto(self, buffer: Any) -> int:
+        while not self._pending:
+            chunk = anyio.from_thread.run(self._next)
+            if not chunk:
+                return 0
+            self._pending = memoryview(chunk)
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+
+def _place(source: IO[bytes], size: int, dest: Path, previous: Optional[Path]) -> bool:
+    """Write one archive member to a new file at `dest` (never through an existing one: it may be a
+    hardlink shared with live releases). When the previous release has a file of the same size,
+    the member is compared with it as it streams; if every byte matches, `dest` becomes a hardlink
+    to that file and nothing is written. Returns True when linked."""
+    try:
+        info = previous.stat() if previous is not None else None
+    except OSError:
+        info = None
+    if info is not None and stat.S_ISREG(info.st_mode) and info.st_size == size:
+        with previous.open("rb") as old:
+            matched = 0
+            while True:
+                chunk = source.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                if old.read(len(chunk)) != chunk:
+                    # Diverged: the matched prefix comes from the old file, the rest from the archive.
+                    old.seek(0)
+                    with dest.open("xb") as out:
+                        shutil.copyfileobj(io.BufferedReader(_Limited(old, matched)), out, COPY_CHUNK)
+                        out.write(chunk)
+                        shutil.copyfileobj(source, out, COPY_CHUNK)
+                    return False
+                matched += len(chunk)
+        try:
+            os.link(previous, dest)
+        except OSError:
+            shutil.copyfile(previous, dest)  # no hardlinks on this filesystem
+            return False
+        return True
+    with dest.open("xb") as out:
+        shutil.copyfileobj(source, out, COPY_CHUNK)
+    return False
+
+
+class _Limited(io.RawIOBase):
+    def __init__(self, handle: IO[bytes], remaining: int) -> None:
+        self._handle, self._remaining = handle, remaining
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        count = self._handle.readinto(memoryview(buffer)[: min(len(buffer), self._remaining)]) if self._remaining else 0
+        self._remaining -= count
+        return count
+
+
+class _Extractor:
+    def __init__(self, staging: Path, base: Optional[Path], strip: int) -> None:
+        settings = release_settings()
+        self.staging, self.base, self.strip = staging, base, strip
+        self.max_bytes = int(settings.get("max_mb", 4096)) * 1024 * 1024
+        self.max_files = int(settings.get("max_files", 50_000))
+        self.files = self.bytes = self.linked = self.skipped = 0
+
+    def _relative(self, raw: str) -> Optional[str]:
+        parts = [part for part in raw.replace("\\", "/").split("/") if part not in ("", ".")]
+        if ".." in parts:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid path in archive: {raw}")
+        parts = parts[self.strip :]
+        return "/".join(parts) if parts else None
+
+    def _count(self, size: int) -> None:
+        self.files += 1
+        self.bytes += size
+        if self.files > self.max_files or self.bytes > self.max_bytes:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Archive exceeds the release size limit")
+
+    def _directory(self, rel: str) -> None:
+        (self.staging / rel).mkdir(parents=True, exist_ok=True)
+
+    def _file(self, rel: str, size: int, source: IO[bytes], mtime: float) -> None:
+        self._count(size)
+        dest = self.staging / rel
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        if dest.is_dir():
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Archive has both a file and a directory at {rel}")
+        # A path listed twice: the later entry wins, as with tar. The earlier one may be a hardlink
+        # into the live release, so it is unlinked rather than written through.
+        dest.unlink(missing_ok=True)
+        if _place(source, size, dest, self.base / rel if self.base else None):
+            self.linked += 1
+        elif mtime > 0:
+            os.utime(dest, (mtime, mtime))
+
+    def extract_tar(self, stream: IO[bytes]) -> None:
+        with tarfile.open(fileobj=stream, mode="r|*") as archive:
+            for member in archive:
+                rel = self._relative(member.name)
+                if rel is None:
+                    continue
+                if member.isdir():
+                    self._directory(rel)
+                elif member.isreg():
+                    self._file(rel, member.size, archive.extractfile(member), member.mtime)
+                else:
+                    self.skipped += 1  # links and devices are not deployed
+
+    def extract_zip(self, path: Path) -> None:
+        with zipfile.ZipFile(path) as archive:
+            members = archive.infolist()
+            if len(members) > self.max_files or sum(info.file_size for info in members) > self.max_bytes:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Archive exceeds the release size limit")
+            for info in members:
+                rel = self._relative(info.filename)
+                if rel is None:
+                    continue
+                if info.is_dir():
+                    self._directory(rel)
+                elif stat.S_ISLNK(info.external_attr >> 16):
+                    self.skipped += 1
+                else:
+                    with archive.open(info) as source:
+                        self._file(rel, info.file_size, source, time.mktime(info.date_time + (0, 0, -1)))
+
+
+async def _spool(head: bytes, chunks: AsyncIterator[bytes], dest: Path, limit: int) -> None:
+    """Zip needs its central directory at the end, so zip uploads are written to disk first."""
+    handle = dest.open("wb")
+    try:
+        buffer, size = bytearray(head), len(head)
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > limit:
+                raise forms.too_large()
+            buffer += chunk
+            if len(buffer) >= forms.WRITE_BUFFER:
+                await asyncio.to_thread(handle.write, bytes(buffer))
+                buffer.clear()
+        await asyncio.to_thread(handle.write, bytes(buffer))
+    finally:
+        handle.close()
+
+
+def _point(home: Path, release_id: str) -> None:
+    """Switch `current` to a release in one rename, so requests see the old or the new site, never a mix."""
+    temp = home / f".current.{uuid.uuid4().hex[:8]}"
+    os.symlink(f"releases/{release_id}", temp)
+    os.replace(temp, home / "current")
+    fsync_dir(home)
+
+
+def _link_tree(source: Path, dest: Path) -> None:
+    """Recreate the tree under `source` at `dest` with hardlinks (copies where the filesystem has none)."""
+    for dirpath, dirnames, filenames in os.walk(source):
+        target = dest / Path(dirpath).relative_to(source)
+        target.mkdir(parents=True, exist_ok=True)
+        for entry in dirnames:
+            if os.path.islink(os.path.join(dirpath, entry)):
+                os.symlink(os.readlink(os.path.join(dirpath, entry)), target / entry)
+        dirnames[:] = [entry for entry in dirnames if not os.path.islink(os.path.join(dirpath, entry))]
+        for entry in filenames:
+            path = os.path.join(dirpath, entry)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), target / entry)
+                continue
+            try:
+                os.link(path, target / entry)
+            except OSError:
+                shutil.copy2(path, target / entry)
+
+
+def _remove(path: Path) -> None:
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def _activate_record(site: Dict, release_id: str) -> None:
+    name = site["name"]
+    current = str(site_home(name) / "current")
+
+    def apply(record: Dict) -> None:
+        record["root_path"] = current
+        record["release"] = release_id
+
+    storage.sites.update(name, apply)
+    site["root_path"], site["release"] = current, release_id
+    site_index.forget(name)
+    assets.pipeline.schedule(name)
+
+
+def _prune(site: Dict) -> List[str]:
+    keep = int(release_settings().get("keep", 5))
+    releases = site_home(site["name"]) / "releases"
+    removed = []
+    for entry in [release for release in list_releases(site) if not release["current"]][keep:]:
+        shutil.rmtree(releases / entry["id"], ignore_errors=True)
+        removed.append(entry["id"])
+    # Staging left behind by a deploy that died mid-upload.
+    cutoff = time.time() - STALE_STAGING_SECONDS
+    for leftover in STAGING_DIR.glob("*"):
+        try:
+            if leftover.stat().st_mtime >= cutoff:
+                continue
+            if leftover.is_dir():
+                shutil.rmtree(leftover, ignore_errors=True)
+            else:
+                leftover.unlink()
+        except OSError:
+            continue
+    return removed
+
+
+def publish(site: Dict, staging: Path, release_id: str, base: Any = ANY_BASE) -> List[str]:
+    """Move a complete tree from STAGING_DIR into releases/ and make it live; returns the pruned release ids.
+
+    `base` is the release the tree was built on (None for a site not deployed yet); when given,
+    the switch is refused with 409 if another release went live in the meantime.
+    """
+    name = site["name"]
+    home = site_home(name)
+    with locks.file_lock(f"site-{name}"):
+        if base is not ANY_BASE and current_release(site) != base:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="The site changed while this release was built")
+        if not (home / "current").is_symlink():
+            # First deploy: the files served so far become the oldest release, so rollback can reach them.
+            # They are linked into it and `current` points there before the site is switched over to it;
+            # only then are the originals removed, so the old site is served until the new one is.
+            if home.is_dir():
+                initial = new_release_id(home.stat().st_mtime, "initial")
+                parked = STAGING_DIR / f"{name}-{initial}"
+                _link_tree(home, parked)
+                fsync_tree(parked)
+                # Site files of the same name as the layout's own entries are the only ones that go early.
+                for entry in (home / "releases", home / "current"):
+                    _remove(entry)
+                (home / "releases").mkdir()
+                os.replace(parked, home / "releases" / initial)
+                _point(home, initial)
+                _activate_record(site, initial)
+                for entry in home.iterdir():
+                    if entry.name not in ("releases", "current"):
+                        _remove(entry)
+            else:
+                (home / "releases").mkdir(parents=True)
+        os.replace(staging, home / "releases" / release_id)
+        _point(home, release_id)
+        _activate_record(site, release_id)
+        return _prune(site)
+
+
+async def deploy(site: Dict, request: Request, strip: int = 0) -> Dict:
+    """Unpack a tar (optionally gz/bz2/xz) or zip request body into a new release and switch to it."""
+    started = time.monotonic()
+    limit = int(release_settings().get("max_mb", 4096)) * 1024 * 1024
+    declared = forms.declared_length(request)
+    if declared > limit:
+        raise forms.too_large()
+    forms.ensure_space(STAGING_DIR, declared)
+    release_id = new_release_id()
+    staging = STAGING_DIR / f"{site['name']}-{release_id}"
+    spool = staging.with_name(staging.name + ".zip")
+    staging.mkdir(parents=True)
+    base = Path(site["root_path"]).resolve()
+    extractor = _Extractor(staging, base if base.is_dir() else None, max(strip, 0))
+    try:
+        chunks = request.stream().__aiter__()
+        head = b""
+        async for chunk in chunks:
+            head += chunk
+            if len(head) >= len(ZIP_MAGIC):
+                break
+        if not head:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty archive")
+        try:
+            if head.startswith(ZIP_MAGIC):
+                await _spool(head, chunks, spool, limit)
+                await anyio.to_thread.run_sync(extractor.extract_zip, spool)
+            else:
+                reader = io.BufferedReader(_BodyReader(head, chunks), COPY_CHUNK)
+                await anyio.to_thread.run_sync(extractor.extract_tar, reader)
+        except (tarfile.TarError, zipfile.BadZipFile, EOFError) as exc:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Body is not a readable tar or zip archive") from exc
+        except (FileExistsError, NotADirectoryError, IsADirectoryError) as exc:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Archive has a file and a directory at the same path") from exc
+        except OSError as exc:
+            if exc.errno == errno.ENOSPC:
+                raise HTTPException(status_code=status.HTTP_507_INSUFFICIENT_STORAGE, detail="Not enough disk space") from exc
+            raise
+        spool.unlink(missing_ok=True)
+        await asyncio.to_thread(fsync_tree, staging)
+        pruned = await asyncio.to_thread(publish, site, staging, release_id)
+    except BaseException:
+        spool.unlink(missing_ok=True)
+        await asyncio.to_thread(shutil.rmtree, staging, True)
+        raise
+    return {
+        "release": release_id,
+        "files": extractor.files,
+        "bytes": extractor.bytes,
+        "linked": extractor.linked,
+        "skipped": extractor.skipped,
+        "pruned": pruned,
+        "seconds": round(time.monotonic() - started, 3),
+    }
+
+
+def activate(site: Dict, release_id: str) -> Dict:
+    """Roll back (or forward) to a kept release."""
+    home = site_home(site["name"])
+    if not RELEASE_ID.match(release_id) or not (home / "releases" / release_id).is_dir():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Release not found")
+    with locks.file_lock(f"site-{site['name']}"):
+        _point(home, release_id)
+        _activate_record(site, release_id)
+    return {"release": release_id, "releases": list_releases(site)}
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import datetime as dt
+import heapq
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from ..core import db, storage
+from ..core.config import system_snapshot
+from ..core.locks import try_leader_lock
+from ..utils.background import PeriodicTask, register
+from . import files
+
+# Longest sleep between checks for shares created or changed by other workers.
+POLL_SECONDS = 10.0
+# Shares swept per tick; a full batch schedules the next tick right away.
+SWEEP_BATCH = 100
+ACTIONS = ("deactivate", "delete")
+
+
+def action() -> str:
+    configured = system_snapshot().get("files", {}).get("expiry", {}).get("action", "deactivate")
+    return configured if configured in ACTIONS else "deactivate"
+
+
+class ExpirySweeper:
+    """Sweeps shares as they come due, sleeping until the earliest one instead of scanning on a timer.
+
+    With SQLite storage every write stores the record's due time in the indexed `sweep_at`
+    column, so a tick is one index lookup however many shares exist or how often they change.
+    The YAML backend has no index: there a min-heap is rebuilt from the document when the
+    shared files generation moves. Runs in a single (leader) worker.
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, str]] = []
+        self._generation = -1
+        self._leader: Optional[int] = None
+        self._lock = threading.Lock()
+        self.rebuilds = 0
+        self.expired = 0
+        self.exhausted = 0
+
+    @staticmethod
+    def _indexed() -> bool:
+        return storage.files.backend == "sqlite"
+
+    def _rebuild(self) -> None:
+        generation = storage.files.generation()
+        heap = [(due, record["id"]) for record in storage.files.all() if (due := storage.share_due_at(record)) is not None]
+        heapq.heapify(heap)
+        self._heap, self._generation = heap, generation
+        self.rebuilds += 1
+
+    def _due(self, now: float) -> List[Dict]:
+        due: List[Dict] = []
+        if self._indexed():
+            if not db.get_meta("files_sweep_at"):
+                storage.files.impl.refresh_columns()  # rows written before the column existed
+                db.set_meta("files_sweep_at", "1")
+            for record in storage.files.impl.ordered_below("sweep_at", now, SWEEP_BATCH):
+                current = storage.share_due_at(record)
+                if current is not None and current <= now:
+                    due.append(record)
+                else:
+                    storage.files.update(record["id"], lambda record: None)  # stale column: rewrite it
+            return due
+        if storage.files.generation() != self._generation:
+            self._rebuild()
+        while self._heap and self._heap[0][0] <= now and len(due) < SWEEP_BATCH:
+            _, file_id = heapq.heappop(self._heap)
+            record = storage.files.get(file_id)
+            current = storage.share_due_at(record) if record else None
+            if current is None:
+                continue
+            if current > now:
+                heapq.heappush(self._heap, (current, file_id))  # extended since the heap was built
+                continue
+            due.append(record)
+        return due
+
+    def _upcoming(self) -> Tuple[Optional[float], int]:
+        """(earliest due time, shares waiting to come due)."""
+        if self._indexed():
+            return storage.files.impl.lowest("sweep_at")
+        return (self._heap[0][0] if self._heap else None), len(self._heap)
+
+    def _sweep(self, record: Dict, now: float) -> None:
+        expired = bool(record.get("expires_at")) and storage.timestamp(record["expires_at"]) <= now
+        if action() == "delete":
+            files.delete_file(record["id"])
+        else:
+            files.purge_file(record["id"])
+        if expired:
+            self.expired += 1
+        else:
+            self.exhausted += 1
+
+    def tick(self) -> float:
+        if self._leader is None:
+            self._leader = try_leader_lock("expiry-sweeper")
+            if self._leader is None:
+                return 60.0
+        with self._lock:
+            now = time.time()
+            due = self._due(now)
+            for record in due:
+                self._sweep(record, now)
+            if len(due) >= SWEEP_BATCH:
+                return 0.0
+            next_due, _ = self._upcoming()
+            if next_due is None:
+                return POLL_SECONDS
+            return min(max(next_due - now, 0.0), POLL_SECONDS)
+
+    def stats(self) -> Dict:
+        next_due, pending = self._upcoming()
+        return {
+            "leader": self._leader is not None,
+            "action": action(),
+            "indexed": self._indexed(),
+            "pending": pending,
+            "next_due": dt.datetime.utcfromtimestamp(next_due).isoformat() if next_due is not None else None,
+            "rebuilds": self.rebuilds,
+            "expired": self.expired,
+            "exhausted": self.exhausted,
+        }
+
+
+sweeper = ExpirySweeper()
+task = register(PeriodicTask("share-expiry", POLL_SECONDS, sweeper.tick))
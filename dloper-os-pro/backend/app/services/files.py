@@ -1,165 +1,328 @@
 from __future__ import annotations
 
+import asyncio
 import datetime as dt
 import mimetypes
+import time
 import uuid
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
-import aiofiles
-from fastapi import HTTPException, UploadFile, status
+from fastapi import HTTPException, Request, status
 
-from ..core import config
-from ..core.config import CONFIG_DIR, save_yaml
+from ..core import db, storage
 from ..core.paths import FILES_DIR
-from ..models.file import SharedFileCreate
-from ..utils.security import hash_password, verify_password
+from ..models.file import SharedFileCreate, SharedFileFromHash
+from ..utils import forms
+from ..utils.background import PeriodicTask, register
+from ..utils.hotcache import hot_cache
+from ..utils.security import (
+    create_download_ticket,
+    hash_password_async,
+    verify_download_ticket,
+    verify_password_async,
+)
+from . import blobs
 
-FILES_PATH = CONFIG_DIR / "files.yaml"
+# Requests from one client for one file count as a single download until it has been idle this long.
+# A client's download counts once per window, measured from its first request of that window.
+DOWNLOAD_SESSION_SECONDS = storage.DOWNLOAD_SESSION_SECONDS
 
 
 def load_records() -> List[Dict]:
-    data = config.get_files_config()
-    return data.get("files", [])
+    return storage.files.all()
 
 
 def save_records(files: List[Dict]) -> None:
-    save_yaml(FILES_PATH, {"files": files})
+    storage.files.replace_all(files)
 
 
-def list_files() -> List[Dict]:
+def list_files(owner: Optional[str] = None) -> List[Dict]:
+    if owner is not None:
+        return storage.files.find("owner", owner)
     return load_records()
 
 
-async def _persist_upload(upload: UploadFile, target_dir: Path) -> Path:
-    target_dir.mkdir(parents=True, exist_ok=True)
-    target_path = target_dir / upload.filename
-    async with aiofiles.open(target_path, "wb") as outfile:
-        while chunk := await upload.read(1024 * 1024):
-            await outfile.write(chunk)
-    await upload.close()
-    return target_path
+async def receive_upload(request: Request) -> Tuple[Dict[str, str], blobs.BlobSink]:
+    """Stream the `upload` part of a multipart request into the blob store's temp dir."""
+    forms.ensure_space(blobs.TMP_DIR, forms.declared_length(request))
 
+    async def open_sink(field: str, filename: str) -> blobs.BlobSink:
+        return blobs.BlobSink(filename)
 
-async def create_shared_file(upload: UploadFile, payload: SharedFileCreate, owner: str, base_url: str) -> Dict:
-    file_id = uuid.uuid4().hex[:12]
-    target_dir = FILES_DIR / file_id
-    target_path = await _persist_upload(upload, target_dir)
-    files = load_records()
+    return await forms.receive_file(request, open_sink)
+
+
+async def create_shared_file(upload: blobs.BlobSink, payload: SharedFileCreate, owner: str, base_url: str) -> Dict:
+    try:
+        password_hash = await hash_password_async(payload.password) if payload.password else None
+        digest, size, path = await asyncio.to_thread(upload.commit)
+    except BaseException:
+        upload.discard()
+        raise
+    return add_shared_file(
+        uuid.uuid4().hex[:12],
+        upload.filename,
+        path,
+        owner,
+        base_url,
+        password_hash=password_hash,
+        max_downloads=payload.max_downloads,
+        expires_at=payload.expires_at.isoformat() if payload.expires_at else None,
+        active=payload.active,
+        sha256=digest,
+        size=size,
+    )
+
+
+async def share_existing(payload: SharedFileFromHash, user: Dict, base_url: str) -> Dict:
+    """Share content already in the blob store without uploading it again."""
+    digest = payload.sha256.lower()
+    blob = blobs.get_blob(digest)
+    # Knowing a hash is not proof of having the file: only its existing owners (or admins) may re-share it.
+    owns = any(
+        record.get("sha256") == digest or any(member["sha256"] == digest for member in record.get("members") or [])
+        for record in storage.files.find("owner", user["username"])
+    )
+    if not blob or not (owns or user.get("role") in {"owner", "admin"}):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown content hash")
+    password_hash = await hash_password_async(payload.password) if payload.password else None
+    return add_shared_file(
+        uuid.uuid4().hex[:12],
+        payload.filename,
+        blobs.add_ref(digest),
+        user["username"],
+        base_url,
+        password_hash=password_hash,
+        max_downloads=payload.max_downloads,
+        expires_at=payload.expires_at.isoformat() if payload.expires_at else None,
+        active=payload.active,
+        sha256=digest,
+        size=blob["size"],
+    )
+
+
+def add_shared_file(
+    file_id: str,
+    filename: str,
+    path: Path,
+    owner: str,
+    base_url: str,
+    password_hash: Optional[str] = None,
+    max_downloads: Optional[int] = None,
+    expires_at: Optional[str] = None,
+    active: bool = True,
+    sha256: Optional[str] = None,
+    size: Optional[int] = None,
+    members: Optional[List[Dict]] = None,
+) -> Dict:
+    """Register stored content as a share; `sha256` marks `path` as a blob holding one reference for it.
+
+    Bundle shares pass `members` instead, each holding one reference to its own blob.
+    """
     entry = {
         "id": file_id,
-        "filename": upload.filename,
-        "path": str(target_path),
-        "password_hash": hash_password(payload.password) if payload.password else None,
-        "password_protected": bool(payload.password),
-        "max_downloads": payload.max_downloads,
-        "expires_at": payload.expires_at.isoformat() if payload.expires_at else None,
+        "filename": filename,
+        "path": str(path),
+        "sha256": sha256,
+        "size": size,
+        "members": members,
+        "password_hash": password_hash,
+        "password_protected": bool(password_hash),
+        "max_downloads": max_downloads,
+        "expires_at": expires_at,
         "download_count": 0,
         "owner": owner,
         "share_url": f"{base_url.rstrip('/')}/share/{file_id}",
         "created_at": dt.datetime.utcnow().isoformat(),
-        "active": payload.active,
+        "active": active,
     }
-    files.append(entry)
-    save_records(files)
+    storage.files.insert(entry)
     return entry
 
 
 def get_file(file_id: str) -> Optional[Dict]:
-    for file in load_records():
-        if file.get("id") == file_id:
-            return file
-    return None
+    return storage.files.get(file_id)
 
 
 def increment_download(file_id: str) -> Optional[Dict]:
-    files = load_records()
-    updated: Optional[Dict] = None
-    for idx, file in enumerate(files):
-        if file.get("id") == file_id:
-            if not file.get("active", True):
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Sharing disabled")
-            # expiry check
-            if file.get("expires_at") and dt.datetime.fromisoformat(file["expires_at"]) < dt.datetime.utcnow():
-                raise HTTPException(status_code=status.HTTP_410_GONE, detail="File expired")
-            if file.get("max_downloads") and file.get("download_count", 0) >= file["max_downloads"]:
-                raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Download limit reached")
-            file["download_count"] = file.get("download_count", 0) + 1
-            files[idx] = file
-            updated = file
-            break
-    if updated:
-        save_records(files)
-    return updated
+    def apply(file: Dict) -> None:
+        if not file.get("active", True):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Sharing disabled")
+        # expiry check
+        if file.get("expires_at") and storage.timestamp(file["expires_at"]) < time.time():
+            raise HTTPException(status_code=status.HTTP_410_GONE, detail="File expired")
+        if file.get("max_downloads") and file.get("download_count", 0) >= file["max_downloads"]:
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Download limit reached")
+        file["download_count"] = file.get("download_count", 0) + 1
+        if file.get("max_downloads") and file["download_count"] >= file["max_downloads"]:
+            file["exhausted_at"] = dt.datetime.utcnow().isoformat()
+
+    return storage.files.update(file_id, apply)
 
 
-def validate_file_password(file_id: str, password: Optional[str]) -> Dict:
+async def validate_file_password(file_id: str, password: Optional[str], ticket: Optional[str] = None) -> Dict:
     file = get_file(file_id)
     if not file:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
     if not file.get("active", True):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Sharing disabled")
     if file.get("password_protected"):
-        if not password:
+        if ticket:
+            if not verify_download_ticket(ticket, file_id, file.get("password_hash") or ""):
+                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired ticket")
+        elif not password:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Password required")
-        if not verify_password(password, file.get("password_hash", "")):
+        elif not await verify_password_async(password, file.get("password_hash", "")):
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect password")
     return file
 
 
+async def issue_download_ticket(file_id: str, password: Optional[str]) -> Dict:
+    file = await validate_file_password(file_id, password)
+    ticket, expires = create_download_ticket(file_id, file.get("password_hash") or "")
+    return {"ticket": ticket, "expires_at": dt.datetime.utcfromtimestamp(expires).isoformat()}
+
+
+def _content_paths(record: Dict) -> List[Path]:
+    digests = [record["sha256"]] if record.get("sha256") else []
+    digests += [member["sha256"] for member in record.get("members") or []]
+    paths = [blobs.blob_path(digest, encoding) for digest in digests for encoding in (None, *blobs.ENCODING_SUFFIX)]
+    return paths + [Path(record["path"])] if record.get("path") else paths
+
+
 def update_file_record(file_id: str, updates: Dict[str, Any]) -> Optional[Dict]:
-    files = load_records()
-    updated: Optional[Dict] = None
-    for idx, file in enumerate(files):
-        if file.get("id") == file_id:
-            file.update(updates)
-            files[idx] = file
-            updated = file
-            break
-    if updated:
-        save_records(files)
+    updated = storage.files.update(file_id, lambda file: file.update(updates))
+    if updated is not None:
+        hot_cache.invalidate(_content_paths(updated))
     return updated
 
 
-def delete_file(file_id: str) -> bool:
-    files = load_records()
-    remaining = [f for f in files if f.get("id") != file_id]
-    if len(remaining) == len(files):
-        return False
-    save_records(remaining)
-    target_dir = FILES_DIR / file_id
+def _release_data(record: Dict) -> None:
+    hot_cache.invalidate(_content_paths(record))
+    with db.transaction(immediate=True) as conn:
+        conn.execute("DELETE FROM download_sessions WHERE file_id = ?", (record["id"],))
+    if record.get("sha256"):
+        blobs.release(record["sha256"])
+    for member in record.get("members") or []:
+        blobs.release(member["sha256"])
+    # Shares created before the blob store keep their own directory.
+    target_dir = FILES_DIR / record["id"]
     if target_dir.exists():
         for item in target_dir.iterdir():
             item.unlink()
         target_dir.rmdir()
+
+
+def delete_file(file_id: str) -> bool:
+    record = storage.files.delete(file_id)
+    if record is None:
+        return False
+    if not record.get("purged_at"):  # a purge already released its data
+        _release_data(record)
     return True
 
 
-def resolve_download(file_id: str, password: Optional[str]) -> Path:
-    record = validate_file_password(file_id, password)
+def purge_file(file_id: str) -> Optional[Dict]:
+    """Free a share's storage but keep its record, deactivated, for the owner's history."""
+    previous: Dict = {}
+
+    def apply(file: Dict) -> None:
+        previous.update(file)
+        file.update(active=False, sha256=None, members=None, purged_at=dt.datetime.utcnow().isoformat())
+
+    updated = storage.files.update(file_id, apply)
+    if updated is not None and not previous.get("purged_at"):
+        _release_data(previous)
+    return updated
+
+
+def stored_content(record: Dict) -> Tuple[Path, Optional[str]]:
+    """The file holding a share's bytes and its storage encoding (None when stored raw)."""
+    if record.get("sha256"):
+        path, encoding = blobs.locate(record["sha256"])
+    else:
+        path, encoding = Path(record["path"]), None
+    if not path.exists():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File missing on disk")
+    return path, encoding
+
+
+async def check_access(
+    file_id: str, password: Optional[str], ticket: Optional[str] = None, client: Optional[str] = None
+) -> Dict:
+    """Check access to a share; counting happens in `record_download` once a body is actually served.
+
+    A share that has used up `max_downloads` is refused here, except to a client whose counted
+    session is still open, so the last download can still be resumed.
+    """
+    record = await validate_file_password(file_id, password, ticket)
     expires_at = record.get("expires_at")
-    if expires_at and dt.datetime.fromisoformat(expires_at) < dt.datetime.utcnow():
+    if expires_at and storage.timestamp(expires_at) < time.time():
         raise HTTPException(status_code=status.HTTP_410_GONE, detail="File expired")
     if record.get("max_downloads") and record.get("download_count", 0) >= record["max_downloads"]:
-        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Download limit reached")
-    path = Path(record["path"])
-    if not path.exists():
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File missing on disk")
-    increment_download(file_id)
-    return path
+        if client is None or not _session_open(file_id, client):
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Download limit reached")
+    return record
 
 
-def file_metadata(file_id: str, password: Optional[str]) -> Dict:
-    record = validate_file_password(file_id, password)
-    path = Path(record["path"])
-    if not path.exists():
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File missing on disk")
-    stats = path.stat()
-    mime, _ = mimetypes.guess_type(path.name)
+def _session_open(file_id: str, client: str) -> bool:
+    row = db.connect().execute(
+        "SELECT started_at FROM download_sessions WHERE file_id = ? AND client = ?", (file_id, client)
+    ).fetchone()
+    return bool(row) and row["started_at"] > time.time() - DOWNLOAD_SESSION_SECONDS
+
+
+def record_download(file_id: str, client: str) -> None:
+    """Count one download per client session; resumed and segmented range requests ride on it.
+
+    The session window runs from the request that was counted, not from the latest one, so a
+    client that keeps coming back is counted again every DOWNLOAD_SESSION_SECONDS.
+    """
+    now = time.time()
+    with db.transaction(immediate=True) as conn:
+        row = conn.execute(
+            "SELECT started_at FROM download_sessions WHERE file_id = ? AND client = ?", (file_id, client)
+        ).fetchone()
+        if row and row["started_at"] > now - DOWNLOAD_SESSION_SECONDS:
+            conn.execute(
+                "UPDATE download_sessions SET last_seen = ? WHERE file_id = ? AND client = ?", (now, file_id, client)
+            )
+            return
+        conn.execute(
+            "INSERT INTO download_sessions(file_id, client, started_at, last_seen) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(file_id, client) DO UPDATE SET started_at = excluded.started_at, last_seen = excluded.last_seen",
+            (file_id, client, now, now),
+        )
+    try:
+        increment_download(file_id)
+    except HTTPException:
+        with db.transaction(immediate=True) as conn:
+            conn.execute("DELETE FROM download_sessions WHERE file_id = ? AND client = ?", (file_id, client))
+        raise
+
+
+def prune_download_sessions() -> None:
+    with db.transaction(immediate=True) as conn:
+        conn.execute("DELETE FROM download_sessions WHERE started_at < ?", (time.time() - DOWNLOAD_SESSION_SECONDS,))
+
+
+async def file_metadata(file_id: str, password: Optional[str], ticket: Optional[str] = None) -> Dict:
+    record = await validate_file_password(file_id, password, ticket)
+    if record.get("members") is not None:
+        meta = {
+            "filesize": record["size"],  # of the ZIP as served
+            "members": [{"path": member["path"], "size": member["size"]} for member in record["members"]],
+        }
+    else:
+        path, _ = stored_content(record)
+        # Original size, also for gzip-stored content.
+        meta = {"filesize": record["size"] if record.get("size") is not None else path.stat().st_size}
+    mime, _ = mimetypes.guess_type(record.get("filename") or "")
     return {
         "id": record.get("id"),
         "filename": record.get("filename"),
-        "filesize": stats.st_size,
+        **meta,
         "content_type": mime or "application/octet-stream",
         "expires_at": record.get("expires_at"),
         "max_downloads": record.get("max_downloads"),
@@ -167,3 +330,6 @@ def file_metadata(file_id: str, password: Optional[str]) -> Dict:
         "password_protected": record.get("password_protected", False),
         "active": record.get("active", True),
     }
+
+
+session_pruner = register(PeriodicTask("download-sessions", DOWNLOAD_SESSION_SECONDS, prune_download_sessions))
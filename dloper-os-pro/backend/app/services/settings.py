@@ -8,11 +8,14 @@ from typing import Dict
 
 from fastapi import HTTPException, status
 
-from ..core import config
+from ..core import config, storage
 from ..core.config import CONFIG_DIR, get_system_settings, save_yaml
+from ..core.locks import file_lock
 from ..core.paths import BACKUPS_DIR, FILES_DIR, SITES_DIR
 from ..models.settings import ResetRequest, SettingsUpdate
-from ..services import users
+from ..services import blobs, users
+from ..utils.hotcache import hot_cache
+from ..utils.security import calibrate_password_hashing
 
 SYSTEM_PATH = CONFIG_DIR / "system.yaml"
 
@@ -22,18 +25,36 @@ def fetch_settings() -> Dict:
 
 
 def update_settings(payload: SettingsUpdate) -> Dict:
-    current = get_system_settings()
-    if payload.name is not None:
-        current.setdefault("instance", {})["name"] = payload.name
-    if payload.base_url is not None:
-        current.setdefault("instance", {})["base_url"] = payload.base_url
-    if payload.analytics_enabled is not None:
-        current.setdefault("analytics", {})["enabled"] = payload.analytics_enabled
-    if payload.token_expiry_minutes is not None:
-        current.setdefault("security", {})["token_expiry_minutes"] = payload.token_expiry_minutes
+    with file_lock("config-system"):
+        current = get_system_settings()
+        if payload.name is not None:
+            current.setdefault("instance", {})["name"] = payload.name
+        if payload.base_url is not None:
+            current.setdefault("instance", {})["base_url"] = payload.base_url
+        if payload.analytics_enabled is not None:
+            current.setdefault("analytics", {})["enabled"] = payload.analytics_enabled
+        if payload.token_expiry_minutes is not None:
+            current.setdefault("security", {})["token_expiry_minutes"] = payload.token_expiry_minutes
+        if payload.compress_uploads is not None:
+            current.setdefault("files", {}).setdefault("compression", {})["enabled"] = payload.compress_uploads
+        if payload.expired_share_action is not None:
+            current.setdefault("files", {}).setdefault("expiry", {})["action"] = payload.expired_share_action
+        if payload.download_offload is not None:
+            current.setdefault("files", {}).setdefault("offload", {})["mode"] = payload.download_offload
+        hashing = current.setdefault("security", {}).setdefault("password_hashing", {})
+        if payload.password_hash_scheme is not None:
+            hashing["scheme"] = payload.password_hash_scheme
+        if payload.password_hash_target_ms is not None:
+            hashing["target_ms"] = payload.password_hash_target_ms
+
+        save_yaml(SYSTEM_PATH, current)
+    # Re-benchmarks only if the scheme or target changed; stored hashes follow on next login.
+    calibrate_password_hashing()
+    return get_system_settings()
+
 
-    save_yaml(SYSTEM_PATH, current)
-    return current
+def recalibrate_hashing() -> Dict:
+    return calibrate_password_hashing(force=True)
 
 
 def _clean_directory(path: Path) -> None:
@@ -46,12 +67,12 @@ def _clean_directory(path: Path) -> None:
             child.unlink(missing_ok=True)  # type: ignore[arg-type]
 
 
-def reset_system(request: ResetRequest, current_username: str) -> Dict:
+async def reset_system(request: ResetRequest, current_username: str) -> Dict:
     phrase = "I want to reset my system"
     if request.confirmation.strip() != phrase:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Confirmation phrase mismatch")
 
-    if not users.authenticate_user(current_username, request.password):
+    if not await users.authenticate_user(current_username, request.password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Password incorrect")
 
     # reset configs
@@ -59,6 +80,9 @@ def reset_system(request: ResetRequest, current_username: str) -> Dict:
     save_yaml(CONFIG_DIR / "users.yaml", config.DEFAULT_USERS)
     save_yaml(CONFIG_DIR / "websites.yaml", config.DEFAULT_WEBSITES)
     save_yaml(CONFIG_DIR / "files.yaml", config.DEFAULT_FILES)
+    storage.reset_storage()
+    blobs.reset()
+    hot_cache.clear()
 
     # clean data directories
     for dir_path in [SITES_DIR, FILES_DIR, BACKUPS_DIR]:
@@ -66,6 +90,8 @@ def reset_system(request: ResetRequest, current_username: str) -> Dict:
 
     # re-init to regenerate secret and seed admin user
     config.init_config()
+    calibrate_password_hashing()
+    storage.init_storage()
     users.ensure_seed_user()
 
     return {"status": "reset", "message": "System restored to defaults. Seed admin recreated (admin/admin123)."}
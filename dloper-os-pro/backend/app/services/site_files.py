@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import stat
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Request, status
+from fastapi.responses import Response
+
+from ..core import locks
+from ..core.persistence import fsync_dir
+from ..models.website import FilePatch
+from ..utils import forms, http
+from . import assets, site_index, site_sync
+from .websites import resolve_site_path
+
+COPY_CHUNK = 8 * 1024 * 1024
+
+
+def _etag(path: Path) -> Optional[str]:
+    """Strong ETag of a site file, None if it does not exist. Writes always make a new inode, so it changes on every write."""
+    try:
+        info = path.stat()
+    except FileNotFoundError:
+        return None
+    if not stat.S_ISREG(info.st_mode):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Not a regular file")
+    return http.strong_etag(info)
+
+
+def read(site: Dict, relative_path: str, request: Request) -> Response:
+    target = resolve_site_path(site, relative_path)
+    if not target.is_file():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    return http.file_response(request, target)
+
+
+def _written(site: Dict, target: Path, relative_path: str, sha256: Optional[str] = None) -> Dict:
+    site_index.note_file(site, target)
+    if sha256:
+        site_sync.remember(site, target, sha256)
+    assets.pipeline.file_changed(site, target)
+    info = target.stat()
+    return {"path": relative_path, "size": info.st_size, "sha256": sha256, "etag": http.strong_etag(info)}
+
+
+async def write(site: Dict, relative_path: str, request: Request) -> Dict:
+    """Replace a file with the raw request body, streamed to a temp file and renamed into place.
+
+    If-Match is checked before the body is read and again, under the site lock, right before
+    the rename, so an edit based on an older version is refused rather than silently lost.
+    """
+    target = resolve_site_path(site, relative_path)
+    http.check_write_preconditions(request, _etag(target))
+    limit = forms.upload_limit_bytes()
+    if forms.declared_length(request) > limit:
+        raise forms.too_large()
+    forms.ensure_space(target.parent, forms.declared_length(request))
+    sink = await forms.AtomicFileSink(target).open()
+    try:
+        async for chunk in request.stream():
+            if sink.size + len(chunk) > limit:
+                raise forms.too_large()
+            await sink.write(chunk)
+        await sink.finish()
+        target = await asyncio.to_thread(_commit, site, relative_path, request, sink)
+    except BaseException:
+        sink.discard()
+        raise
+    return await asyncio.to_thread(_written, site, target, relative_path, sink.sha256)
+
+
+def _commit(site: Dict, relative_path: str, request: Request, sink: forms.AtomicFileSink) -> Path:
+    with locks.file_lock(f"site-{site['name']}"):
+        # Resolved again: a deploy may have switched releases while the body streamed in.
+        sink.dest = resolve_site_path(site, relative_path)
+        http.check_write_preconditions(request, _etag(sink.dest))
+        return sink.commit()
+
+
+def _edits(patch: FilePatch, size: int) -> List[Tuple[int, int, bytes]]:
+    """(offset, delete, data) in file order; offsets refer to the file before any edit."""
+    edits = sorted(((size if edit.offset is None else edit.offset, edit) for edit in patch.edits), key=lambda item: item[0])
+    result = []
+    end = 0
+    for offset, edit in edits:
+        if offset < end or offset + edit.delete > size:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Edit at offset {offset} overlaps another or runs past the end")
+        result.append((offset, edit.delete, edit.text.encode()))
+        end = offset + edit.delete
+    return result
+
+
+def _copy(source: int, dest: int, offset: int, count: int) -> None:
+    """Copy a byte range between files inside the kernel (a reflink on filesystems that have them)."""
+    while count > 0:
+        try:
+            copied = os.copy_file_range(source, dest, min(count, COPY_CHUNK), offset)
+        except OSError:
+            copied = _write_all(dest, os.pread(source, min(count, COPY_CHUNK), offset))
+        if not copied:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="The file shrank while it was patched")
+        offset += copied
+        count -= copied
+
+
+def _write_all(fd: int, data: bytes) -> int:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+    return len(data)
+
+
+def patch(site: Dict, relative_path: str, payload: FilePatch, request: Request) -> Dict:
+    """Apply byte-range edits and appends without sending the file either way.
+
+    The result is assembled in a new file, copying the untouched ranges from the old one, and
+    renamed into place: the old inode may be shared with other releases, so it is never
+    modified. Edits at explicit offsets need If-Match, since offsets only make sense against
+    the version the client read; pure appends do not.
+    """
+    if request.headers.get("if-match") is None and any(edit.offset is not None for edit in payload.edits):
+        raise HTTPException(status_code=status.HTTP_428_PRECONDITION_REQUIRED, detail="Edits at an offset need If-Match")
+    with locks.file_lock(f"site-{site['name']}"):
+        target = resolve_site_path(site, relative_path)
+        etag = _etag(target)
+        if etag is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+        http.check_write_preconditions(request, etag)
+        temp = target.with_name(f".{target.name}.{uuid.uuid4().hex[:8]}.upload")
+        source = os.open(target, os.O_RDONLY)
+        try:
+            edits = _edits(payload, os.fstat(source).st_size)
+            forms.ensure_space(target.parent, sum(len(data) for _, _, data in edits))
+            dest = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            try:
+                position = 0
+                for offset, delete, data in edits:
+                    _copy(source, dest, position, offset - position)
+                    _write_all(dest, data)
+                    position = offset + delete
+                _copy(source, dest, position, os.fstat(source).st_size - position)
+                os.fchmod(dest, stat.S_IMODE(os.fstat(source).st_mode))
+                os.fsync(dest)
+            finally:
+                os.close(dest)
+            os.replace(temp, target)
+        except BaseException:
+            temp.unlink(missing_ok=True)
+            raise
+        finally:
+            os.close(source)
+        fsync_dir(target.parent)
+    result = _written(site, target, relative_path)
+    result["edits"] = len(edits)
+    return result
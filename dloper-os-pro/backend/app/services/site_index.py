@@ -0,0 +1,394 @@
+from __future__ import annotations
+
+import base64
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+from ..core import db
+
+# Listings within this many seconds of the last check of the same subtree skip the stat pass.
+REFRESH_INTERVAL = 2.0
+SETTLE_NS = 2_000_000_000
+DEFAULT_PAGE = 200
+MAX_PAGE = 1000
+SORT_COLUMNS = {"name": "name", "size": "size", "modified": "mtime_ns"}
+
+_checked: Dict[Tuple[str, str], float] = {}
+_stats = {"full_scans": 0, "refreshes": 0, "dirs_checked": 0, "dirs_rescanned": 0}
+
+
+def _split(path: str) -> Tuple[str, str]:
+    parent, _, name = path.rpartition("/")
+    return parent, name
+
+
+def _join(parent: str, name: str) -> str:
+    return f"{parent}/{name}" if parent else name
+
+
+def _ancestors(path: str) -> Iterator[str]:
+    """`path` and every directory above it, excluding the root ("")."""
+    while path:
+        yield path
+        path = _split(path)[0]
+
+
+def _subtree(column: str, rel: str) -> Tuple[str, Tuple[str, ...]]:
+    if not rel:
+        return "1", ()
+    return f"({column} = ? OR {column} >= ? AND {column} < ?)", (rel, rel + "/", rel + "0")  # '0' sorts right after '/'
+
+
+def _is_temp(name: str) -> bool:
+    return name.startswith(".") and name.endswith(".upload")  # an AtomicFileSink still being written
+
+
+def _children(directory: Path) -> Dict[str, Tuple[bool, int, int]]:
+    """name -> (is_dir, size, mtime_ns). Symlinked directories are not followed."""
+    found: Dict[str, Tuple[bool, int, int]] = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if _is_temp(entry.name):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        found[entry.name] = (True, 0, entry.stat(follow_symlinks=False).st_mtime_ns)
+                    elif entry.is_file():
+                        info = entry.stat()
+                        found[entry.name] = (False, info.st_size, info.st_mtime_ns)
+                except OSError:
+                    continue  # vanished or a broken link
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return found
+
+
+def _dir_mtime(path: Path) -> Optional[int]:
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _settled(mtime_ns: Optional[int]) -> int:
+    """The mtime to remember for a directory just listed. A change in the same clock tick as the
+    listing would not move the mtime, so very recent directories are stored as "look again"."""
+    if mtime_ns is None or time.time_ns() - mtime_ns < SETTLE_NS:
+        return -1
+    return mtime_ns
+
+
+# (site_dirs rows, site_entries rows, bytes, files) of a subtree read from disk; rows leave out the site.
+Tree = Tuple[List[Tuple[Any, ...]], List[Tuple[Any, ...]], int, int]
+
+
+def _walk(root: Path, rel: str) -> Tree:
+    """Read the directory `rel` and everything below it from disk, without touching the database."""
+    directory = root / rel
+    dirs: List[Tuple[Any, ...]] = [(rel, _settled(_dir_mtime(directory)))]
+    entries: List[Tuple[Any, ...]] = []
+    total_size = total_files = 0
+    for name, (is_dir, size, mtime_ns) in _children(directory).items():
+        if is_dir:
+            sub_dirs, sub_entries, size, files = _walk(root, _join(rel, name))
+            dirs += sub_dirs
+            entries += sub_entries
+        else:
+            files = 1
+        entries.append((rel, name, int(is_dir), size, files, mtime_ns))
+        total_size += size
+        total_files += files
+    return dirs, entries, total_size, total_files
+
+
+def _store_tree(conn: sqlite3.Connection, site: str, tree: Tree) -> Tuple[int, int]:
+    """Write a walked subtree; returns its (bytes, files) totals."""
+    dirs, entries, size, files = tree
+    conn.executemany("INSERT OR REPLACE INTO site_dirs(site, path, mtime_ns) VALUES (?, ?, ?)", [(site, *row) for row in dirs])
+    conn.executemany(
+        "INSERT OR REPLACE INTO site_entries(site, parent, name, is_dir, size, files, mtime_ns) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(site, *row) for row in entries],
+    )
+    return size, files
+
+
+def _drop_tree(conn: sqlite3.Connection, site: str, rel: str) -> None:
+    for table, column in (("site_entries", "parent"), ("site_dirs", "path")):
+        clause, params = _subtree(column, rel)
+        conn.execute(f"DELETE FROM {table} WHERE site = ? AND {clause}", (site, *params))
+
+
+def _propagate(conn: sqlite3.Connection, site: str, rel: str, size: int, files: int) -> None:
+    """Carry a change in `rel`'s totals up to every ancestor directory's row."""
+    if not size and not files:
+        return
+    for path in _ancestors(rel):
+        parent, name = _split(path)
+        conn.execute(
+            "UPDATE site_entries SET size = size + ?, files = files + ? WHERE site = ? AND parent = ? AND name = ? AND is_dir = 1",
+            (size, files, site, parent, name),
+        )
+
+
+class _Listing:
+    """A directory read from disk ahead of the write transaction, with any subdirectories new to the index walked."""
+
+    def __init__(self, root: Path, site: str, rel: str, mtime_ns: Optional[int]) -> None:
+        self.root = root
+        self.mtime_ns = mtime_ns
+        self.current = _children(root / rel)
+        known = {
+            row["name"]
+            for row in db.connect().execute("SELECT name FROM site_entries WHERE site = ? AND parent = ? AND is_dir = 1", (site, rel))
+        }
+        self.trees = {
+            name: _walk(root, _join(rel, name)) for name, (is_dir, _, _) in self.current.items() if is_dir and name not in known
+        }
+
+    def tree(self, rel: str, name: str) -> Tree:
+        # Another worker may have changed the index since the listing; walk what it didn't expect.
+        return self.trees.get(name) or _walk(self.root, _join(rel, name))
+
+
+def _rescan_dir(conn: sqlite3.Connection, site: str, rel: str, listing: _Listing) -> None:
+    """Reconcile one directory's direct children with the disk; subdirectories keep their own rows."""
+    indexed = {
+        row["name"]: row
+        for row in conn.execute("SELECT name, is_dir, size, files, mtime_ns FROM site_entries WHERE site = ? AND parent = ?", (site, rel))
+    }
+    current = listing.current
+    size_delta = files_delta = 0
+    for name, row in indexed.items():
+        entry = current.get(name)
+        if entry is not None and bool(row["is_dir"]) == entry[0]:
+            continue
+        size_delta -= row["size"]
+        files_delta -= row["files"]
+        conn.execute("DELETE FROM site_entries WHERE site = ? AND parent = ? AND name = ?", (site, rel, name))
+        if row["is_dir"]:
+            _drop_tree(conn, site, _join(rel, name))
+    for name, (is_dir, size, entry_mtime) in current.items():
+        row = indexed.get(name)
+        if row is not None and bool(row["is_dir"]) == is_dir:
+            if row["mtime_ns"] == entry_mtime and (is_dir or row["size"] == size):
+                continue
+            if is_dir:  # totals belong to the subdirectory's own rescans
+                conn.execute(
+                    "UPDATE site_entries SET mtime_ns = ? WHERE site = ? AND parent = ? AND name = ?", (entry_mtime, site, rel, name)
+                )
+                continue
+            size_delta += size - row["size"]
+            files = 1
+        else:
+            files = 1
+            if is_dir:
+                size, files = _store_tree(conn, site, listing.tree(rel, name))
+            size_delta += size
+            files_delta += files
+        conn.execute(
+            "INSERT OR REPLACE INTO site_entries(site, parent, name, is_dir, size, files, mtime_ns) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (site, rel, name, int(is_dir), size, files, entry_mtime),
+        )
+    conn.execute("UPDATE site_dirs SET mtime_ns = ? WHERE site = ? AND path = ?", (_settled(listing.mtime_ns), site, rel))
+    _propagate(conn, site, rel, size_delta, files_delta)
+    _stats["dirs_rescanned"] += 1
+
+
+def _indexed(name: str) -> bool:
+    return db.connect().execute("SELECT 1 FROM site_dirs WHERE site = ? AND path = ''", (name,)).fetchone() is not None
+
+
+def refresh(site: Dict, rel: str = "", force: bool = False) -> None:
+    """Bring the index for `rel`'s subtree up to date with the disk.
+
+    The first call indexes the whole site. After that only directory mtimes are compared:
+    adding, removing or renaming an entry changes its directory's mtime, so only those
+    directories are listed again. A file rewritten in place keeps its directory's mtime;
+    writes through the API update the index directly (`note_file`).
+    """
+    name, root = site["name"], Path(site["root_path"])
+    key = (name, rel)
+    now = time.monotonic()
+    if not force and now - _checked.get(key, float("-inf")) < REFRESH_INTERVAL and _indexed(name):
+        return
+    root.mkdir(parents=True, exist_ok=True)
+    # Everything that touches the disk happens before the write transaction, which then only
+    # writes what changed, so a large site does not hold the database lock while it is read.
+    if not _indexed(name):
+        tree = _walk(root, "")
+        with db.transaction(immediate=True) as conn:
+            if conn.execute("SELECT 1 FROM site_dirs WHERE site = ? AND path = ''", (name,)).fetchone() is None:
+                _drop_tree(conn, name, "")
+                _store_tree(conn, name, tree)
+                _stats["full_scans"] += 1
+        _checked[key] = now
+        return
+    clause, params = _subtree("path", rel)
+    known = db.connect().execute(f"SELECT path, mtime_ns FROM site_dirs WHERE site = ? AND {clause}", (name, *params)).fetchall()
+    _stats["refreshes"] += 1
+    changed = []
+    for row in sorted(known, key=lambda row: row["path"]):
+        mtime_ns = _dir_mtime(root / row["path"])
+        _stats["dirs_checked"] += 1
+        if mtime_ns != row["mtime_ns"]:
+            changed.append((row["path"], mtime_ns))
+    listings: Dict[str, _Listing] = {}
+    for path, mtime_ns in changed:
+        if mtime_ns is None:
+            # Gone, or replaced by a file: reconcile it from its parent.
+            path = _split(path)[0]
+            mtime_ns = _dir_mtime(root / path)
+        if path not in listings:
+            listings[path] = _Listing(root, name, path, mtime_ns)
+    if changed:
+        with db.transaction(immediate=True) as conn:
+            for path, mtime_ns in changed:
+                if conn.execute("SELECT 1 FROM site_dirs WHERE site = ? AND path = ?", (name, path)).fetchone() is None:
+                    continue  # dropped along with a removed parent earlier in this pass
+                target = path if mtime_ns is not None else _split(path)[0]
+                _rescan_dir(conn, name, target, listings[target])
+    _checked[key] = now
+
+
+def note_file(site: Dict, path: Path) -> None:
+    """Record a file the API just wrote, so listings show it without waiting for a rescan."""
+    name, root = site["name"], Path(site["root_path"]).resolve()
+    try:
+        rel = path.resolve().relative_to(root).as_posix()
+    except ValueError:
+        return
+    parent, filename = _split(rel)
+    info = path.stat()
+    with db.transaction(immediate=True) as conn:
+        if conn.execute("SELECT 1 FROM site_dirs WHERE site = ? AND path = ''", (name,)).fetchone() is None:
+            return  # never listed; the first listing indexes everything
+        # Create rows for new directories; mtime 0 makes the next refresh look at them once.
+        for directory in reversed(list(_ancestors(parent))):
+            above, dirname = _split(directory)
+            if conn.execute(
+                "INSERT OR IGNORE INTO site_entries(site, parent, name, is_dir, size, files, mtime_ns) VALUES (?, ?, ?, 1, 0, 0, 0)",
+                (name, above, dirname),
+            ).rowcount:
+                conn.execute("INSERT OR IGNORE INTO site_dirs(site, path, mtime_ns) VALUES (?, ?, 0)", (name, directory))
+        row = conn.execute(
+            "SELECT size, is_dir FROM site_entries WHERE site = ? AND parent = ? AND name = ?", (name, parent, filename)
+        ).fetchone()
+        if row is not None and row["is_dir"]:
+            return  # a directory was replaced by a file outside the API; leave it to the rescan
+        conn.execute(
+            "INSERT OR REPLACE INTO site_entries(site, parent, name, is_dir, size, files, mtime_ns) VALUES (?, ?, ?, 0, ?, 1, ?)",
+            (name, parent, filename, info.st_size, info.st_mtime_ns),
+        )
+        _propagate(conn, name, parent, info.st_size - (row["size"] if row else 0), 0 if row else 1)
+
+
+def forget(name: str) -> None:
+    with db.transaction(immediate=True) as conn:
+        conn.execute("DELETE FROM site_entries WHERE site = ?", (name,))
+        conn.execute("DELETE FROM site_dirs WHERE site = ?", (name,))
+    for key in [key for key in _checked if key[0] == name]:
+        del _checked[key]
+
+
+def all_files(site: Dict) -> List[Dict]:
+    refresh(site)
+    rows = db.connect().execute("SELECT parent, name, size FROM site_entries WHERE site = ? AND is_dir = 0", (site["name"],))
+    return sorted(({"path": _join(row["parent"], row["name"]), "size": row["size"]} for row in rows), key=lambda item: item["path"])
+
+
+def _encode_cursor(values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> List[Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if isinstance(values, list) and len(values) == 3:
+            return values
+    except ValueError:
+        pass
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def _directory(raw: str) -> str:
+    parts = [part for part in raw.replace("\\", "/").split("/") if part not in ("", ".")]
+    if ".." in parts:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Path escapes the site root")
+    return "/".join(parts)
+
+
+def _iso(mtime_ns: int) -> str:
+    return datetime.fromtimestamp(mtime_ns / 1e9, tz=timezone.utc).isoformat()
+
+
+def list_dir(
+    site: Dict, path: str = "", cursor: Optional[str] = None, limit: int = DEFAULT_PAGE, sort: str = "name", order: str = "asc"
+) -> Dict:
+    """One page of a directory: subdirectories first (with their subtree totals), then files.
+
+    Pages are keyset-paginated: `next_cursor` encodes the last entry's sort key, so a page
+    costs the same at any depth into a large directory and survives concurrent inserts.
+    """
+    if sort not in SORT_COLUMNS or order not in ("asc", "desc"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unknown sort order")
+    rel = _directory(path)
+    refresh(site, rel)
+    name, column = site["name"], SORT_COLUMNS[sort]
+    conn = db.connect()
+    if rel and conn.execute("SELECT 1 FROM site_dirs WHERE site = ? AND path = ?", (name, rel)).fetchone() is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found")
+    limit = max(1, min(limit, MAX_PAGE))
+    direction, compare = ("ASC", ">") if order == "asc" else ("DESC", "<")
+    where, params = "site = ? AND parent = ?", [name, rel]
+    if cursor:
+        is_dir, key, last = _decode_cursor(cursor)
+        where += f" AND (is_dir < ? OR is_dir = ? AND ({column}, name) {compare} (?, ?))"
+        params += [is_dir, is_dir, key, last]
+    rows = conn.execute(
+        f"SELECT name, is_dir, size, files, mtime_ns FROM site_entries WHERE {where} "
+        f"ORDER BY is_dir DESC, {column} {direction}, name {direction} LIMIT ?",
+        (*params, limit + 1),
+    ).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    entries = []
+    for row in rows:
+        entry = {
+            "name": row["name"],
+            "path": _join(rel, row["name"]),
+            "type": "dir" if row["is_dir"] else "file",
+            "size": row["size"],
+            "modified": _iso(row["mtime_ns"]) if row["mtime_ns"] > 0 else None,
+        }
+        if row["is_dir"]:
+            entry["files"] = row["files"]
+        entries.append(entry)
+    if rel:
+        parent, dirname = _split(rel)
+        total = conn.execute(
+            "SELECT size, files FROM site_entries WHERE site = ? AND parent = ? AND name = ?", (name, parent, dirname)
+        ).fetchone()
+    else:
+        total = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) AS size, COALESCE(SUM(files), 0) AS files FROM site_entries WHERE site = ? AND parent = ''", (name,)
+        ).fetchone()
+    last = rows[-1] if rows else None
+    return {
+        "path": rel,
+        "size": total["size"] if total else 0,
+        "files": total["files"] if total else 0,
+        "entries": entries,
+        "next_cursor": _encode_cursor([last["is_dir"], last[column], last["name"]]) if more else None,
+    }
+
+
+def stats() -> Dict[str, Any]:
+    return dict(_stats)
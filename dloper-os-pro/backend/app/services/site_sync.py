@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import stat
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import HTTPException, Request, status
+
+from ..core import db
+from ..core.persistence import fsync_tree
+from ..models.website import SyncManifest
+from ..utils import forms
+from . import assets, deploys, site_index
+
+READ_CHUNK = 1024 * 1024
+# A plan must be applied within this long; after that the client plans again.
+PLAN_TTL_SECONDS = 3600
+
+
+def sync_path(raw: str) -> str:
+    parts = [part for part in raw.replace("\\", "/").split("/") if part not in ("", ".")]
+    if not parts or ".." in parts:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid path: {raw}")
+    return "/".join(parts)
+
+
+def _hash_file(path: Path) -> str:
+    hasher = hashlib.sha256()
+    with path.open("rb") as handle:
+        while chunk := handle.read(READ_CHUNK):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+REMEMBER_SQL = "INSERT OR REPLACE INTO site_hashes(site, path, size, mtime_ns, ino, sha256) VALUES (?, ?, ?, ?, ?, ?)"
+
+
+def _hash_row(site: Dict, path: Path, sha256: str) -> Optional[Tuple]:
+    root = Path(site["root_path"]).resolve()
+    try:
+        rel = path.resolve().relative_to(root).as_posix()
+    except ValueError:
+        return None
+    info = path.stat()
+    return (site["name"], rel, info.st_size, info.st_mtime_ns, info.st_ino, sha256)
+
+
+def remember(site: Dict, path: Path, sha256: str) -> None:
+    """Record the hash of a file the API just wrote, so it is never read back just to hash it."""
+    row = _hash_row(site, path, sha256)
+    if row is not None:
+        db.connect().execute(REMEMBER_SQL, row)
+
+
+def hashes(site: Dict, paths: Iterable[str]) -> Dict[str, Tuple[int, str]]:
+    """path -> (size, sha256) for the site's live files; missing files are left out.
+
+    Hashes are stored per site with the file's size, mtime and inode, and reused while those
+    still match, so only files changed since they were last seen are read. Release switches
+    keep hardlinked files' inodes, so their hashes carry over too.
+    """
+    name, root = site["name"], Path(site["root_path"]).resolve()
+    known = {
+        row["path"]: row
+        for row in db.connect().execute("SELECT path, size, mtime_ns, ino, sha256 FROM site_hashes WHERE site = ?", (name,))
+    }
+    found: Dict[str, Tuple[int, str]] = {}
+    rows = []
+    for rel in paths:
+        try:
+            info = (root / rel).stat()
+        except OSError:
+            continue
+        if not stat.S_ISREG(info.st_mode):
+            continue
+        row = known.get(rel)
+        if row is not None and (row["size"], row["mtime_ns"], row["ino"]) == (info.st_size, info.st_mtime_ns, info.st_ino):
+            found[rel] = (info.st_size, row["sha256"])
+            continue
+        digest = _hash_file(root / rel)
+        found[rel] = (info.st_size, digest)
+        rows.append((name, rel, info.st_size, info.st_mtime_ns, info.st_ino, digest))
+    if rows:
+        with db.transaction(immediate=True) as conn:
+            conn.executemany("INSERT OR REPLACE INTO site_hashes(site, path, size, mtime_ns, ino, sha256) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    return found
+
+
+def plan(site: Dict, manifest: SyncManifest) -> Dict:
+    """Compare a client manifest with the live site and answer with what has to be sent."""
+    limit = int(deploys.release_settings().get("max_files", 50_000))
+    if len(manifest.files) > limit:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"A manifest lists at most {limit} files")
+    wanted = {sync_path(raw): entry for raw, entry in manifest.files.items()}
+    server = _server_state(site, wanted)
+    upload = sorted(path for path, entry in wanted.items() if server.get(path) != (entry.size, entry.sha256))
+    delete: List[str] = []
+    if manifest.complete:
+        generated = assets.generated(site["name"])
+        delete = sorted(item["path"] for item in site_index.all_files(site) if item["path"] not in wanted and item["path"] not in generated)
+    plan_id = uuid.uuid4().hex
+    now = time.time()
+    data = {"upload": {path: wanted[path].sha256 for path in upload}, "delete": delete}
+    with db.transaction(immediate=True) as conn:
+        conn.execute("DELETE FROM sync_plans WHERE created_at < ?", (now - PLAN_TTL_SECONDS,))
+        conn.execute(
+            "INSERT INTO sync_plans(id, site, base, created_at, data) VALUES (?, ?, ?, ?, ?)",
+            (plan_id, site["name"], deploys.current_release(site), now, json.dumps(data)),
+        )
+    return {
+        "plan": plan_id,
+        "upload": upload,
+        "delete": delete,
+        "unchanged": len(wanted) - len(upload),
+        "upload_bytes": sum(wanted[path].size for path in upload),
+        "expires_at": int(now + PLAN_TTL_SECONDS),
+    }
+
+
+def _server_state(site: Dict, wanted: Dict) -> Dict[str, Tuple[int, str]]:
+    """Sizes are compared first; a file is only hashed when its size matches the manifest."""
+    root = Path(site["root_path"]).resolve()
+    same_size = []
+    for path, entry in wanted.items():
+        try:
+            if (root / path).stat().st_size == entry.size:
+                same_size.append(path)
+        except OSError:
+            continue
+    return hashes(site, same_size)
+
+
+def _claim(site: Dict, plan_id: str) -> Dict:
+    with db.transaction(immediate=True) as conn:
+        row = conn.execute("SELECT base, created_at, data FROM sync_plans WHERE id = ? AND site = ?", (plan_id, site["name"])).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM sync_plans WHERE id = ?", (plan_id,))
+    if row is None or row["created_at"] < time.time() - PLAN_TTL_SECONDS:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Sync plan not found or expired")
+    if row["base"] != deploys.current_release(site):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="The site changed since this plan was made; plan again")
+    return {**json.loads(row["data"]), "base": row["base"]}
+
+
+def _assemble(base: Path, staging: Path, skip: Set[str]) -> int:
+    """Fill the new release with every live file not replaced or deleted, as hardlinks."""
+    linked = 0
+    for directory, _, filenames in os.walk(base):
+        rel_dir = Path(directory).relative_to(base)
+        (staging / rel_dir).mkdir(parents=True, exist_ok=True)
+        for filename in filenames:
+            rel = (rel_dir / filename).as_posix()
+            if rel in skip or (staging / rel).exists():
+                continue
+            source = Path(directory) / filename
+            if source.is_symlink() or not source.is_file():
+                continue
+            try:
+                os.link(source, staging / rel)
+            except OSError:
+                shutil.copy2(source, staging / rel)
+            linked += 1
+    return linked
+
+
+def _delete_list(raw: Optional[str]) -> Set[str]:
+    try:
+        paths = json.loads(raw or "[]")
+    except ValueError:
+        paths = None
+    if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="`delete` must be a JSON list of paths")
+    return {sync_path(path) for path in paths}
+
+
+async def apply(site: Dict, plan_id: str, request: Request) -> Dict:
+    """Apply a plan: the multipart body carries one `upload` part per planned path (the part's
+    filename is the path) and optionally a `delete` field with a JSON list of paths. The result
+    becomes a new release, switched to in one step, so visitors see either all of it or none."""
+    started = time.monotonic()
+    planned = _claim(site, plan_id)
+    expected: Dict[str, str] = planned["upload"]
+    release_id = deploys.new_release_id()
+    staging = deploys.STAGING_DIR / f"{site['name']}-{release_id}"
+    staging.mkdir(parents=True)
+
+    async def open_sink(field: str, filename: str) -> forms.AtomicFileSink:
+        path = sync_path(filename)
+        if field != "upload" or path not in expected:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Not part of the plan: {filename}")
+        return await forms.AtomicFileSink(staging / path).open()
+
+    try:
+        forms.ensure_space(staging, forms.declared_length(request))
+        fields, parts = await forms.stream_form(request, open_sink, max_parts=len(expected) + forms.MAX_PARTS)
+        received: Dict[str, forms.AtomicFileSink] = {}
+        try:
+            for _, sink in parts:
+                path = sink.dest.relative_to(staging).as_posix()
+                if path in received or sink.sha256 != expected[path]:
+                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Content does not match the plan: {path}")
+                received[path] = sink
+            missing = sorted(set(expected) - set(received))
+            if missing:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={"message": "Planned files missing", "missing": missing})
+            delete = _delete_list(fields.get("delete"))
+            for sink in received.values():
+                await asyncio.to_thread(sink.commit)
+        except BaseException:
+            for _, sink in parts:
+                sink.discard()
+            raise
+        base = Path(site["root_path"]).resolve()
+        changed = delete | set(received)
+        # Variants of changed files would be stale; the asset pipeline makes new ones.
+        stale = {path + suffix for path in changed for suffix in assets.SUFFIXES.values()}
+        linked = await asyncio.to_thread(_assemble, base, staging, changed | stale)
+        await asyncio.to_thread(fsync_tree, staging)
+        pruned = await asyncio.to_thread(deploys.publish, site, staging, release_id, planned["base"])
+    except BaseException:
+        await asyncio.to_thread(shutil.rmtree, staging, True)
+        raise
+    live = Path(site["root_path"])
+    rows = [row for path, sink in received.items() if (row := _hash_row(site, live / path, sink.sha256)) is not None]
+    with db.transaction(immediate=True) as conn:
+        conn.executemany(REMEMBER_SQL, rows)
+        conn.executemany("DELETE FROM site_hashes WHERE site = ? AND path = ?", [(site["name"], path) for path in delete])
+    return {
+        "release": release_id,
+        "uploaded": len(received),
+        "uploaded_bytes": sum(sink.size for sink in received.values()),
+        "deleted": len(delete),
+        "linked": linked,
+        "pruned": pruned,
+        "seconds": round(time.monotonic() - started, 3),
+    }
+
+
+def forget(name: str) -> None:
+    with db.transaction(immediate=True) as conn:
+        conn.execute("DELETE FROM site_hashes WHERE site = ?", (name,))
+        conn.execute("DELETE FROM sync_plans WHERE site = ?", (name,))
@@ -5,6 +5,12 @@ from typing import Dict
 
 import psutil
 
+from ..core import config
+from ..utils.deps import principal_cache
+from ..utils.hotcache import hot_cache
+from ..utils.security import hash_pool
+from . import access_log, admission, analytics, assets, expiry, site_index
+
 
 def system_metrics() -> Dict:
     cpu = psutil.cpu_percent(interval=0.1)
@@ -32,3 +38,18 @@ def system_metrics() -> Dict:
         "temperature": temp_val,
         "network": network,
     }
+
+
+def runtime_stats() -> Dict:
+    return {
+        "config_cache": config.cache_stats(),
+        "analytics": analytics.stats(),
+        "access_log": access_log.ingester.stats(),
+        "password_hashing": hash_pool.stats(),
+        "principal_cache": principal_cache.stats(),
+        "share_expiry": expiry.sweeper.stats(),
+        "hot_cache": hot_cache.stats(),
+        "admission": admission.controller.stats(),
+        "site_index": site_index.stats(),
+        "site_assets": assets.pipeline.stats(),
+    }
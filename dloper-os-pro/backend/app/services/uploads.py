@@ -0,0 +1,297 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional
+
+import aiofiles
+from fastapi import HTTPException, status
+
+from ..core import db, locks
+from ..core.config import system_snapshot
+from ..core.paths import DATA_DIR
+from ..core.persistence import PUBLIC_FILE_MODE, fsync_dir
+from ..models.upload import UploadSessionCreate
+from ..utils import forms
+from ..utils.background import PeriodicTask, register
+from ..utils.security import hash_password_async
+from . import assets, blobs, files, site_index, websites
+
+UPLOADS_DIR = DATA_DIR / "uploads"
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+WRITE_BUFFER = 1024 * 1024
+# Sessions untouched for this long are dropped together with their partial data.
+SESSION_TTL_SECONDS = 24 * 3600
+GC_INTERVAL_SECONDS = 15 * 60
+
+
+def _part_path(session_id: str) -> Path:
+    return UPLOADS_DIR / f"{session_id}.part"
+
+
+def _chunk_count(size: int, chunk_size: int) -> int:
+    return -(-size // chunk_size)
+
+
+def _load(session_id: str, owner: str) -> Dict:
+    row = db.connect().execute("SELECT * FROM upload_sessions WHERE id = ?", (session_id,)).fetchone()
+    if not row or row["owner"] != owner:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found")
+    session = dict(row)
+    session["options"] = json.loads(session["options"])
+    return session
+
+
+def _describe(session: Dict) -> Dict:
+    rows = db.connect().execute("SELECT idx FROM upload_chunks WHERE session_id = ? ORDER BY idx", (session["id"],))
+    received = [row["idx"] for row in rows]
+    chunks = _chunk_count(session["size"], session["chunk_size"])
+    have = set(received)
+    return {
+        "id": session["id"],
+        "target": session["target"],
+        "filename": session["filename"],
+        "size": session["size"],
+        "chunk_size": session["chunk_size"],
+        "chunks": chunks,
+        "received": received,
+        "missing": [idx for idx in range(chunks) if idx not in have],
+        "created_at": dt.datetime.utcfromtimestamp(session["created_at"]).isoformat(),
+        "updated_at": dt.datetime.utcfromtimestamp(session["updated_at"]).isoformat(),
+    }
+
+
+def _session_limits() -> Dict:
+    return system_snapshot().get("uploads", {}).get("sessions", {})
+
+
+def _admit(owner: str, size: int) -> None:
+    """Open sessions hold their full size on disk for up to a day, so they are capped per owner and
+    overall, and a new one must leave `reserve_mb` free. Call with the `upload-sessions` lock held."""
+    limits = _session_limits()
+    mib = 1024 * 1024
+    row = db.connect().execute(
+        "SELECT COUNT(*) AS sessions, COALESCE(SUM(size), 0) AS reserved, "
+        "COALESCE(SUM(CASE WHEN owner = ? THEN 1 ELSE 0 END), 0) AS owner_sessions, "
+        "COALESCE(SUM(CASE WHEN owner = ? THEN size ELSE 0 END), 0) AS owner_reserved FROM upload_sessions",
+        (owner, owner),
+    ).fetchone()
+    if row["owner_sessions"] >= int(limits.get("max_per_user", 8)):
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many open upload sessions; complete or abort one first")
+    if row["owner_reserved"] + size > int(limits.get("max_user_mb", 16384)) * mib:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Open upload sessions exceed your reserved space")
+    if row["sessions"] >= int(limits.get("max_sessions", 64)) or row["reserved"] + size > int(limits.get("max_total_mb", 65536)) * mib:
+        raise HTTPException(status_code=status.HTTP_507_INSUFFICIENT_STORAGE, detail="Upload capacity exhausted; try again later")
+    if shutil.disk_usage(UPLOADS_DIR).free - size < int(limits.get("reserve_mb", 512)) * mib:
+        raise HTTPException(status_code=status.HTTP_507_INSUFFICIENT_STORAGE, detail="Not enough disk space")
+
+
+def _preallocate(path: Path, size: int) -> None:
+    fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        if size:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):
+                os.ftruncate(fd, size)  # sparse fallback (e.g. filesystems without fallocate)
+    finally:
+        os.close(fd)
+
+
+async def create_session(payload: UploadSessionCreate, owner: str) -> Dict:
+    filename = Path(payload.filename).name
+    if not filename or filename != payload.filename:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid filename")
+    chunk_size = payload.chunk_size or DEFAULT_CHUNK_SIZE
+    if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Chunk size out of range")
+    if payload.size > forms.upload_limit_bytes():
+        raise forms.too_large()
+
+    if payload.target == "site":
+        site = websites.get_site(payload.site or "")
+        if not site:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+        relative_path = payload.path or filename
+        websites.resolve_site_path(site, relative_path)
+        options = {"site": site["name"], "path": relative_path}
+    else:
+        options = {
+            "password_hash": await hash_password_async(payload.password) if payload.password else None,
+            "max_downloads": payload.max_downloads,
+            "expires_at": payload.expires_at.isoformat() if payload.expires_at else None,
+        }
+
+    session_id = uuid.uuid4().hex
+    UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+    now = time.time()
+    session = {
+        "id": session_id,
+        "owner": owner,
+        "target": payload.target,
+        "filename": filename,
+        "size": payload.size,
+        "chunk_size": chunk_size,
+        "options": options,
+        "created_at": now,
+        "updated_at": now,
+    }
+    await asyncio.to_thread(_open, session)
+    return _describe(session)
+
+
+def _open(session: Dict) -> None:
+    # One lock around admission, preallocation and the insert, so concurrent creates cannot oversubscribe.
+    with locks.file_lock("upload-sessions"):
+        _admit(session["owner"], session["size"])
+        try:
+            _preallocate(_part_path(session["id"]), session["size"])
+        except OSError as exc:
+            _part_path(session["id"]).unlink(missing_ok=True)
+            raise HTTPException(status_code=status.HTTP_507_INSUFFICIENT_STORAGE, detail="Not enough disk space") from exc
+        with db.transaction(immediate=True) as conn:
+            conn.execute(
+                "INSERT INTO upload_sessions(id, owner, target, filename, size, chunk_size, options, created_at, updated_at) "
+                "VALUES (:id, :owner, :target, :filename, :size, :chunk_size, :options, :created_at, :updated_at)",
+                {**session, "options": json.dumps(session["options"])},
+            )
+
+
+def get_session(session_id: str, owner: str) -> Dict:
+    return _describe(_load(session_id, owner))
+
+
+async def write_chunk(
+    session_id: str, index: int, owner: str, body: AsyncIterator[bytes], sha256: Optional[str] = None
+) -> Dict:
+    """Write chunk `index` in place at its offset; chunks may arrive in any order and in parallel."""
+    session = _load(session_id, owner)
+    if not 0 <= index < _chunk_count(session["size"], session["chunk_size"]):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Chunk index out of range")
+    start = index * session["chunk_size"]
+    expected = min(session["chunk_size"], session["size"] - start)
+    hasher = hashlib.sha256()
+    written = 0
+    buffer = bytearray()
+    try:
+        async with aiofiles.open(_part_path(session_id), "r+b") as handle:
+            await handle.seek(start)
+            async for piece in body:
+                written += len(piece)
+                if written > expected:
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Chunk larger than expected")
+                hasher.update(piece)
+                buffer += piece
+                if len(buffer) >= WRITE_BUFFER:
+                    await handle.write(bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await handle.write(bytes(buffer))
+            await handle.flush()
+            await asyncio.to_thread(os.fdatasync, handle.fileno())
+    except FileNotFoundError as exc:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found") from exc
+    if written != expected:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Chunk must be {expected} bytes")
+    if sha256 and hasher.hexdigest() != sha256.lower():
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Chunk checksum mismatch")
+
+    with db.transaction(immediate=True) as conn:
+        conn.execute("INSERT OR IGNORE INTO upload_chunks(session_id, idx) VALUES (?, ?)", (session_id, index))
+        conn.execute("UPDATE upload_sessions SET updated_at = ? WHERE id = ?", (time.time(), session_id))
+    return {"index": index, "size": written, "sha256": hasher.hexdigest()}
+
+
+def _move(source: Path, dest: Path) -> None:
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    os.chmod(source, PUBLIC_FILE_MODE)  # parts are private while they fill; the site's web server must read the result
+    try:
+        os.replace(source, dest)  # same filesystem: a rename, no second copy
+    except OSError:
+        shutil.move(str(source), str(dest))
+    fsync_dir(dest.parent)
+
+
+async def complete_session(session_id: str, owner: str, base_url: str) -> Dict:
+    session = _load(session_id, owner)
+    missing = _describe(session)["missing"]
+    if missing:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail={"message": "Upload incomplete", "missing": missing})
+    options = session["options"]
+    if session["target"] == "site":
+        site = websites.get_site(options["site"])
+        if not site:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+        dest = websites.resolve_site_path(site, options["path"])
+
+    # Claim the session so a concurrent completion cannot move the same data twice.
+    with db.transaction(immediate=True) as conn:
+        claimed = conn.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,)).rowcount
+    if not claimed:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found")
+
+    part = _part_path(session_id)
+    if session["target"] == "site":
+        await asyncio.to_thread(_move, part, dest)
+        await asyncio.to_thread(site_index.note_file, site, dest)
+        assets.pipeline.file_changed(site, dest)
+        return {"path": options["path"], "size": session["size"]}
+    digest, size, source, encoding = await asyncio.to_thread(blobs.prepare_file, part, session["filename"])
+    dest = await asyncio.to_thread(blobs.adopt, source, digest, size, encoding)
+    part.unlink(missing_ok=True)
+    return files.add_shared_file(
+        uuid.uuid4().hex[:12],
+        session["filename"],
+        dest,
+        owner,
+        base_url,
+        password_hash=options.get("password_hash"),
+        max_downloads=options.get("max_downloads"),
+        expires_at=options.get("expires_at"),
+        sha256=digest,
+        size=size,
+    )
+
+
+def abort_session(session_id: str, owner: str) -> None:
+    _load(session_id, owner)
+    with db.transaction(immediate=True) as conn:
+        conn.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+    _part_path(session_id).unlink(missing_ok=True)
+
+
+def collect_stale(now: Optional[float] = None) -> int:
+    now = now or time.time()
+    with db.transaction(immediate=True) as conn:
+        stale = [row["id"] for row in conn.execute("SELECT id FROM upload_sessions WHERE updated_at < ?", (now - SESSION_TTL_SECONDS,))]
+        conn.executemany("DELETE FROM upload_sessions WHERE id = ?", [(session_id,) for session_id in stale])
+        live = {row["id"] for row in conn.execute("SELECT id FROM upload_sessions")}
+    removed = 0
+    if UPLOADS_DIR.exists():
+        for part in UPLOADS_DIR.glob("*.part"):
+            if part.stem in live:
+                continue
+            try:
+                # Orphans (e.g. left by a crash mid-completion) get the same grace period.
+                if part.stem in stale or part.stat().st_mtime < now - SESSION_TTL_SECONDS:
+                    part.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+    return removed
+
+
+def _tick() -> None:
+    collect_stale()  # its count is not a delay for PeriodicTask
+
+
+collector = register(PeriodicTask("upload-gc", GC_INTERVAL_SECONDS, _tick))
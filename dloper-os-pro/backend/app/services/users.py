@@ -1,16 +1,24 @@
 from __future__ import annotations
 
+import asyncio
 import datetime as dt
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set
 
-from ..core import config
-from ..core.config import CONFIG_DIR, save_yaml
-from ..utils.security import hash_password, verify_password
+from fastapi import HTTPException
 
-USERS_PATH = CONFIG_DIR / "users.yaml"
+from ..core import storage
+from ..utils.security import (
+    hash_password,
+    hash_password_async,
+    hashing_params,
+    needs_rehash,
+    verify_password_async,
+)
 
 UserRecord = Dict[str, str]
 
+_rehash_tasks: Set[asyncio.Task] = set()
+
 
 def _sanitize(user: UserRecord) -> UserRecord:
     clean = user.copy()
@@ -19,12 +27,11 @@ def _sanitize(user: UserRecord) -> UserRecord:
 
 
 def load_users() -> List[UserRecord]:
-    data = config.get_users_config()
-    return data.get("users", [])
+    return storage.users.all()
 
 
 def save_users(users: List[UserRecord]) -> None:
-    save_yaml(USERS_PATH, {"users": users})
+    storage.users.replace_all(users)
 
 
 def ensure_seed_user() -> UserRecord:
@@ -35,42 +42,56 @@ def ensure_seed_user() -> UserRecord:
         "username": "admin",
         "email": "admin@example.com",
         "role": "owner",
-        "password_hash": hash_password("admin123"),
+        "password_hash": hash_password("admin123", hashing_params()),
         "created_at": dt.datetime.utcnow().isoformat(),
     }
-    save_users([admin_user])
+    storage.users.insert(admin_user)
     return admin_user
 
 
 def get_user_by_username(username: str) -> Optional[UserRecord]:
-    for user in load_users():
-        if user.get("username") == username:
-            return user
-    return None
+    return storage.users.get(username)
 
 
-def authenticate_user(username: str, password: str) -> Optional[UserRecord]:
+async def authenticate_user(username: str, password: str) -> Optional[UserRecord]:
     user = get_user_by_username(username)
     if not user:
         return None
-    if not verify_password(password, user.get("password_hash", "")):
+    if not await verify_password_async(password, user.get("password_hash", "")):
         return None
+    if needs_rehash(user["password_hash"], hashing_params()):
+        task = asyncio.create_task(_rehash(username, password, user["password_hash"]))
+        _rehash_tasks.add(task)
+        task.add_done_callback(_rehash_tasks.discard)
     return user
 
 
-def create_user(username: str, email: str, role: str, password: str) -> UserRecord:
-    users = load_users()
-    if any(u.get("username") == username for u in users):
+async def _rehash(username: str, password: str, old_hash: str) -> None:
+    """Bring a stored hash up to the calibrated parameters after a successful login."""
+    try:
+        new_hash = await hash_password_async(password)
+    except HTTPException:
+        return  # hashing pool is saturated; the next login retries
+
+    def apply(user: UserRecord) -> None:
+        if user.get("password_hash") == old_hash:
+            user["password_hash"] = new_hash
+
+    storage.users.update(username, apply)
+
+
+async def create_user(username: str, email: str, role: str, password: str) -> UserRecord:
+    if storage.users.get(username):
         raise ValueError("User already exists")
     record: UserRecord = {
         "username": username,
         "email": email,
         "role": role,
-        "password_hash": hash_password(password),
+        "password_hash": await hash_password_async(password),
         "created_at": dt.datetime.utcnow().isoformat(),
     }
-    users.append(record)
-    save_users(users)
+    if not storage.users.insert(record):
+        raise ValueError("User already exists")
     return record
 
 
@@ -81,26 +102,16 @@ def list_users(safe: bool = True) -> List[UserRecord]:
     return users
 
 
-def update_user(username: str, payload: Dict[str, str]) -> Optional[UserRecord]:
-    users = load_users()
-    updated: Optional[UserRecord] = None
-    for idx, user in enumerate(users):
-        if user.get("username") == username:
-            user.update({k: v for k, v in payload.items() if k in {"email", "role"}})
-            if password := payload.get("password"):
-                user["password_hash"] = hash_password(password)
-            updated = user
-            users[idx] = user
-            break
-    if updated:
-        save_users(users)
-    return updated
+async def update_user(username: str, payload: Dict[str, str]) -> Optional[UserRecord]:
+    password_hash = await hash_password_async(payload["password"]) if payload.get("password") else None
+
+    def apply(user: UserRecord) -> None:
+        user.update({k: v for k, v in payload.items() if k in {"email", "role"}})
+        if password_hash:
+            user["password_hash"] = password_hash
+
+    return storage.users.update(username, apply)
 
 
 def delete_user(username: str) -> bool:
-    users = load_users()
-    remaining = [u for u in users if u.get("username") != username]
-    if len(remaining) == len(users):
-        return False
-    save_users(remaining)
-    return True
+    return storage.users.delete(username) is not None
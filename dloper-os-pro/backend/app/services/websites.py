@@ -1,133 +1,140 @@
 from __future__ import annotations
 
+import asyncio
 from pathlib import Path
 from typing import Dict, List, Optional
 
-import aiofiles
-from fastapi import UploadFile
+from fastapi import HTTPException, Request, status
 
-from ..core import config
-from ..core.config import CONFIG_DIR, save_yaml
+from ..core import storage
 from ..core.paths import SITES_DIR
+from ..core.persistence import atomic_write
 from ..models.website import WebsiteCreate, WebsiteUpdate
-
-WEBSITES_PATH = CONFIG_DIR / "websites.yaml"
+from ..utils import forms
+from . import access_log, analytics, assets, site_index, site_sync
 
 
 def load_sites() -> List[Dict]:
-    data = config.get_websites_config()
-    return data.get("websites", [])
+    return storage.sites.all()
 
 
 def save_sites(sites: List[Dict]) -> None:
-    save_yaml(WEBSITES_PATH, {"websites": sites})
+    storage.sites.replace_all(sites)
 
 
 def list_sites() -> List[Dict]:
     return load_sites()
 
 
+def get_site(name: str) -> Optional[Dict]:
+    return storage.sites.get(name)
+
+
+def find_site_by_domain(domain: str) -> Optional[Dict]:
+    matches = storage.sites.find("domains", domain.lower())
+    return matches[0] if matches else None
+
+
 def add_site(payload: WebsiteCreate) -> Dict:
-    sites = load_sites()
-    if any(site.get("name") == payload.name for site in sites):
+    if storage.sites.get(payload.name):
         raise ValueError("Site already exists")
     root_path = str(SITES_DIR / payload.name)
     Path(root_path).mkdir(parents=True, exist_ok=True)
     entry = {
         "name": payload.name,
         "root_path": root_path,
-        "domains": payload.domains,
+        "domains": [domain.lower() for domain in payload.domains],
         "ssl_enabled": payload.ssl_enabled,
         "upstream": payload.upstream,
         "analytics": {"requests": 0, "errors": 0, "bandwidth_mb": 0.0},
     }
-    sites.append(entry)
-    save_sites(sites)
+    if not storage.sites.insert(entry):
+        raise ValueError("Site already exists")
     return entry
 
 
 def update_site(name: str, payload: WebsiteUpdate) -> Optional[Dict]:
-    sites = load_sites()
-    updated_site: Optional[Dict] = None
-    for idx, site in enumerate(sites):
-        if site.get("name") == name:
-            if payload.domains is not None:
-                site["domains"] = payload.domains
-            if payload.ssl_enabled is not None:
-                site["ssl_enabled"] = payload.ssl_enabled
-            if payload.upstream is not None:
-                site["upstream"] = payload.upstream
-            sites[idx] = site
-            updated_site = site
-            break
-    if updated_site:
-        save_sites(sites)
-    return updated_site
+    def apply(site: Dict) -> None:
+        if payload.domains is not None:
+            site["domains"] = [domain.lower() for domain in payload.domains]
+        if payload.ssl_enabled is not None:
+            site["ssl_enabled"] = payload.ssl_enabled
+        if payload.upstream is not None:
+            site["upstream"] = payload.upstream
+
+    return storage.sites.update(name, apply)
 
 
 def delete_site(name: str) -> bool:
-    sites = load_sites()
-    remaining = [s for s in sites if s.get("name") != name]
-    if len(remaining) == len(sites):
+    if storage.sites.delete(name) is None:
         return False
-    save_sites(remaining)
+    analytics.forget(name)
+    access_log.ingester.forget(name)
+    site_index.forget(name)
+    site_sync.forget(name)
+    assets.forget(name)
     return True
 
 
 def record_analytics(name: str, bandwidth_mb: float = 0.0, error: bool = False) -> None:
-    sites = load_sites()
-    changed = False
-    for idx, site in enumerate(sites):
-        if site.get("name") == name:
-            analytics = site.setdefault("analytics", {"requests": 0, "errors": 0, "bandwidth_mb": 0.0})
-            analytics["requests"] = analytics.get("requests", 0) + 1
-            analytics["bandwidth_mb"] = analytics.get("bandwidth_mb", 0.0) + bandwidth_mb
-            if error:
-                analytics["errors"] = analytics.get("errors", 0) + 1
-            site["analytics"] = analytics
-            sites[idx] = site
-            changed = True
-            break
-    if changed:
-        save_sites(sites)
+    # Counted in memory; lifetime totals and time buckets are written by the periodic analytics flush.
+    analytics.record(name, bandwidth_mb=bandwidth_mb, error=error)
+
+
+def resolve_site_path(site: Dict, relative_path: str) -> Path:
+    root = Path(site["root_path"]).resolve()
+    target = (root / relative_path.lstrip("/")).resolve()
+    if target == root or root not in target.parents:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Path escapes the site root")
+    return target
 
 
 def list_site_files(name: str) -> Optional[List[Dict]]:
-    site = next((s for s in load_sites() if s.get("name") == name), None)
+    site = get_site(name)
     if not site:
         return None
-    root = Path(site["root_path"])
-    if not root.exists():
-        root.mkdir(parents=True, exist_ok=True)
-    files: List[Dict] = []
-    for path in root.rglob("*"):
-        if path.is_file():
-            rel = path.relative_to(root).as_posix()
-            files.append({"path": rel, "size": path.stat().st_size})
-    return files
-
-
-async def upload_site_file(name: str, relative_path: str, upload: UploadFile) -> Dict:
-    site = next((s for s in load_sites() if s.get("name") == name), None)
+    return site_index.all_files(site)
+
+
+def browse_site_files(
+    name: str, path: str = "", cursor: Optional[str] = None, limit: int = site_index.DEFAULT_PAGE, sort: str = "name", order: str = "asc"
+) -> Optional[Dict]:
+    site = get_site(name)
+    if not site:
+        return None
+    return site_index.list_dir(site, path, cursor=cursor, limit=limit, sort=sort, order=order)
+
+
+async def upload_site_file(name: str, relative_path: str, request: Request) -> Dict:
+    """Stream the `upload` part of a multipart request next to its destination, then rename it into place."""
+    site = get_site(name)
     if not site:
         raise FileNotFoundError("site")
-    root = Path(site["root_path"])
-    target = (root / relative_path).parent
-    target.mkdir(parents=True, exist_ok=True)
-    dest = root / relative_path
-    async with aiofiles.open(dest, "wb") as outfile:
-        while chunk := await upload.read(1024 * 1024):
-            await outfile.write(chunk)
-    await upload.close()
-    return {"path": relative_path, "size": dest.stat().st_size}
+    dest = resolve_site_path(site, relative_path)
+    forms.ensure_space(dest.parent, forms.declared_length(request))
+
+    async def open_sink(field: str, filename: str) -> forms.AtomicFileSink:
+        return await forms.AtomicFileSink(dest).open()
+
+    _, sink = await forms.receive_file(request, open_sink)
+    try:
+        await asyncio.to_thread(sink.commit)
+    except BaseException:
+        sink.discard()
+        raise
+    await asyncio.to_thread(site_index.note_file, site, dest)
+    site_sync.remember(site, dest, sink.sha256)
+    assets.pipeline.file_changed(site, dest)
+    return {"path": relative_path, "size": sink.size, "sha256": sink.sha256}
 
 
 def save_site_file(name: str, relative_path: str, content: str) -> Dict:
-    site = next((s for s in load_sites() if s.get("name") == name), None)
+    site = get_site(name)
     if not site:
         raise FileNotFoundError("site")
-    root = Path(site["root_path"])
-    target = root / relative_path
-    target.parent.mkdir(parents=True, exist_ok=True)
-    target.write_text(content)
+    target = resolve_site_path(site, relative_path)
+    # Replaced, never rewritten in place: deployed releases share unchanged files through hardlinks.
+    atomic_write(target, content.encode())
+    site_index.note_file(site, target)
+    assets.pipeline.file_changed(site, target)
     return {"path": relative_path, "size": target.stat().st_size}
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import logging
+import threading
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """Runs `func` every `interval` seconds on a daemon thread until stopped.
+
+    `func` may return a number of seconds to override the wait before its next run.
+    """
+
+    def __init__(self, name: str, interval: float, func: Callable[[], Optional[float]], run_on_stop: bool = False) -> None:
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.run_on_stop = run_on_stop
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        if self.run_on_stop:
+            self._call()
+
+    def _call(self) -> Optional[float]:
+        try:
+            return self.func()
+        except Exception:  # pragma: no cover - keep the loop alive
+            logger.exception("Background task %s failed", self.name)
+            return None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            delay = self._call()
+            self._wake.wait(self.interval if delay is None else max(delay, 0.0))
+            self._wake.clear()
+
+
+_tasks: List[PeriodicTask] = []
+
+
+def register(task: PeriodicTask) -> PeriodicTask:
+    _tasks.append(task)
+    return task
+
+
+def start_all() -> None:
+    for task in _tasks:
+        task.start()
+
+
+def stop_all() -> None:
+    for task in reversed(_tasks):
+        task.stop()
@@ -1,38 +1,144 @@
 from __future__ import annotations
 
-from typing import Callable, Dict, Optional
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, Header, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 
+from ..core import storage
+from ..core.config import system_snapshot
 from ..services import users
 from ..utils.security import decode_access_token
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login", auto_error=False)
 
+PRINCIPAL_CACHE_SIZE = 1024
 
-def get_optional_user(token: Optional[str] = Depends(oauth2_scheme)) -> Optional[Dict]:
-    if not token:
-        return None
+
+class PrincipalCache:
+    """Token digest -> sanitized user, valid until the token's `exp`.
+
+    Entries are dropped wholesale whenever any user changes (shared generation counter,
+    so other workers' edits count too) or the signing secret changes.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[bytes, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._validity: Tuple[int, Optional[str]] = (-1, None)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+    @staticmethod
+    def validity() -> Tuple[int, Optional[str]]:
+        return storage.users.generation(), system_snapshot().get("security", {}).get("secret_key")
+
+    def _check_validity(self) -> None:
+        validity = self.validity()
+        if validity != self._validity:
+            self._entries.clear()
+            self._validity = validity
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        digest = self._digest(token)
+        with self._lock:
+            self._check_validity()
+            entry = self._entries.get(digest)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[digest]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, token: str, expires_at: float, principal: Dict[str, Any], seen: Tuple[int, Optional[str]]) -> None:
+        """`seen` is `validity()` from before the user was looked up; if a user changed since, the
+        principal may already be stale and is not cached."""
+        digest = self._digest(token)
+        with self._lock:
+            self._check_validity()
+            if seen != self._validity:
+                return
+            self._entries[digest] = (expires_at, dict(principal))
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+        }
+
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_SIZE)
+
+
+def _resolve_principal(token: str, required: bool) -> Optional[Dict]:
+    cached = principal_cache.get(token)
+    if cached is not None:
+        return cached
+    seen = principal_cache.validity()
     payload = decode_access_token(token)
     username = payload.get("sub")
     if not username:
+        if required:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
         return None
     user = users.get_user_by_username(username)
-    return users._sanitize(user) if user else None  # type: ignore[attr-defined]
+    if not user:
+        if required:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+        return None
+    principal = users._sanitize(user)  # type: ignore[attr-defined]
+    if payload.get("exp"):
+        principal_cache.put(token, float(payload["exp"]), principal, seen)
+    return principal
+
+
+def get_optional_user(token: Optional[str] = Depends(oauth2_scheme)) -> Optional[Dict]:
+    if not token:
+        return None
+    return _resolve_principal(token, required=False)
 
 
 def get_current_user(token: Optional[str] = Depends(oauth2_scheme)) -> Dict:
     if not token:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    payload = decode_access_token(token)
-    username = payload.get("sub")
-    if not username:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    user = users.get_user_by_username(username)
-    if not user:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    return users._sanitize(user)  # type: ignore[attr-defined]
+    return _resolve_principal(token, required=True)  # type: ignore[return-value]
+
+
+def _ingest_token() -> str:
+    return str(system_snapshot().get("analytics", {}).get("ingest_token") or "")
+
+
+def require_ingest_access(token: Optional[str] = Depends(oauth2_scheme), x_ingest_token: Optional[str] = Header(None)) -> None:
+    """A signed-in user, or the shared `analytics.ingest_token` (for log shippers and edge proxies)."""
+    expected = _ingest_token()
+    if expected and x_ingest_token and hmac.compare_digest(x_ingest_token.encode(), expected.encode()):
+        return
+    get_current_user(token)
+
+
+def require_ingest_token_if_set(token: Optional[str] = Depends(oauth2_scheme), x_ingest_token: Optional[str] = Header(None)) -> None:
+    """For the public beacon endpoint: open as it always was, unless `analytics.ingest_token` is configured."""
+    if _ingest_token():
+        require_ingest_access(token, x_ingest_token)
 
 
 def require_role(*roles: str) -> Callable[[Dict], Dict]:
@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import asyncio
+import errno
+import hashlib
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import IO, Awaitable, Callable, Dict, List, Optional, Protocol, Tuple
+
+from fastapi import HTTPException, Request, status
+from multipart.multipart import MultipartParser, parse_options_header
+
+from ..core.config import system_snapshot
+from ..core.persistence import fsync_dir
+
+WRITE_BUFFER = 1024 * 1024
+MAX_FIELD_BYTES = 64 * 1024
+MAX_PARTS = 32
+
+
+class FileSink(Protocol):
+    """Where a streamed file part goes. `finish` seals it; `discard` removes whatever was written."""
+
+    size: int
+
+    async def write(self, data: bytes) -> None: ...
+
+    async def finish(self) -> None: ...
+
+    def discard(self) -> None: ...
+
+
+SinkOpener = Callable[[str, str], Awaitable[FileSink]]
+
+
+def upload_limit_bytes() -> int:
+    return int(system_snapshot().get("uploads", {}).get("max_file_mb", 4096)) * 1024 * 1024
+
+
+def too_large() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Upload exceeds the size limit")
+
+
+def ensure_space(directory: Path, needed: int) -> None:
+    """Refuse up front when the declared upload cannot fit, instead of failing with a full disk."""
+    directory.mkdir(parents=True, exist_ok=True)
+    if needed and shutil.disk_usage(directory).free < needed:
+        raise HTTPException(status_code=status.HTTP_507_INSUFFICIENT_STORAGE, detail="Not enough disk space")
+
+
+def declared_length(request: Request) -> int:
+    try:
+        return int(request.headers.get("content-length", "0"))
+    except ValueError:
+        return 0
+
+
+def _seal(handle: IO[bytes], tail: bytes) -> None:
+    """Write the last bytes and make the file durable before it is renamed into place."""
+    with handle:
+        handle.write(tail)
+        handle.flush()
+        os.fsync(handle.fileno())
+
+
+class AtomicFileSink:
+    """Writes next to `dest` (same directory, so same filesystem) and renames into place on commit."""
+
+    def __init__(self, dest: Path) -> None:
+        self.dest = dest
+        self.temp = dest.with_name(f".{dest.name}.{uuid.uuid4().hex[:8]}.upload")
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self._buffer = bytearray()
+        self._file: Optional[IO[bytes]] = None
+
+    @property
+    def sha256(self) -> str:
+        return self.hasher.hexdigest()
+
+    async def open(self) -> "AtomicFileSink":
+        self.dest.parent.mkdir(parents=True, exist_ok=True)
+        self._file = self.temp.open("wb")
+        return self
+
+    async def write(self, data: bytes) -> None:
+        self.hasher.update(data)
+        self.size += len(data)
+        self._buffer += data
+        if len(self._buffer) >= WRITE_BUFFER:
+            await asyncio.to_thread(self._file.write, bytes(self._buffer))
+            self._buffer.clear()
+
+    async def finish(self) -> None:
+        if self._file is None:
+            return
+        await asyncio.to_thread(_seal, self._file, bytes(self._buffer))
+        self._buffer.clear()
+        self._file = None
+
+    def commit(self) -> Path:
+        os.replace(self.temp, self.dest)
+        fsync_dir(self.dest.parent)
+        return self.dest
+
+    def discard(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.temp.unlink(missing_ok=True)
+
+
+def _content_disposition(headers: Dict[bytes, bytes]) -> Tuple[str, Optional[str]]:
+    _, options = parse_options_header(headers.get(b"content-disposition", b""))
+    name = options.get(b"name", b"").decode("utf-8", "replace")
+    filename = options.get(b"filename")
+    return name, filename.decode("utf-8", "replace") if filename is not None else None
+
+
+async def stream_form(
+    request: Request, open_sink: SinkOpener, max_file_bytes: Optional[int] = None, max_parts: int = MAX_PARTS
+) -> Tuple[Dict[str, str], List[Tuple[str, FileSink]]]:
+    """Parse a multipart body as it arrives, handing file parts straight to sinks.
+
+    Nothing is spooled: each file part is written once, by its sink, while the request is still
+    streaming. `max_file_bytes` applies per file. On any error every sink opened so far is
+    discarded. On success the caller owns the returned (field, sink) pairs, in body order, and
+    must commit or discard them.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Expected multipart/form-data")
+    limit = max_file_bytes if max_file_bytes is not None else upload_limit_bytes()
+
+    # The parser's callbacks are synchronous; collect events per chunk and act on them afterwards.
+    events: List[Tuple[str, object]] = []
+    header_field, header_value = bytearray(), bytearray()
+    headers: Dict[bytes, bytes] = {}
+
+    def on_header_end() -> None:
+        headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+
+    def on_headers_finished() -> None:
+        events.append(("headers", dict(headers)))
+        headers.clear()
+
+    callbacks = {
+        "on_part_data": lambda data, start, end: events.append(("data", data[start:end])),
+        "on_part_end": lambda: events.append(("end", None)),
+        "on_header_field": lambda data, start, end: header_field.extend(data[start:end]),
+        "on_header_value": lambda data, start, end: header_value.extend(data[start:end]),
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+    }
+    parser = MultipartParser(boundary, callbacks)
+    fields: Dict[str, str] = {}
+    files: List[Tuple[str, FileSink]] = []
+    opened: List[FileSink] = []
+    name, sink, value = "", None, bytearray()
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for kind, payload in events:
+                if kind == "headers":
+                    if len(fields) + len(opened) >= max_parts:
+                        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Too many form parts")
+                    name, filename = _content_disposition(payload)
+                    sink = None
+                    if filename is not None:
+                        sink = await open_sink(name, filename)
+                        opened.append(sink)
+                    value.clear()
+                elif kind == "data" and sink is not None:
+                    if sink.size + len(payload) > limit:
+                        raise too_large()
+                    await sink.write(payload)
+                elif kind == "data":
+                    value += payload
+                    if len(value) > MAX_FIELD_BYTES:
+                        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Form field too large")
+                elif sink is not None:
+                    await sink.finish()
+                    files.append((name, sink))
+                    sink = None
+                else:
+                    fields[name] = value.decode("utf-8", "replace")
+            events.clear()
+        parser.finalize()
+        if sink is not None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Incomplete multipart body")
+    except OSError as exc:
+        for opened_sink in opened:
+            opened_sink.discard()
+        if exc.errno == errno.ENOSPC:
+            raise HTTPException(status_code=status.HTTP_507_INSUFFICIENT_STORAGE, detail="Not enough disk space") from exc
+        raise
+    except BaseException:
+        for opened_sink in opened:
+            opened_sink.discard()
+        raise
+    return fields, files
+
+
+async def receive_file(
+    request: Request, open_sink: SinkOpener, field: str = "upload", max_file_bytes: Optional[int] = None
+) -> Tuple[Dict[str, str], FileSink]:
+    """`stream_form` for endpoints taking exactly one file part named `field`."""
+    limit = max_file_bytes if max_file_bytes is not None else upload_limit_bytes()
+    if declared_length(request) > limit + MAX_PARTS * MAX_FIELD_BYTES:
+        raise too_large()  # before a single byte is written
+    fields, files = await stream_form(request, open_sink, limit)
+    sink = None
+    for name, part in files:
+        if name == field and sink is None:
+            sink = part
+        else:
+            part.discard()
+    if sink is None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Missing file field '{field}'")
+    return fields, sink
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import anyio
+import psutil
+
+from ..core.config import system_snapshot
+
+# Keys remembered for admission: an object is cached the second time it is asked for.
+SEEN_KEYS = 4096
+AUTO_FRACTION = 32  # of physical RAM, per worker, when files.cache.max_mb is 0
+AUTO_CEILING = 128 * 1024 * 1024
+
+Key = Tuple[str, int, int, int]
+
+
+def _settings() -> Dict[str, Any]:
+    return dict(system_snapshot().get("files", {}).get("cache", {}))
+
+
+class HotObjectCache:
+    """Byte-bounded LRU of whole files, for small/medium content many clients fetch at once.
+
+    Keys include size, mtime and inode, so a replaced file can never be served stale; explicit
+    invalidation just frees the memory early. Concurrent misses for one file share a single read.
+    """
+
+    def __init__(self) -> None:
+        self._entries: "OrderedDict[Key, bytes]" = OrderedDict()
+        self._seen: "OrderedDict[Key, None]" = OrderedDict()
+        self._loading: Dict[Key, "asyncio.Future[Optional[bytes]]"] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.loads = 0
+        self.evictions = 0
+        self.bytes_served = 0
+
+    @staticmethod
+    def capacity() -> int:
+        settings = _settings()
+        if not settings.get("enabled", True):
+            return 0
+        configured = int(settings.get("max_mb", 0)) * 1024 * 1024
+        return configured or min(psutil.virtual_memory().total // AUTO_FRACTION, AUTO_CEILING)
+
+    @staticmethod
+    def max_object() -> int:
+        return int(_settings().get("max_object_mb", 16)) * 1024 * 1024
+
+    async def get(self, path: Path, stat: os.stat_result) -> Optional[bytes]:
+        """The file's bytes from memory (loading them if the file is hot), or None to read from disk."""
+        capacity = self.capacity()
+        if not capacity or stat.st_size > min(self.max_object(), capacity):
+            return None
+        key = (str(path), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+        pending = self._loading.get(key)
+        if pending is not None:
+            self.collapsed += 1
+            return await asyncio.shield(pending)
+        self.misses += 1
+        if key not in self._seen:
+            self._seen[key] = None
+            while len(self._seen) > SEEN_KEYS:
+                self._seen.popitem(last=False)
+            return None
+
+        future: "asyncio.Future[Optional[bytes]]" = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            data = await anyio.to_thread.run_sync(path.read_bytes)
+            if len(data) != stat.st_size:
+                data = None  # changed under us; the next request gets a new key
+            else:
+                self.loads += 1
+                self._insert(key, data, capacity)
+        except OSError:
+            data = None
+        finally:
+            del self._loading[key]
+            future.set_result(data)
+        return data
+
+    def _insert(self, key: Key, data: bytes, capacity: int) -> None:
+        self._seen.pop(key, None)
+        self._entries[key] = data
+        self.size += len(data)
+        while self.size > capacity and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def served(self, count: int) -> None:
+        self.bytes_served += count
+
+    def invalidate(self, paths: Iterable[Path]) -> None:
+        names = {str(path) for path in paths}
+        for key in [key for key in self._entries if key[0] in names]:
+            self.size -= len(self._entries.pop(key))
+        for key in [key for key in self._seen if key[0] in names]:
+            del self._seen[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._seen.clear()
+        self.size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.collapsed + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "capacity_bytes": self.capacity(),
+            "hits": self.hits,
+            "collapsed_misses": self.collapsed,
+            "misses": self.misses,
+            "disk_loads": self.loads,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits + self.collapsed) / total, 4) if total else None,
+            "bytes_served": self.bytes_served,
+        }
+
+
+hot_cache = HotObjectCache()
@@ -0,0 +1,335 @@
+from __future__ import annotations
+
+import hashlib
+import mimetypes
+import os
+import zlib
+from email.utils import formatdate, parsedate_to_datetime
+from functools import partial
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Mapping, Optional, Tuple
+from urllib.parse import quote
+
+import aiofiles
+import anyio
+from fastapi import HTTPException, Request, status
+from fastapi.responses import Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from ..core.config import system_snapshot
+from ..core.paths import FILES_DIR
+from .hotcache import hot_cache
+
+CHUNK_SIZE = 256 * 1024
+# Raw files are read with pread() in a worker thread; bigger reads mean fewer thread hops per MiB.
+SLICE_CHUNK_SIZE = 1024 * 1024
+OFFLOAD_MODES = ("none", "x-accel", "x-sendfile")
+# Peers whose X-Real-IP / X-Forwarded-For is believed: the nginx in front of the backend.
+TRUSTED_PROXIES = {"127.0.0.1", "::1"}
+
+
+def strong_etag(stat: os.stat_result) -> str:
+    """Shared files are written once, so size + mtime + inode identify the exact bytes."""
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}-{stat.st_ino:x}"'
+
+
+def client_ip(request: Request) -> str:
+    """The client's address; behind the local reverse proxy, the one it forwarded."""
+    host = request.client.host if request.client else ""
+    if host in TRUSTED_PROXIES:
+        forwarded = request.headers.get("x-real-ip") or request.headers.get("x-forwarded-for", "").split(",")[0]
+        if forwarded.strip():
+            return forwarded.strip()
+    return host
+
+
+def client_fingerprint(request: Request) -> str:
+    """Stable per-client key (address + user agent) for grouping the requests of one download."""
+    raw = f"{client_ip(request)}|{request.headers.get('user-agent', '')}"
+    return hashlib.blake2b(raw.encode(), digest_size=12).hexdigest()
+
+
+def download_client(request: Request, ticket: Optional[str]) -> str:
+    """Download-session key: the download ticket when the request carries one, since every ticket is
+    issued to one client (so users behind one NAT with the same browser are told apart), else
+    `client_fingerprint`. An invented ticket only starts a new session, which is counted."""
+    if ticket:
+        return "ticket:" + hashlib.blake2b(ticket.encode(), digest_size=12).hexdigest()
+    return client_fingerprint(request)
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    candidates = [value.strip() for value in header.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def accepts_encoding(request: Request, encoding: str) -> bool:
+    for item in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        if name.strip().lower() in (encoding, "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    return bool(header) and _etag_matches(header, etag)
+
+
+def check_write_preconditions(request: Request, etag: Optional[str]) -> None:
+    """If-Match / If-None-Match on a write; `etag` is None when the resource does not exist yet."""
+    if_match = request.headers.get("if-match")
+    if if_match is not None:
+        candidates = [value.strip() for value in if_match.split(",")]
+        if etag is None or ("*" not in candidates and etag not in candidates):  # strong comparison only
+            raise _precondition_failed(etag)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag is not None and _etag_matches(if_none_match, etag):
+        raise _precondition_failed(etag)
+
+
+def _precondition_failed(etag: Optional[str]) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_412_PRECONDITION_FAILED,
+        detail="The file changed since it was read",
+        headers={"ETag": etag} if etag else None,
+    )
+
+
+def _if_range_allows(request: Request, etag: str, mtime: float) -> bool:
+    header = request.headers.get("if-range")
+    if not header:
+        return True
+    if header.startswith('"'):
+        return header == etag  # strong comparison only
+    try:
+        return int(parsedate_to_datetime(header).timestamp()) == int(mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive (start, end) for a single `bytes=` range; None means serve the whole file."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None  # multipart ranges are optional; a full 200 is a valid answer
+    start_raw, _, end_raw = spec.strip().partition("-")
+    try:
+        if start_raw:
+            start = int(start_raw)
+            end = min(int(end_raw), size - 1) if end_raw else size - 1
+        elif end_raw:
+            start, end = max(size - int(end_raw), 0), size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+
+def content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+class FileSliceResponse(Response):
+    """Sends bytes [start, start + length) of a file, zero-copy when the ASGI server offers it.
+
+    Servers advertising `http.response.zerocopysend` get the fd and sendfile() it straight to the
+    socket; `http.response.pathsend` covers whole-file responses. Otherwise the slice comes from
+    `read_slice` (hot-object cache, else pread() off the event loop).
+    """
+
+    def __init__(
+        self, path: Path, start: int, length: int, status_code: int, headers: Mapping[str, str], media_type: str
+    ) -> None:
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path, self.start, self.length = path, start, length
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        extensions = scope.get("extensions") or {}
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if "http.response.zerocopysend" in extensions:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                await send({"type": "http.response.zerocopysend", "file": fd, "offset": self.start, "count": self.length})
+            finally:
+                os.close(fd)
+        elif "http.response.pathsend" in extensions and self.start == 0 and self.length == self.path.stat().st_size:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+        else:
+            # Servers may swallow sends after the client left, so stop reading once it has.
+            async with anyio.create_task_group() as task_group:
+
+                async def wrap(func: Callable[[], Awaitable[None]]) -> None:
+                    await func()
+                    task_group.cancel_scope.cancel()
+
+                task_group.start_soon(wrap, partial(self._send_slice, send))
+                await wrap(partial(_wait_for_disconnect, receive))
+        if self.background is not None:
+            await self.background()
+
+    async def _send_slice(self, send: Send) -> None:
+        sent = 0
+        async for chunk in read_slice(self.path, self.start, self.length):
+            sent += len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": sent < self.length})
+        if sent < self.length:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def _wait_for_disconnect(receive: Receive) -> None:
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def read_slice(path: Path, offset: int, length: int) -> AsyncIterator[bytes]:
+    """Bytes [offset, offset + length) of a file, from the hot-object cache or via pread() in a thread."""
+    fd = await anyio.to_thread.run_sync(os.open, path, os.O_RDONLY)
+    try:
+        data = await hot_cache.get(path, os.fstat(fd))
+        if data is not None:
+            hot_cache.served(min(length, max(len(data) - offset, 0)))
+            view = memoryview(data)
+            for position in range(offset, min(offset + length, len(data)), SLICE_CHUNK_SIZE):
+                yield bytes(view[position : min(position + SLICE_CHUNK_SIZE, offset + length)])
+            return
+        while length > 0:
+            chunk = await anyio.to_thread.run_sync(os.pread, fd, min(SLICE_CHUNK_SIZE, length), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            length -= len(chunk)
+            yield chunk
+    finally:
+        os.close(fd)
+
+
+def offload_settings() -> Mapping[str, Any]:
+    return system_snapshot().get("files", {}).get("offload", {})
+
+
+def offload_response(path: Path, headers: Mapping[str, str], media_type: str) -> Optional[Response]:
+    """Empty response telling the reverse proxy to stream `path` itself, or None when offload is off.
+
+    The proxy then owns Range, conditional requests and sendfile(); only the headers that
+    describe the content are passed along.
+    """
+    settings = offload_settings()
+    mode = settings.get("mode", "none")
+    if mode == "x-accel":
+        try:
+            relative = path.resolve().relative_to(FILES_DIR.resolve())
+        except ValueError:
+            return None  # nginx only maps the files directory
+        prefix = str(settings.get("internal_prefix") or "/_dloper_files/").rstrip("/")
+        return Response(headers={**headers, "X-Accel-Redirect": f"{prefix}/{quote(relative.as_posix())}"}, media_type=media_type)
+    if mode == "x-sendfile":
+        return Response(headers={**headers, "X-Sendfile": str(path.resolve())}, media_type=media_type)
+    return None
+
+
+async def _gunzip_range(path: Path, start: int, length: int) -> AsyncIterator[bytes]:
+    """Decompress a gzip file on the fly, yielding only bytes [start, start + length) of the original."""
+    decompressor = zlib.decompressobj(31)
+    position = 0
+    async with aiofiles.open(path, "rb") as handle:
+        while length > 0:
+            compressed = await handle.read(CHUNK_SIZE)
+            if not compressed:
+                break
+            data = decompressor.decompress(compressed)
+            offset, position = position, position + len(data)
+            if position <= start:
+                continue
+            data = data[max(start - offset, 0) :][:length]
+            length -= len(data)
+            yield data
+
+
+BodyFactory = Callable[[int, int, int, Dict[str, str]], Response]
+
+
+def ranged_response(
+    request: Request,
+    size: int,
+    etag: str,
+    mtime: float,
+    filename: str,
+    media_type: str,
+    body: BodyFactory,
+    headers: Optional[Dict[str, str]] = None,
+) -> Response:
+    """Conditional/range negotiation for any representation of known size (200, 206, 304 or 416).
+
+    `body(start, length, status_code, headers)` builds the response for the selected bytes.
+    """
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": formatdate(mtime, usegmt=True),
+        "Content-Disposition": content_disposition(filename),
+        **(headers or {}),
+    }
+    if not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    start, end, status_code = 0, size - 1, status.HTTP_200_OK
+    range_header = request.headers.get("range")
+    if range_header and size and _if_range_allows(request, etag, mtime):
+        byte_range = parse_range(range_header, size)
+        if byte_range:
+            start, end = byte_range
+            status_code = status.HTTP_206_PARTIAL_CONTENT
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    length = max(end - start + 1, 0)
+    headers["Content-Length"] = str(length)
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+    return body(start, length, status_code, headers)
+
+
+def file_response(
+    request: Request,
+    path: Path,
+    filename: Optional[str] = None,
+    etag: Optional[str] = None,
+    content_encoding: Optional[str] = None,
+    decoded_size: Optional[int] = None,
+    offload: bool = False,
+) -> Response:
+    """Serve `path` honouring Range, If-Range and If-None-Match (200, 206, 304 or 416).
+
+    For a gzip-stored file pass `content_encoding="gzip"` to send it as stored, or
+    `decoded_size` to decompress it on the fly (ranges then refer to the original bytes).
+    With `offload`, raw files are handed to the reverse proxy when one is configured.
+    """
+    filename = filename or path.name
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    if offload and not content_encoding and decoded_size is None:
+        offloaded = offload_response(path, {"Content-Disposition": content_disposition(filename)}, media_type)
+        if offloaded is not None:
+            return offloaded
+    stat = path.stat()
+    headers: Dict[str, str] = {}
+    if content_encoding or decoded_size is not None:
+        headers["Vary"] = "Accept-Encoding"
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+
+    def body(start: int, length: int, status_code: int, headers: Dict[str, str]) -> Response:
+        if decoded_size is not None:
+            return StreamingResponse(_gunzip_range(path, start, length), status_code=status_code, headers=headers, media_type=media_type)
+        return FileSliceResponse(path, start, length, status_code, headers, media_type)
+
+    size = decoded_size if decoded_size is not None else stat.st_size
+    return ranged_response(request, size, etag or strong_etag(stat), stat.st_mtime, filename, media_type, body, headers)
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import secrets
+import time
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+# Kept free of app imports: these functions run inside the password-hashing worker processes.
+ITERATIONS = 390_000
+DEFAULT_PARAMS: Dict[str, Any] = {"scheme": "pbkdf2", "iterations": ITERATIONS}
+SCHEMES = ("pbkdf2", "scrypt")
+
+# Calibration never goes below these, however slow the host is.
+MIN_PBKDF2_ITERATIONS = 100_000
+MIN_SCRYPT_N = 1 << 14
+MAX_SCRYPT_N = 1 << 17  # 128 MiB per hash with r=8
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+def _b64(raw: bytes) -> str:
+    return base64.b64encode(raw).decode()
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=32)
+
+
+def hash_password(password: str, params: Optional[Mapping[str, Any]] = None) -> str:
+    params = params or DEFAULT_PARAMS
+    salt = secrets.token_bytes(16)
+    if params["scheme"] == "scrypt":
+        n, r, p = params["n"], params.get("r", SCRYPT_R), params.get("p", SCRYPT_P)
+        return f"scrypt${n}${r}${p}${_b64(salt)}${_b64(_scrypt(password, salt, n, r, p))}"
+    iterations = params["iterations"]
+    dk = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"pbkdf2${iterations}${_b64(salt)}${_b64(dk)}"
+
+
+def parse_params(encoded: str) -> Optional[Dict[str, Any]]:
+    parts = encoded.split("$")
+    try:
+        if parts[0] == "pbkdf2" and len(parts) == 4:
+            return {"scheme": "pbkdf2", "iterations": int(parts[1])}
+        if parts[0] == "scrypt" and len(parts) == 6:
+            return {"scheme": "scrypt", "n": int(parts[1]), "r": int(parts[2]), "p": int(parts[3])}
+    except ValueError:
+        pass
+    return None
+
+
+def needs_rehash(encoded: str, params: Mapping[str, Any]) -> bool:
+    current = parse_params(encoded)
+    return current is None or any(current.get(key) != value for key, value in params.items())
+
+
+def verify_password(password: str, encoded: str) -> bool:
+    try:
+        parts = encoded.split("$")
+        params = parse_params(encoded)
+        if params is None:
+            return False
+        salt = base64.b64decode(parts[-2].encode())
+        expected = base64.b64decode(parts[-1].encode())
+        if params["scheme"] == "scrypt":
+            candidate = _scrypt(password, salt, params["n"], params["r"], params["p"])
+        else:
+            candidate = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, params["iterations"])
+        return hmac.compare_digest(candidate, expected)
+    except Exception:
+        return False
+
+
+def _timed(params: Mapping[str, Any], rounds: int = 3) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        hash_password("calibration", params)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def calibrate(scheme: str, target_ms: float) -> Tuple[Dict[str, Any], float]:
+    """Pick the cost for `scheme` whose hash takes about `target_ms` here; returns (params, measured ms)."""
+    if scheme == "scrypt":
+        probe = {"scheme": "scrypt", "n": MIN_SCRYPT_N, "r": SCRYPT_R, "p": SCRYPT_P}
+        probe_ms = _timed(probe)
+        n = MIN_SCRYPT_N
+        # scrypt cost is linear in n; only powers of two are valid.
+        while n * 2 <= MAX_SCRYPT_N and probe_ms * (n * 2 // MIN_SCRYPT_N) <= target_ms:
+            n *= 2
+        params: Dict[str, Any] = {**probe, "n": n}
+    elif scheme == "pbkdf2":
+        probe = {"scheme": "pbkdf2", "iterations": 50_000}
+        iterations = int(probe["iterations"] * target_ms / _timed(probe)) // 10_000 * 10_000
+        params = {"scheme": "pbkdf2", "iterations": max(iterations, MIN_PBKDF2_ITERATIONS)}
+    else:
+        raise ValueError(f"Unknown password hashing scheme: {scheme}")
+    return params, round(_timed(params, rounds=1), 1)
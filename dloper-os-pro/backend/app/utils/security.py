@@ -1,49 +1,145 @@
 from __future__ import annotations
 
+import asyncio
 import base64
 import hashlib
 import hmac
+import multiprocessing
+import os
 import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Optional, Tuple
 
 import jwt
 from fastapi import HTTPException, status
 
-from ..core.config import get_system_settings
+from ..core.config import CONFIG_DIR, WORKERS, get_system_settings, save_yaml, system_snapshot
+from ..core.locks import file_lock
+from .passwords import (  # noqa: F401 - re-exported
+    DEFAULT_PARAMS,
+    ITERATIONS,
+    calibrate,
+    hash_password,
+    needs_rehash,
+    verify_password,
+)
 
 ALGORITHM = "HS256"
-ITERATIONS = 390_000
+# Hashing processes per API worker: together they use at most half the cores (minimum one each).
+HASH_WORKERS = max(1, (os.cpu_count() or 2) // 2 // WORKERS)
+# Requests allowed to wait for a hashing process before new ones are rejected with 429.
+HASH_QUEUE_LIMIT = 8 * HASH_WORKERS
+DOWNLOAD_TICKET_TTL_SECONDS = 15 * 60
 
 
-def hash_password(password: str) -> str:
-    salt = secrets.token_bytes(16)
-    dk = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, ITERATIONS)
-    return "pbkdf2${iter}${salt}${digest}".format(
-        iter=ITERATIONS,
-        salt=base64.b64encode(salt).decode(),
-        digest=base64.b64encode(dk).decode(),
-    )
+class HashPool:
+    """Size-limited process pool for PBKDF2 work with admission control."""
 
+    def __init__(self, workers: int, queue_limit: int) -> None:
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self._busy_seconds = 0.0
 
-def verify_password(password: str, encoded: str) -> bool:
-    try:
-        scheme, iter_str, salt_b64, digest_b64 = encoded.split("$")
-        if scheme != "pbkdf2":
-            return False
-        iterations = int(iter_str)
-        salt = base64.b64decode(salt_b64.encode())
-        expected = base64.b64decode(digest_b64.encode())
-        candidate = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
-        return hmac.compare_digest(candidate, expected)
-    except Exception:
-        return False
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver")
+            )
+        return self._executor
+
+    def _retry_after(self) -> int:
+        average = self._busy_seconds / self.completed if self.completed else 0.5
+        return max(1, int(average * (self._in_flight - self.workers + 1) / self.workers + 0.999))
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        with self._lock:
+            if self._in_flight >= self.workers + self.queue_limit:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="Too many password checks in progress",
+                    headers={"Retry-After": str(self._retry_after())},
+                )
+            self._in_flight += 1
+            pool = self._pool()
+        started = time.perf_counter()
+        try:
+            return await asyncio.wrap_future(pool.submit(func, *args))
+        except BrokenProcessPool:
+            with self._lock:
+                if self._executor is pool:
+                    self._executor = None
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self.completed += 1
+                self._busy_seconds += time.perf_counter() - started
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queue_limit": self.queue_limit,
+            "in_flight": self._in_flight,
+            "queue_depth": max(0, self._in_flight - self.workers),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_latency_ms": round(self._busy_seconds / self.completed * 1000, 1) if self.completed else None,
+        }
+
+
+hash_pool = HashPool(HASH_WORKERS, HASH_QUEUE_LIMIT)
+
+
+def hashing_params() -> Dict[str, Any]:
+    params = system_snapshot().get("security", {}).get("password_hashing", {}).get("params")
+    return dict(params) if params else dict(DEFAULT_PARAMS)
+
+
+def calibrate_password_hashing(force: bool = False) -> Dict[str, Any]:
+    """Benchmark this host once per scheme/target and persist the chosen cost in system.yaml."""
+    with file_lock("config-system"):
+        system = get_system_settings()
+        settings = system.setdefault("security", {}).setdefault("password_hashing", {})
+        scheme = settings.setdefault("scheme", "pbkdf2")
+        target_ms = settings.setdefault("target_ms", 250)
+        params = settings.get("params")
+        if not force and params and params.get("scheme") == scheme and settings.get("calibrated_for_ms") == target_ms:
+            return settings
+        settings["params"], settings["measured_ms"] = calibrate(scheme, target_ms)
+        settings["calibrated_for_ms"] = target_ms
+        settings["calibrated_at"] = datetime.utcnow().isoformat()
+        save_yaml(CONFIG_DIR / "system.yaml", system)
+        return settings
+
+
+async def hash_password_async(password: str) -> str:
+    return await hash_pool.run(hash_password, password, hashing_params())
+
+
+async def verify_password_async(password: str, encoded: str) -> bool:
+    return await hash_pool.run(verify_password, password, encoded)
 
 
 def create_access_token(data: Dict[str, Any], expires_minutes: Optional[int] = None) -> str:
-    settings = get_system_settings()
+    settings = system_snapshot()
     expiry = expires_minutes or settings.get("security", {}).get("token_expiry_minutes", 60)
-    to_encode = data.copy()
+    to_encode = dict(data)
     expire_at = datetime.utcnow() + timedelta(minutes=expiry)
     to_encode.update({"exp": expire_at})
     secret = settings.get("security", {}).get("secret_key")
@@ -51,7 +147,7 @@ def create_access_token(data: Dict[str, Any], expires_minutes: Optional[int] = N
 
 
 def decode_access_token(token: str) -> Dict[str, Any]:
-    settings = get_system_settings()
+    settings = system_snapshot()
     secret = settings.get("security", {}).get("secret_key")
     try:
         return jwt.decode(token, secret, algorithms=[ALGORITHM])
@@ -59,3 +155,29 @@ def decode_access_token(token: str) -> Dict[str, Any]:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired") from exc
     except jwt.PyJWTError as exc:  # type: ignore[attr-defined]
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token") from exc
+
+
+def _ticket_signature(file_id: str, expires: int, binding: str, nonce: str = "") -> str:
+    secret = (system_snapshot().get("security", {}).get("secret_key") or "").encode()
+    key = hmac.new(secret, b"download-ticket", hashlib.sha256).digest()
+    message = f"{file_id}\n{expires}\n{binding}" + (f"\n{nonce}" if nonce else "")
+    mac = hmac.new(key, message.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac).rstrip(b"=").decode()
+
+
+def create_download_ticket(file_id: str, binding: str, ttl: int = DOWNLOAD_TICKET_TTL_SECONDS) -> Tuple[str, int]:
+    """Sign `<expires>.<nonce>.<mac>` for one file; `binding` (the password hash) voids it on password change.
+
+    The nonce makes every ticket distinct, so downloads can be counted per ticket.
+    """
+    expires = int(time.time()) + ttl
+    nonce = secrets.token_urlsafe(9)
+    return f"{expires}.{nonce}.{_ticket_signature(file_id, expires, binding, nonce)}", expires
+
+
+def verify_download_ticket(ticket: str, file_id: str, binding: str) -> bool:
+    expires, _, rest = ticket.partition(".")
+    nonce, _, signature = rest.rpartition(".")  # tickets issued before nonces have none
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, _ticket_signature(file_id, int(expires), binding, nonce))
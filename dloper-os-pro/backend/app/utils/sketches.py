@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import math
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+def _hash_pair(value: str) -> Tuple[int, int]:
+    digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+
+
+class HyperLogLog:
+    """Cardinality estimate in 2**precision bytes (4 KiB at the default precision, ~1.6% error)."""
+
+    def __init__(self, precision: int = 12, registers: bytes = b"") -> None:
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers else bytearray(self.size)
+
+    def add(self, value: str) -> None:
+        hashed = _hash64(value)
+        index = hashed >> (64 - self.precision)
+        remainder = (hashed << self.precision) & 0xFFFFFFFFFFFFFFFF
+        rank = 64 - self.precision + 1 if remainder == 0 else 65 - remainder.bit_length()
+        rank = min(rank, 64 - self.precision + 1)
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self) -> int:
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        return cls(precision=int(math.log2(len(data))), registers=data)
+
+
+class CountMinSketch:
+    """Approximate frequency counts in a fixed depth x width table of 32-bit counters."""
+
+    def __init__(self, width: int = 2048, depth: int = 4, counters: bytes = b"") -> None:
+        self.width = width
+        self.depth = depth
+        self.table = array("I")
+        if counters:
+            self.table.frombytes(counters)
+        else:
+            self.table.extend([0] * (width * depth))
+
+    def _cells(self, value: str) -> List[int]:
+        first, second = _hash_pair(value)
+        return [row * self.width + (first + row * second) % self.width for row in range(self.depth)]
+
+    def add(self, value: str, count: int = 1) -> int:
+        cells = self._cells(value)
+        for cell in cells:
+            self.table[cell] = min(self.table[cell] + count, 0xFFFFFFFF)
+        return min(self.table[cell] for cell in cells)
+
+    def estimate(self, value: str) -> int:
+        return min(self.table[cell] for cell in self._cells(value))
+
+    def to_bytes(self) -> bytes:
+        return self.table.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, width: int = 2048, depth: int = 4) -> "CountMinSketch":
+        return cls(width=width, depth=depth, counters=data)
+
+
+class TopK:
+    """Heavy hitters: a count-min sketch for frequencies plus the `k` best candidates seen so far."""
+
+    def __init__(self, k: int = 20, sketch: Optional[CountMinSketch] = None, candidates: Optional[Dict[str, int]] = None) -> None:
+        self.k = k
+        self.sketch = sketch or CountMinSketch()
+        self.candidates: Dict[str, int] = candidates or {}
+
+    def add(self, value: str, count: int = 1) -> None:
+        estimate = self.sketch.add(value, count)
+        if value in self.candidates or len(self.candidates) < self.k:
+            self.candidates[value] = estimate
+            return
+        weakest = min(self.candidates, key=self.candidates.__getitem__)
+        if estimate > self.candidates[weakest]:
+            del self.candidates[weakest]
+            self.candidates[value] = estimate
+
+    def top(self, limit: Optional[int] = None) -> List[Dict[str, int]]:
+        ranked = sorted(self.candidates.items(), key=lambda item: item[1], reverse=True)
+        return [{"value": value, "count": count} for value, count in ranked[: limit or self.k]]
+
+    def to_bytes(self) -> bytes:
+        header = json.dumps({"k": self.k, "candidates": self.candidates}).encode()
+        return len(header).to_bytes(4, "big") + header + self.sketch.to_bytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "TopK":
+        length = int.from_bytes(data[:4], "big")
+        header = json.loads(data[4 : 4 + length])
+        return cls(k=header["k"], sketch=CountMinSketch.from_bytes(data[4 + length :]), candidates=header["candidates"])
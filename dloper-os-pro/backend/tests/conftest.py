@@ -0,0 +1,37 @@
+import copy
+import os
+import shutil
+import tempfile
+
+import pytest
+import yaml
+
+# Everything the app stores lives under DLOPER_BASE_DIR, read when app.core.paths is first imported.
+BASE_DIR = tempfile.mkdtemp(prefix="dloper-tests-")
+os.environ["DLOPER_BASE_DIR"] = BASE_DIR
+
+from app.core import config  # noqa: E402
+
+system = copy.deepcopy(config.DEFAULT_SYSTEM)
+# The public endpoints' rate limits would start answering 429 partway through the suite.
+system["files"]["limits"]["client"]["rate"] = system["files"]["limits"]["share"]["rate"] = 0
+config.ensure_directories()
+with open(config.CONFIG_DIR / "system.yaml", "w") as handle:
+    yaml.safe_dump(system, handle)
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+
+    with TestClient(app) as test_client:
+        yield test_client
+    shutil.rmtree(BASE_DIR, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def auth(client):
+    response = client.post("/api/auth/login", data={"username": "admin", "password": "admin123"})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
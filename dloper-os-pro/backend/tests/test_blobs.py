@@ -0,0 +1,63 @@
+from app.services import blobs, files
+
+DATA = b"shared content " * 100
+
+
+def upload(client, auth, data=DATA, name="a.txt"):
+    response = client.post("/api/files/upload", files={"upload": (name, data)}, headers=auth)
+    assert response.status_code == 200
+    return response.json()
+
+
+def bundle(client, auth, data=DATA):
+    parts = [("upload", ("docs/a.txt", data)), ("upload", ("b.txt", b"other " + data))]
+    response = client.post("/api/files/bundle", files=parts, headers=auth)
+    assert response.status_code == 200
+    return response.json()
+
+
+def refcount(digest):
+    blob = blobs.get_blob(digest)
+    return blob["refcount"] if blob else 0
+
+
+def test_shares_of_the_same_content_share_one_blob(client, auth):
+    data = b"dedup " * 500
+    first, second = upload(client, auth, data), upload(client, auth, data, "copy.txt")
+    assert first["sha256"] == second["sha256"]
+    assert refcount(first["sha256"]) == 2
+    assert client.delete(f"/api/files/{first['id']}", headers=auth).status_code == 200
+    assert refcount(first["sha256"]) == 1
+    assert client.get(f"/files/{second['id']}").content == data
+    assert client.delete(f"/api/files/{second['id']}", headers=auth).status_code == 200
+    assert refcount(first["sha256"]) == 0
+    assert not blobs.blob_path(first["sha256"]).exists()
+
+
+def test_purge_then_delete_releases_members_once(client, auth):
+    single = upload(client, auth)
+    packed = bundle(client, auth)
+    digest = single["sha256"]
+    assert refcount(digest) == 2
+
+    purged = files.purge_file(packed["id"])
+    assert purged["purged_at"] and not purged["active"]
+    assert purged["sha256"] is None and purged["members"] is None
+    assert refcount(digest) == 1
+
+    files.purge_file(packed["id"])  # a second purge has nothing left to release
+    assert files.delete_file(packed["id"])
+    assert refcount(digest) == 1
+    assert client.get(f"/files/{single['id']}").content == DATA
+
+    assert files.delete_file(single["id"])
+    assert refcount(digest) == 0
+
+
+def test_share_existing_adds_a_reference(client, auth):
+    original = upload(client, auth, b"by hash " * 300)
+    response = client.post("/api/files/share-existing", json={"sha256": original["sha256"], "filename": "again.txt"}, headers=auth)
+    assert response.status_code == 200
+    assert refcount(original["sha256"]) == 2
+    assert files.delete_file(original["id"]) and files.delete_file(response.json()["id"])
+    assert refcount(original["sha256"]) == 0
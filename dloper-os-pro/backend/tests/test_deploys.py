@@ -0,0 +1,109 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from app.core.paths import SITES_DIR
+from app.services import deploys
+
+
+def tar(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def zipped(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+@pytest.fixture(scope="module")
+def site(client, auth):
+    assert client.post("/api/websites/", json={"name": "rollback"}, headers=auth).status_code == 200
+    home = SITES_DIR / "rollback"
+    (home / "index.html").write_text("handmade")
+    (home / "img").mkdir()
+    (home / "img" / "logo.svg").write_text("<svg/>")
+    return home
+
+
+def deploy(client, auth, content):
+    response = client.post("/api/websites/rollback/deploy", content=content, headers=auth)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def releases(client, auth):
+    return client.get("/api/websites/rollback/releases", headers=auth).json()
+
+
+def live(home):
+    return os.readlink(home / "current"), (home / "current" / "index.html").read_text()
+
+
+def record(client, auth):
+    return next(site for site in client.get("/api/websites/", headers=auth).json() if site["name"] == "rollback")
+
+
+def test_deploy_and_rollback(client, auth, site):
+    first = deploy(client, auth, tar({"index.html": b"v1", "img/logo.svg": b"<svg/>"}))
+    assert live(site) == (f"releases/{first['release']}", "v1")
+    assert sorted(os.listdir(site)) == ["current", "releases"]
+    assert record(client, auth)["root_path"] == str(site / "current")
+
+    listed = releases(client, auth)
+    assert [entry["current"] for entry in listed] == [True, False]
+    initial = listed[1]["id"]
+    assert initial.endswith("-initial")
+    assert (site / "releases" / initial / "index.html").read_text() == "handmade"
+
+    second = deploy(client, auth, zipped({"index.html": b"v2", "img/logo.svg": b"<svg/>"}))
+    assert second["linked"] == 1  # the unchanged logo is hardlinked, not written again
+    logo = [site / "releases" / release / "img" / "logo.svg" for release in (first["release"], second["release"])]
+    assert os.stat(logo[0]).st_ino == os.stat(logo[1]).st_ino
+    assert live(site) == (f"releases/{second['release']}", "v2")
+
+    response = client.post(f"/api/websites/rollback/releases/{first['release']}/activate", headers=auth)
+    assert response.status_code == 200
+    assert live(site) == (f"releases/{first['release']}", "v1")
+    assert record(client, auth)["release"] == first["release"]
+    assert [entry["id"] for entry in releases(client, auth) if entry["current"]] == [first["release"]]
+
+    client.post(f"/api/websites/rollback/releases/{initial}/activate", headers=auth)
+    assert live(site) == (f"releases/{initial}", "handmade")
+    assert (site / "current" / "img" / "logo.svg").read_text() == "<svg/>"
+
+    client.post(f"/api/websites/rollback/releases/{second['release']}/activate", headers=auth)
+    assert live(site) == (f"releases/{second['release']}", "v2")
+    assert not [entry for entry in os.listdir(site) if entry.startswith(".current.")]
+
+
+@pytest.mark.parametrize("release_id", ["20990101T000000000Z-nothere", "../../etc", "current"])
+def test_activating_an_unknown_release(client, auth, site, release_id):
+    before = os.readlink(site / "current") if (site / "current").is_symlink() else None
+    response = client.post(f"/api/websites/rollback/releases/{release_id}/activate", headers=auth)
+    assert response.status_code == 404
+    assert (os.readlink(site / "current") if (site / "current").is_symlink() else None) == before
+
+
+def test_failed_deploy_leaves_the_live_release_alone(client, auth, site):
+    deploy(client, auth, tar({"index.html": b"good"}))
+    before = live(site)
+    count = len(releases(client, auth))
+    response = client.post("/api/websites/rollback/deploy", content=b"not an archive at all", headers=auth)
+    assert response.status_code == 400
+    unsafe = client.post("/api/websites/rollback/deploy", content=tar({"../escape.html": b"x"}), headers=auth)
+    assert unsafe.status_code == 400
+    assert live(site) == before
+    assert len(releases(client, auth)) == count
+    assert not [entry for entry in os.listdir(deploys.STAGING_DIR) if entry.startswith("rollback-")]
@@ -0,0 +1,68 @@
+import pytest
+import yaml
+
+from app.core import config
+from app.core.config import ConfigStore
+from app.core.persistence import Journal
+
+
+@pytest.fixture
+def crashing_store(monkeypatch, tmp_path):
+    """A store whose debounced flush never runs, as if the process died before it was due."""
+    monkeypatch.setattr(config, "FLUSH_DELAY_SECONDS", 0.5)
+    monkeypatch.setattr(ConfigStore, "_schedule_flush", lambda self: None)
+    return ConfigStore(Journal(tmp_path / ".journal"))
+
+
+def read(path):
+    with path.open() as handle:
+        return yaml.safe_load(handle)
+
+
+def test_unflushed_changes_are_recovered(crashing_store, tmp_path):
+    path = tmp_path / "users.yaml"
+    crashing_store.snapshot(path, {"users": []})
+    for name in ("a", "b", "c"):
+        document = crashing_store.load(path, {})
+        document["users"].append({"username": name})
+        crashing_store.store(path, document)
+    assert read(path) == {"users": []}
+
+    assert ConfigStore(Journal(tmp_path / ".journal")).recover() == 1
+    assert read(path) == {"users": [{"username": "a"}, {"username": "b"}, {"username": "c"}]}
+
+
+def test_recovery_after_a_partial_flush_is_idempotent(crashing_store, tmp_path):
+    users, sites = tmp_path / "users.yaml", tmp_path / "websites.yaml"
+    crashing_store.snapshot(users, {"users": [{"username": "admin"}]})
+    crashing_store.snapshot(sites, {"websites": []})
+    document = crashing_store.load(users, {})
+    document["users"].append({"username": "new"})
+    crashing_store.store(users, document)
+    document = crashing_store.load(sites, {})
+    document["websites"].append({"name": "blog"})
+    crashing_store.store(sites, document)
+
+    # The flush rewrote users.yaml, then died before websites.yaml and the journal truncation.
+    crashing_store._write(users, crashing_store._dirty[users])
+    expected_users = {"users": [{"username": "admin"}, {"username": "new"}]}
+    assert read(users) == expected_users
+
+    recovering = ConfigStore(Journal(tmp_path / ".journal"))
+    assert recovering.recover() == 1  # only websites.yaml still needed its entry
+    assert read(users) == expected_users  # the splice was not applied a second time
+    assert read(sites) == {"websites": [{"name": "blog"}]}
+    assert ConfigStore(Journal(tmp_path / ".journal")).recover() == 0
+
+
+def test_torn_trailing_entry_is_ignored(crashing_store, tmp_path):
+    path = tmp_path / "files.yaml"
+    crashing_store.snapshot(path, {"files": []})
+    document = crashing_store.load(path, {})
+    document["files"].append({"id": "x"})
+    crashing_store.store(path, document)
+    with (tmp_path / ".journal").open("a") as handle:
+        handle.write('{"path": "')
+
+    assert ConfigStore(Journal(tmp_path / ".journal")).recover() == 1
+    assert read(path) == {"files": [{"id": "x"}]}
@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+from app.services import blobs
+
+BOUNDARY = "testboundary7MA4YWxk"
+
+
+def part(name, value, filename=None):
+    disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else "")
+    head = f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n"
+    if filename:
+        head += "Content-Type: application/octet-stream\r\n"
+    return head.encode() + b"\r\n" + value + b"\r\n"
+
+
+def body(*parts, close=True):
+    return b"".join(parts) + (f"--{BOUNDARY}--\r\n".encode() if close else b"")
+
+
+def post(client, auth, content, content_type=f"multipart/form-data; boundary={BOUNDARY}"):
+    return client.post("/api/files/upload", content=content, headers={**auth, "Content-Type": content_type})
+
+
+def chunked(data, size):
+    for offset in range(0, len(data), size):
+        yield data[offset : offset + size]
+
+
+def downloaded(client, response):
+    assert response.status_code == 200, response.text
+    return client.get(f"/files/{response.json()['id']}").content
+
+
+def leftover_temps():
+    return os.listdir(blobs.TMP_DIR) if blobs.TMP_DIR.exists() else []
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"\r\n",
+        b"ends with a newline\r\n",
+        f"\r\n--{BOUNDARY}".encode()[:-1] + b"X almost a boundary",
+        f"--{BOUNDARY}".encode() + b" at the start of a line but not after CRLF",
+        b"\r\n--" + BOUNDARY[:10].encode() + b"\r\n--\r\n-" * 500,
+        os.urandom(300_000),
+    ],
+)
+def test_file_content_survives_intact(client, auth, data):
+    assert downloaded(client, post(client, auth, body(part("upload", data, "f.bin")))) == data
+
+
+@pytest.mark.parametrize("size", [1, 7, len(BOUNDARY) + 3, 4096])
+def test_boundaries_split_across_chunks(client, auth, size):
+    data = b"line\r\n" * 2000 + f"\r\n--{BOUNDARY[:-2]}".encode()
+    content = body(part("upload", data, "split.bin"), part("password", b"secret"))
+    response = post(client, auth, chunked(content, size))
+    assert response.status_code == 200, response.text
+    assert response.json()["password_protected"]
+    assert response.json()["size"] == len(data)
+
+
+def test_unterminated_body_is_rejected_and_cleaned_up(client, auth):
+    response = post(client, auth, body(part("upload", b"x" * 1000, "cut.bin"), close=False)[:-2])
+    assert response.status_code == 400
+    assert leftover_temps() == []
+
+
+def test_fields_only_body(client, auth):
+    response = post(client, auth, body(part("password", b"secret")))
+    assert response.status_code == 422
+
+
+@pytest.mark.parametrize(
+    "content_type", ["multipart/form-data", "application/x-www-form-urlencoded", "multipart/mixed; boundary=" + BOUNDARY]
+)
+def test_not_multipart_form_data(client, auth, content_type):
+    response = post(client, auth, body(part("upload", b"x", "a.bin")), content_type)
+    assert response.status_code == 415
+
+
+def test_too_many_parts(client, auth):
+    parts = [part(f"field{index}", b"v") for index in range(40)]
+    response = post(client, auth, body(part("upload", b"x", "a.bin"), *parts))
+    assert response.status_code == 400
+    assert leftover_temps() == []
+
+
+def test_oversized_field(client, auth):
+    response = post(client, auth, body(part("password", b"p" * (65 * 1024)), part("upload", b"x", "a.bin")))
+    assert response.status_code == 400
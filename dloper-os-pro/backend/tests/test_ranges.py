@@ -0,0 +1,78 @@
+import pytest
+
+DATA = bytes(range(256)) * 40  # 10240 bytes
+
+
+@pytest.fixture(scope="module")
+def share(client, auth):
+    response = client.post("/api/files/upload", files={"upload": ("data.bin", DATA)}, headers=auth)
+    assert response.status_code == 200
+    return f"/files/{response.json()['id']}"
+
+
+def test_full_download_advertises_ranges(client, share):
+    response = client.get(share)
+    assert response.status_code == 200
+    assert response.content == DATA
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["etag"].startswith('"')
+
+
+@pytest.mark.parametrize(
+    "header, start, end",
+    [
+        ("bytes=0-99", 0, 99),
+        ("bytes=10000-", 10000, len(DATA) - 1),
+        ("bytes=-16", len(DATA) - 16, len(DATA) - 1),
+        ("bytes=10200-99999", 10200, len(DATA) - 1),
+        ("bytes=-99999", 0, len(DATA) - 1),
+    ],
+)
+def test_single_ranges(client, share, header, start, end):
+    response = client.get(share, headers={"Range": header})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes {start}-{end}/{len(DATA)}"
+    assert response.headers["content-length"] == str(end - start + 1)
+    assert response.content == DATA[start : end + 1]
+
+
+@pytest.mark.parametrize("header", ["bytes=10240-", "bytes=20000-20010", "bytes=50-10"])
+def test_unsatisfiable_ranges(client, share, header):
+    response = client.get(share, headers={"Range": header})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(DATA)}"
+
+
+@pytest.mark.parametrize("header", ["bytes=0-1,5-6", "items=0-1", "bytes=abc", "bytes=-"])
+def test_ranges_not_honoured_get_the_whole_file(client, share, header):
+    response = client.get(share, headers={"Range": header})
+    assert response.status_code == 200
+    assert response.content == DATA
+
+
+def test_if_range(client, share):
+    etag = client.head(share).headers["etag"]
+    matching = client.get(share, headers={"Range": "bytes=0-9", "If-Range": etag})
+    assert matching.status_code == 206 and matching.content == DATA[:10]
+    stale = client.get(share, headers={"Range": "bytes=0-9", "If-Range": '"stale"'})
+    assert stale.status_code == 200 and stale.content == DATA
+    weak = client.get(share, headers={"Range": "bytes=0-9", "If-Range": f"W/{etag}"})
+    assert weak.status_code == 200
+    last_modified = client.head(share).headers["last-modified"]
+    dated = client.get(share, headers={"Range": "bytes=0-9", "If-Range": last_modified})
+    assert dated.status_code == 206
+    old = client.get(share, headers={"Range": "bytes=0-9", "If-Range": "Mon, 01 Jan 2001 00:00:00 GMT"})
+    assert old.status_code == 200
+
+
+def test_if_none_match(client, share):
+    etag = client.head(share).headers["etag"]
+    assert client.get(share, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(share, headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_head_with_range(client, share):
+    response = client.head(share, headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["content-length"] == "100"
+    assert response.content == b""
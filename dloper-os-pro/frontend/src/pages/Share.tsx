@@ -13,6 +13,7 @@ interface ShareMeta {
   download_count: number;
   password_protected: boolean;
   active?: boolean;
+  members?: { path: string; size: number }[];
 }
 
 function formatSize(bytes: number): string {
@@ -27,6 +28,7 @@ export default function Share() {
   const { fileId } = useParams();
   const [meta, setMeta] = useState<ShareMeta | null>(null);
   const [password, setPassword] = useState('');
+  const [ticket, setTicket] = useState<string | null>(null);
   const [error, setError] = useState<string | null>(null);
   const [needsPassword, setNeedsPassword] = useState(false);
   const [loading, setLoading] = useState(false);
@@ -38,11 +40,18 @@ export default function Share() {
     setError(null);
     setStatus(null);
     try {
+      // Trade the password for a signed ticket once; meta and download then skip the password hash
+      let unlocked = ticket;
+      if (password) {
+        const granted = await api.post(`/files/${fileId}/ticket`, { password });
+        unlocked = granted.data.ticket;
+        setTicket(unlocked);
+      }
       const res = await api.get(`/files/${fileId}/meta`, {
-        params: password ? { password } : {},
+        params: unlocked ? { ticket: unlocked } : {},
       });
       setMeta(res.data);
-      const requires = Boolean(res.data.password_protected);
+      const requires = Boolean(res.data.password_protected) && !unlocked;
       setNeedsPassword(requires);
       setStatus(requires ? 'Password required' : 'Link unlocked');
     } catch (err: any) {
@@ -71,9 +80,10 @@ export default function Share() {
     // eslint-disable-next-line react-hooks/exhaustive-deps
   }, [fileId]);
 
-  const download = () => {
+  const download = (member?: string) => {
     if (!fileId) return;
-    const url = `${API_BASE.replace(/\/$/, '')}/files/${fileId}${password ? `?password=${encodeURIComponent(password)}` : ''}`;
+    const path = member ? `/members/${member.split('/').map(encodeURIComponent).join('/')}` : '';
+    const url = `${API_BASE.replace(/\/$/, '')}/files/${fileId}${path}${ticket ? `?ticket=${encodeURIComponent(ticket)}` : ''}`;
     window.open(url, '_blank');
   };
 
@@ -180,12 +190,28 @@ export default function Share() {
               )}
               <button
                 className="w-full px-4 py-3 rounded-lg bg-mint text-midnight font-semibold flex items-center gap-2 justify-center"
-                onClick={download}
+                onClick={() => download()}
                 disabled={meta.active === false}
               >
-                <Download size={16} /> Download
+                <Download size={16} /> {meta.members ? 'Download all (ZIP)' : 'Download'}
               </button>
             </div>
+
+            {meta.members && (
+              <div className="max-h-64 overflow-y-auto divide-y divide-white/5 text-sm">
+                {meta.members.map((member) => (
+                  <button
+                    key={member.path}
+                    className="w-full flex items-center justify-between gap-3 py-2 text-left hover:text-mint"
+                    onClick={() => download(member.path)}
+                    disabled={meta.active === false}
+                  >
+                    <span className="truncate">{member.path}</span>
+                    <span className="text-sand/60 shrink-0">{formatSize(member.size)}</span>
+                  </button>
+                ))}
+              </div>
+            )}
           </div>
         )}
       </div>
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Download throughput benchmark for SmartShare links.
+
+Fetches one URL repeatedly from parallel clients and reports aggregate MB/s and latency.
+Run it once against the backend directly (Python serving) and once through nginx with
+`files.offload.mode: x-accel` to compare, e.g.:
+
+    scripts/bench-downloads.py http://127.0.0.1:8000/files/<id> -c 8 -n 64
+    scripts/bench-downloads.py http://pi.local/api/files/<id> -c 8 -n 64
+"""
+from __future__ import annotations
+
+import argparse
+import statistics
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+READ_SIZE = 1024 * 1024
+
+
+def fetch(url: str) -> Tuple[int, float]:
+    started = time.perf_counter()
+    received = 0
+    with urllib.request.urlopen(url) as response:
+        while chunk := response.read(READ_SIZE):
+            received += len(chunk)
+    return received, time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("url")
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("-n", "--requests", type=int, default=32)
+    args = parser.parse_args()
+
+    fetch(args.url)  # warm the page cache so both runs read from memory
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(fetch, [args.url] * args.requests))
+    elapsed = time.perf_counter() - started
+
+    total = sum(size for size, _ in results)
+    latencies = sorted(seconds for _, seconds in results)
+    print(f"requests     {len(results)} x {results[0][0] / 1e6:.1f} MB, concurrency {args.concurrency}")
+    print(f"throughput   {total / elapsed / 1e6:.1f} MB/s ({elapsed:.2f} s)")
+    print(f"latency p50  {statistics.median(latencies) * 1000:.0f} ms")
+    print(f"latency p95  {latencies[int(0.95 * (len(latencies) - 1))] * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,4 +5,12 @@ REPO_ROOT=$(cd "$(dirname "$0")/.." && pwd)
 VENV_DIR="$REPO_ROOT/.venv"
 source "$VENV_DIR/bin/activate"
 
-uvicorn backend.app.main:app --reload --port 8000 --app-dir "$REPO_ROOT"
+# WORKERS=4 scripts/run-backend.sh runs one process per Pi 5 core (no auto-reload).
+WORKERS=${WORKERS:-1}
+export DLOPER_WORKERS="$WORKERS"
+
+if [ "$WORKERS" -gt 1 ]; then
+  uvicorn backend.app.main:app --workers "$WORKERS" --port 8000 --app-dir "$REPO_ROOT"
+else
+  uvicorn backend.app.main:app --reload --port 8000 --app-dir "$REPO_ROOT"
+fi